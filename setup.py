@@ -4,7 +4,7 @@
 # To rebuild just the cython modules, use these commands:
 # sudo apt-get install python-setuptools cython
 # python3 setup.py build_ext --inplace
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 from Cython.Build import cythonize # Warning: must be _after_ setup import
 import glob
 import os
@@ -111,6 +111,11 @@ else:
     scripts = []
     sys.stderr.write("Warning: Platform %s not supported" % sys.platform)
 
+# The Cython modules use OpenMP to run on multiple threads
+cython_exts = [Extension("odemis.util." + os.path.splitext(os.path.basename(p))[0], [p],
+                         extra_compile_args=["-fopenmp"], extra_link_args=["-fopenmp"])
+               for p in glob.glob(os.path.join("src", "odemis", "util", "*.pyx"))]
+
 dist = setup(name='Odemis',
              version=VERSION,
              description='Open Delmic Microscope Software',
@@ -131,7 +136,7 @@ dist = setup(name='Odemis',
                            'odemis.gui': ["doc/*.html"],
                            'odemis.driver': ["*.tiff", "*.h5", "*.eds"],
                           },
-             ext_modules=cythonize(glob.glob(os.path.join("src", "odemis", "util", "*.pyx")), language_level=3),
+             ext_modules=cythonize(cython_exts, language_level=3),
              scripts=scripts,
              data_files=data_files,  # not officially in setuptools, but works as for distutils
              include_dirs=[numpy.get_include()],
@@ -30,7 +30,7 @@ import numpy
 from odemis import model, util
 from odemis.acq.align import transform, spot, autofocus, FindOverlay
 from odemis.acq.align.autofocus import AcquireNoBackground, MTD_EXHAUSTIVE
-from odemis.acq.drift import MeasureShift
+from odemis.acq.align.shift import MeasureShift
 from odemis.dataio import tiff
 from odemis.util import img, executeAsyncTask
 import os
@@ -23,6 +23,12 @@ import numpy
 from numpy import fft
 from numpy.fft import fftfreq
 
+try:
+    # Faster than numpy.fft, and can use multiple threads
+    from scipy import fft as sfft
+except ImportError:  # scipy < 1.4
+    sfft = None
+
 
 def _upsampled_dft(data, upsampled_region_size,
                    upsample_factor=1, axis_offsets=None):
@@ -87,6 +93,152 @@ def _upsampled_dft(data, upsampled_region_size,
     return data
 
 
+def _upsampled_dft_batch(data, upsampled_region_size, upsample_factor, axis_offsets):
+    """
+    Same as _upsampled_dft(), but for a stack of 2D data, each with its own
+    offsets.
+    data (numpy.array of shape NYX): The input data arrays (DFT of original data) to upsample.
+    upsampled_region_size (int): The size of the region to be sampled, on each dimension.
+    upsample_factor (int): The upsampling factor.
+    axis_offsets (numpy.array of shape N2): The offsets of the region to be sampled, for each data.
+    returns (numpy.ndarray of shape N x upsampled_region_size x upsampled_region_size):
+      The upsampled DFT of the specified regions.
+    """
+    im2pi = 1j * 2 * numpy.pi
+    ups = numpy.arange(upsampled_region_size)
+    kernels = []
+    for ax in (1, 2):
+        # N x upsampled_region_size x size of the axis
+        kernel = ((ups[None, :] - axis_offsets[:, ax - 1, None])[:, :, None]
+                  * fftfreq(data.shape[ax], upsample_factor))
+        kernel = numpy.exp(-im2pi * kernel)
+        # use kernel with same precision as the data
+        kernels.append(kernel.astype(data.dtype, copy=False))
+
+    # Equivalent to _upsampled_dft(), for each data: kernel_y @ data @ kernel_x.T
+    return kernels[0] @ data @ kernels[1].transpose(0, 2, 1)
+
+
+# Maximum number of pixels of the images processed at once by MeasureShifts().
+# Small images are processed together, to avoid the overhead of each call, but
+# big images are processed separately, as it's faster when the data fits in the
+# CPU cache.
+MAX_BATCH_PIXELS = 2 ** 16
+
+
+def _fft2(data, workers):
+    """
+    data (numpy.array of shape ...YX): the data
+    workers (int): maximum number of threads to use
+    return (numpy.array of complex): the FFT over the last 2 dimensions
+    """
+    if sfft is None:
+        return fft.fft2(data)
+    return sfft.fft2(data, workers=workers)
+
+
+def _ifft2(data, workers):
+    """
+    data (numpy.array of complex, of shape ...YX): the data
+    workers (int): maximum number of threads to use
+    return (numpy.array of complex): the inverse FFT over the last 2 dimensions
+    """
+    if sfft is None:
+        return fft.ifft2(data)
+    return sfft.ifft2(data, workers=workers)
+
+
+def _measure_shifts_batch(previous_imgs, current_imgs, precision, workers):
+    """
+    Computes the shifts of a stack of images, all at once. See MeasureShifts().
+    previous_imgs (numpy.array of shape NYX)
+    current_imgs (numpy.array of shape NYX)
+    precision (1<=int)
+    workers (int): maximum number of threads to use for the FFTs
+    returns (numpy.array of shape N2): the shift (x, y) of each pair
+    """
+    # Same precision as with numpy.fft, whichever the type of the data
+    previous_fft = _fft2(numpy.asarray(previous_imgs, dtype=numpy.float64), workers)
+    current_fft = _fft2(numpy.asarray(current_imgs, dtype=numpy.float64), workers)
+    shape = numpy.array(previous_fft.shape[1:])
+    image_product = numpy.multiply(previous_fft, numpy.conjugate(current_fft, out=current_fft), out=previous_fft)
+
+    # Cross-correlation computation, same as MeasureShift()
+    eps = numpy.finfo(image_product.real.dtype).eps
+    image_product /= numpy.maximum(numpy.abs(image_product), 100 * eps)
+    float_dtype = image_product.real.dtype
+    cross_correlation = _ifft2(image_product, workers)
+
+    # Locate the maximum of each pair
+    n = cross_correlation.shape[0]
+    maxima = numpy.argmax(numpy.abs(cross_correlation).reshape(n, -1), axis=1)
+    shifts = numpy.stack(numpy.unravel_index(maxima, shape), axis=1).astype(float_dtype, copy=False)
+    midpoints = numpy.fix(shape / 2)
+    shifts = numpy.where(shifts > midpoints, shifts - shape, shifts)
+
+    if precision > 1:
+        shifts = numpy.round(shifts * precision) / precision
+        upsampled_region_size = numpy.ceil(precision * 1.5)
+        # Center of output array at dftshift + 1
+        dftshift = numpy.fix(upsampled_region_size / 2.0)
+        # Matrix multiply DFT around the current shift estimate
+        sample_region_offset = dftshift - shifts * precision
+        cross_correlation = _upsampled_dft_batch(numpy.conjugate(image_product, out=image_product),
+                                                 int(upsampled_region_size),
+                                                 precision,
+                                                 sample_region_offset).conj()
+        # Locate maximum and map back to original pixel grid
+        maxima = numpy.argmax(numpy.abs(cross_correlation).reshape(n, -1), axis=1)
+        maxima = numpy.stack(numpy.unravel_index(maxima, cross_correlation.shape[1:]), axis=1)
+        maxima = maxima.astype(float_dtype, copy=False)
+        maxima -= dftshift
+
+        shifts += maxima / precision
+
+    return shifts[:, ::-1]
+
+
+def MeasureShifts(previous_imgs, current_imgs, precision=1, workers=1):
+    """
+    Same as MeasureShift(), but for many pairs of images at once. The FFTs,
+    cross-power spectra and subpixel refinements are computed on the stack of
+    images, which is faster than calling MeasureShift() on each pair.
+    previous_imgs (list of N numpy.array, or numpy.array of shape NYX): the
+      previous frames, all of the same shape
+    current_imgs (list of N numpy.array, or numpy.array of shape NYX): the
+      last frames, of the same shape as previous_imgs
+    precision (1<=int): Calculate drift within 1/precision of a pixel
+    workers (None or 1<=int): maximum number of threads to use for the FFTs.
+      If None, as many as there are CPUs.
+    returns (numpy.array of shape N2): Drift in pixels (horizontal, vertical)
+      for each pair.
+    """
+    if precision < 1:
+        raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
+    if len(previous_imgs) != len(current_imgs):
+        raise ValueError("Got %d previous images, but %d current images" %
+                         (len(previous_imgs), len(current_imgs)))
+    if len(previous_imgs) == 0:
+        return numpy.empty((0, 2))
+
+    shape = numpy.shape(previous_imgs[0])
+    if len(shape) != 2 or any(numpy.shape(im) != shape for im in previous_imgs) or \
+            any(numpy.shape(im) != shape for im in current_imgs):
+        raise ValueError("Images should all be 2D and have the same shape")
+    if workers is None:
+        workers = -1  # All the CPUs
+
+    # Process the pairs by batches, to limit the memory usage
+    n = len(previous_imgs)
+    batch_size = max(1, MAX_BATCH_PIXELS // (shape[0] * shape[1]))
+    shifts = []
+    for i in range(0, n, batch_size):
+        shifts.append(_measure_shifts_batch(previous_imgs[i:i + batch_size], current_imgs[i:i + batch_size],
+                                            precision, workers))
+
+    return numpy.concatenate(shifts)
+
+
 def MeasureShift(previous_img, current_img, precision=1):
     """
     The function is taken from skimage.registration._phase_cross_correlation.
@@ -158,3 +310,74 @@ def MeasureShift(previous_img, current_img, precision=1):
         shifts += maxima / precision
 
     return shifts[1], shifts[0]
+
+
+def _get_fft_shape(shape):
+    """
+    shape (tuple of ints): the shape of the data
+    return (tuple of ints): a shape at least as big, which is fast to compute
+      with a (real) FFT
+    """
+    if sfft is None:
+        return tuple(shape)
+    return tuple(sfft.next_fast_len(s, real=True) for s in shape)
+
+
+def _rfft2(data, shape):
+    """
+    data (numpy.array): 2D array of real numbers
+    shape (tuple of 2 ints): shape of the FFT, the data is padded with 0's
+    return (numpy.array of complex): the FFT, with the last dimension halved
+    """
+    if sfft is None:
+        return fft.rfft2(data, s=shape)
+    return sfft.rfft2(data, s=shape, workers=-1)
+
+
+def _irfft2(data, shape):
+    """
+    data (numpy.array of complex): FFT as returned by _rfft2()
+    shape (tuple of 2 ints): shape of the output
+    return (numpy.array of float): the inverse FFT
+    """
+    if sfft is None:
+        return fft.irfft2(data, s=shape)
+    return sfft.irfft2(data, s=shape, workers=-1)
+
+
+def MeasureOverlapShift(previous_img, current_img):
+    """
+    Same as MeasureShift() (with precision=1), but optimised for the overlapping
+    parts of tiles, which are typically thin strips: as the images are real,
+    only half of the FFT is computed, the images are padded to a shape fast to
+    compute with the FFT, and the computation uses multiple threads.
+    previous_img (numpy.array): 2d array with the previous frame
+    current_img (numpy.array): 2d array with the last frame, must be of same
+      shape as previous_img
+    returns (tuple of floats): Drift in pixels (horizontal, vertical).
+    """
+    assert previous_img.shape == current_img.shape, "Prev shape %s != new shape %s" % (
+        previous_img.shape, current_img.shape)
+
+    # The images are centred on 0, so that padding with 0's is the same as
+    # padding with the average value.
+    shape = _get_fft_shape(previous_img.shape)
+    previous_img = numpy.asarray(previous_img, dtype=numpy.float64)
+    current_img = numpy.asarray(current_img, dtype=numpy.float64)
+    previous_fft = _rfft2(previous_img - previous_img.mean(), shape)
+    current_fft = _rfft2(current_img - current_img.mean(), shape)
+    image_product = previous_fft * current_fft.conj()
+
+    # Same normalisation as MeasureShift()
+    eps = numpy.finfo(image_product.real.dtype).eps
+    image_product /= numpy.maximum(numpy.abs(image_product), 100 * eps)
+    cross_correlation = _irfft2(image_product, shape)
+
+    # Locate maximum
+    maxima = numpy.unravel_index(numpy.argmax(numpy.abs(cross_correlation)), shape)
+    shifts = numpy.array(maxima, dtype=numpy.float64)
+    shape = numpy.array(shape)
+    midpoints = numpy.fix(shape / 2)
+    shifts[shifts > midpoints] -= shape[shifts > midpoints]
+
+    return shifts[1], shifts[0]
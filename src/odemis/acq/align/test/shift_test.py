@@ -22,7 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 import math
 from numpy import fft
 import numpy
-from odemis.acq.align.shift import MeasureShift
+from odemis.acq.align.shift import MeasureShift, MeasureShifts
 from odemis.dataio import hdf5
 import os
 import unittest
@@ -206,5 +206,43 @@ class TestMeasureShift(unittest.TestCase):
         drift = MeasureShift(self.small_data, self.small_data_random_drifted_noisy, 10)
         numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
 
+    # @unittest.skip("skip")
+    def test_batch(self):
+        """
+        Tests that measuring many pairs at once gives the same shifts as measuring
+        each pair separately.
+        """
+        prev_imgs = [self.data[0], self.data[0], self.data[0], self.data_noisy]
+        cur_imgs = [self.data[0], self.data_drifted[0], self.data_random_drifted,
+                    self.data_random_drifted_noisy]
+        for precision in (1, 10):
+            shifts = MeasureShifts(prev_imgs, cur_imgs, precision)
+            self.assertEqual(shifts.shape, (len(prev_imgs), 2))
+            for p, c, s in zip(prev_imgs, cur_imgs, shifts):
+                numpy.testing.assert_array_almost_equal(s, MeasureShift(p, c, precision))
+
+        # Small images, which are all processed in a single batch, and with all the CPUs
+        prev_imgs = [self.small_data, self.small_data, self.small_data_noisy]
+        cur_imgs = [self.small_data_noisy, self.small_data_random_drifted,
+                    self.small_data_random_drifted_noisy]
+        shifts = MeasureShifts(prev_imgs, cur_imgs, 10, workers=None)
+        for p, c, s in zip(prev_imgs, cur_imgs, shifts):
+            numpy.testing.assert_array_almost_equal(s, MeasureShift(p, c, 10))
+        numpy.testing.assert_almost_equal(shifts[1], (self.small_deltac, self.small_deltar), 1)
+
+    # @unittest.skip("skip")
+    def test_batch_wrong_input(self):
+        """
+        Tests MeasureShifts with empty or incompatible inputs.
+        """
+        shifts = MeasureShifts([], [])
+        self.assertEqual(shifts.shape, (0, 2))
+
+        with self.assertRaises(ValueError):
+            MeasureShifts([self.data[0]], [self.data[0], self.data[0]])
+        with self.assertRaises(ValueError):
+            MeasureShifts([self.data[0]], [self.small_data])
+
+
 if __name__ == '__main__':
     unittest.main()
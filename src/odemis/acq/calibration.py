@@ -276,12 +276,27 @@ def apply_spectrum_corrections(data, bckg=None, coef=None):
       theta is NaN. The MD_THETA_LIST is updated to only contain the part with numbers.
     """
 
+    data = apply_spectrum_background(data, bckg)
+    data = apply_spectrum_efficiency(data, coef)
+    return data
+
+
+def apply_spectrum_background(data, bckg=None):
+    """
+    Apply the background correction to the given data if applicable, and in
+    case the MD_THETA_LIST is present, remove the NaN values.
+    This is the first step of apply_spectrum_corrections(), which doesn't depend
+    on the spectrum efficiency compensation.
+    :param data: (DataArray of at least 5 dims) The original data.
+    :param bckg: (None or DataArray of at least 5 dims) The background data.
+    :returns: (DataArray) The corrected data, or data itself if there is
+      nothing to correct.
+    """
     # handle time correlator data (chronograph) data
     # -> no spectrum efficiency compensation and bg correction supported
-    if data.shape[-5] <= 1 and data.shape[-4] > 1:
-        if bckg is not None or coef is not None:
-            raise ValueError("Background correction and spectrum efficiency compensation "
-                             "not supported on time correlator (chronograph) data")
+    if data.shape[-5] <= 1 and data.shape[-4] > 1 and bckg is not None:
+        raise ValueError("Background correction and spectrum efficiency compensation "
+                         "not supported on time correlator (chronograph) data")
 
     # TODO: use MD_BASELINE as a fallback?
     if bckg is not None:
@@ -342,6 +357,23 @@ def apply_spectrum_corrections(data, bckg=None, coef=None):
         except (ValueError, KeyError) as ex:
             logging.warning("Failed to correct chromatic aberration on angular spectrum data: %s", ex)
 
+    return data
+
+
+def apply_spectrum_efficiency(data, coef=None):
+    """
+    Apply the spectrum efficiency compensation factors to the given data if
+    applicable. This is the last step of apply_spectrum_corrections().
+    :param data: (DataArray of at least 5 dims) The data, after background correction.
+    :param coef: (None or DataArray of at least 5 dims) The coefficient data, with CTZYX = C1111.
+    :returns: (DataArray) The compensated data, or data itself if coef is None.
+    """
+    # handle time correlator data (chronograph) data
+    # -> no spectrum efficiency compensation and bg correction supported
+    if data.shape[-5] <= 1 and data.shape[-4] > 1 and coef is not None:
+        raise ValueError("Background correction and spectrum efficiency compensation "
+                         "not supported on time correlator (chronograph) data")
+
     if coef is not None:
         # Check if we have any wavelength information in data.
         if model.MD_WL_LIST not in data.metadata:
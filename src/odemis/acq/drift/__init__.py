@@ -28,7 +28,7 @@ import threading
 import numpy
 import cv2
 
-from odemis.acq.align.shift import MeasureShift
+from odemis.acq.align.shift import MeasureShift, MeasureShifts
 
 MIN_RESOLUTION = (20, 20)  # sometimes 8x8 works, but it's not reliable enough
 MAX_PIXELS = 128 ** 2  # px
@@ -172,13 +172,13 @@ class AnchoredEstimator(object):
             # Note: prev_drift and drift, don't represent exactly the same
             # value as the previous image also had drifted. So we need to
             # include also the drift of the previous image.
-            # Also, MeasureShift return the shift in image pixels, which is
+            # Also, MeasureShifts return the shift in image pixels, which is
             # different (usually bigger) from the SEM px.
-            prev_drift = MeasureShift(self.raw[-2], self.raw[-1], 10)
+            prev_drift, orig_drift = MeasureShifts([self.raw[-2], self.raw[0]],
+                                                   [self.raw[-1], self.raw[-1]], 10)
             prev_drift = (prev_drift[0] * self._scale[0] + self.drift[0],
                           prev_drift[1] * self._scale[1] + self.drift[1])
 
-            orig_drift = MeasureShift(self.raw[0], self.raw[-1], 10)
             self.drift = (orig_drift[0] * self._scale[0],
                           orig_drift[1] * self._scale[1])
             logging.debug("Current drift: %s", self.drift)
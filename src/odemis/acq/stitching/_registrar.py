@@ -37,13 +37,31 @@ from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
 
 from odemis import model
-from odemis.acq.drift import MeasureShift
+from odemis.acq.align.shift import MeasureOverlapShift
 
 GOOD_MATCH = 0.9  # consider all registrations with match > GOOD_MATCH
 LEFT_TO_RIGHT = 1
 RIGHT_TO_LEFT = -1
 
 
+def _normalized_cross_correlation(a, b, avg_a, avg_b):
+    """
+    Computes the normalized cross-correlation between two images of the same shape
+    a, b (numpy.array): the two images
+    avg_a, avg_b (float): the average value to subtract to each image
+    return (-1 <= float <= 1 or None): the bigger, the more similar are the images.
+      None if any of the images is constant.
+    """
+    dist_a = numpy.subtract(a, avg_a, dtype=numpy.float64).ravel()
+    dist_b = numpy.subtract(b, avg_b, dtype=numpy.float64).ravel()
+    covar = numpy.dot(dist_a, dist_b) / dist_a.size
+    var_a = numpy.dot(dist_a, dist_a) / dist_a.size
+    var_b = numpy.dot(dist_b, dist_b) / dist_b.size
+    if var_a == 0 or var_b == 0:
+        return None
+    return covar / math.sqrt(var_a * var_b)
+
+
 class IdentityRegistrar(object):
     """ Returns position as-is """
 
@@ -313,26 +331,14 @@ class ShiftRegistrar(object):
 
         (l1, t1, r1, b1), (l2, t2, r2, b2) = self._estimateROI(shift)
 
-        imageA_sh = numpy.array(imageA)[t1:b1, l1:r1]
-        imageB_sh = numpy.array(imageB)[t2:b2, l2:r2]
-
-        avg = (numpy.sum(imageA_sh) / imageA_sh.size,
-               numpy.sum(imageB_sh) / imageB_sh.size)
-
-        dist = (numpy.subtract(imageA_sh, avg[0]),
-                numpy.subtract(imageB_sh, avg[1]))
-
-        covar = numpy.sum(dist[0] * dist[1]) / imageA_sh.size
+        # Only look at the overlapping parts (without copying the whole tiles)
+        imageA_sh = numpy.asarray(imageA[t1:b1, l1:r1])
+        imageB_sh = numpy.asarray(imageB[t2:b2, l2:r2])
 
-        var = (numpy.sum(numpy.power(dist[0], 2)) / imageA_sh.size,
-               numpy.sum(numpy.power(dist[1], 2)) / imageB_sh.size)
-
-        stDev = (math.sqrt(var[0]), math.sqrt(var[1]))
-
-        if stDev[0] == 0 or stDev[1] == 0:
+        ncc = _normalized_cross_correlation(imageA_sh, imageB_sh, imageA_sh.mean(), imageB_sh.mean())
+        if ncc is None:
             return 0
-
-        return covar / (stDev[0] * stDev[1])
+        return ncc
 
     def _get_shift(self, prev_tile, tile, shift):
         """
@@ -344,7 +350,7 @@ class ShiftRegistrar(object):
         (l1, t1, r1, b1), (l2, t2, r2, b2) = self._estimateROI(shift)
         a = prev_tile[t1:b1, l1:r1]
         b = tile[t2:b2, l2:r2]
-        [x, y] = MeasureShift(b, a)
+        [x, y] = MeasureOverlapShift(b, a)
         return x, y
 
     def _register_horizontally(self, row, col, xdir):
@@ -478,6 +484,9 @@ class GlobalShiftRegistrar(ShiftRegistrar):
         # Calculated position of each tile relative to the upper left (first) tile in pixels as a 3D array of floats
         self.registered_positions_px = None  # 3D array of calculated shifts in px
 
+        # Average value of each tile, as it's used for the registration with each neighbour
+        self._tile_avg = {}  # id(tile) -> float
+
     def addTile(self, tile, dependent_tiles=None):
         """
         Extends grid by one tile. The first tile is added at the top left position. Any following
@@ -626,25 +635,21 @@ class GlobalShiftRegistrar(ShiftRegistrar):
             t2, b2 = 0, tile.shape[0] - int(exp_tile_dist_px[1])
 
         # TODO should we take a larger area?
-        prev_tile_roi = numpy.array(prev_tile)[t1:b1, l1:r1]
-        tile_roi = numpy.array(tile)[t2:b2, l2:r2]
+        # Only the overlapping parts are used (without copying the whole tiles)
+        prev_tile_roi = numpy.asarray(prev_tile[t1:b1, l1:r1])
+        tile_roi = numpy.asarray(tile[t2:b2, l2:r2])
 
         # If you need to crop the tile without changing the output shift,
         # you can do it here with the pattern tile_roi[t:-b, l:-r]
-        meas_tile_dist_px = MeasureShift(tile_roi, prev_tile_roi)
+        meas_tile_dist_px = MeasureOverlapShift(tile_roi, prev_tile_roi)
         # How much to shift the tile relative to the metadata position
         shift_px = numpy.subtract(exp_tile_dist_px, meas_tile_dist_px)
 
-        # Measure accuracy (ncc value)
-        avg = numpy.average(prev_tile), numpy.average(tile)
-        diff = prev_tile_roi - avg[0], tile_roi - avg[1]
-        covar = numpy.sum(diff[0] * diff[1]) / prev_tile_roi.size
-        var = numpy.sum(diff[0] ** 2) / prev_tile_roi.size, numpy.sum(diff[1] ** 2) / tile_roi.size
-        st_dev = (numpy.sqrt(var[0]), numpy.sqrt(var[1]))
-        if st_dev[0] == 0 or st_dev[1] == 0:
+        # Measure accuracy (ncc value, between -1 and 1)
+        ncc = _normalized_cross_correlation(prev_tile_roi, tile_roi,
+                                            self._get_tile_average(prev_tile), self._get_tile_average(tile))
+        if ncc is None:
             return exp_tile_dist_px, 0
-        # Normalized cross correlation (values between -1 and 1)
-        ncc = (covar / (st_dev[0] * st_dev[1]))
         overlap = numpy.abs(
             numpy.subtract(tile.shape[::-1], numpy.abs(exp_tile_dist_px)))  # tile.shape is YX, so reverse it
         if numpy.any(numpy.abs(meas_tile_dist_px) > overlap):
@@ -654,6 +659,18 @@ class GlobalShiftRegistrar(ShiftRegistrar):
 
         return shift_px, ncc
 
+    def _get_tile_average(self, tile):
+        """
+        :param tile: (DataArray) a tile of the grid
+        :returns: (float) the average value of the tile
+        """
+        try:
+            return self._tile_avg[id(tile)]
+        except KeyError:
+            avg = numpy.average(tile)
+            self._tile_avg[id(tile)] = avg
+            return avg
+
     def _compute_registration(self, tile, row, col):
         """
         Performs registration of the tile at grid position row, col with respect to every
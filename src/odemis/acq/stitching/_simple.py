@@ -22,42 +22,50 @@ from odemis.acq.stitching._registrar import ShiftRegistrar, IdentityRegistrar, G
 from odemis.acq.stitching._weaver import MeanWeaver, CollageWeaver, CollageWeaverReverse
 
 
-def register(tiles, method=REGISTER_GLOBAL_SHIFT):
+def get_registrar(method=REGISTER_GLOBAL_SHIFT):
     """
-    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration.
-    If it's tuples, the first tile of each tuple is the “main tile”, and the following ones are
-    dependent tiles.
-    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar
-    returns:
-        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
-        MD_POS metadata
+    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar,
+      REGISTER_GLOBAL_SHIFT → GlobalShiftRegistrar
+    returns (Registrar): a new registrar, to which the tiles can be added one at a time
     """
-
     if method == REGISTER_SHIFT:
-        registrar = ShiftRegistrar()
+        return ShiftRegistrar()
     elif method == REGISTER_IDENTITY:
-        registrar = IdentityRegistrar()
+        return IdentityRegistrar()
     elif method == REGISTER_GLOBAL_SHIFT:
-        registrar = GlobalShiftRegistrar()
+        return GlobalShiftRegistrar()
     else:
         raise ValueError("Invalid registrar %s" % (method,))
 
-    # Register tiles
-    updatedTiles = []
-    for ts in tiles:
-        # Separate tile and dependent_tiles
-        if isinstance(ts, tuple):
-            tile = ts[0]
-            dep_tiles = ts[1:]
-        else:
-            tile = ts
-            dep_tiles = None
-        registrar.addTile(tile, dep_tiles)
 
-    # Compute the positions
-    positions, dep_positions = registrar.getPositions()
+def add_registration_tile(registrar, ts):
+    """
+    Pass one tile (and its dependent tiles) to the registrar.
+    registrar (Registrar): the registrar to which to add the tile
+    ts (DataArray of shape YX or tuple of DataArrays): the tile. If it's a tuple,
+      the first tile is the “main tile”, and the following ones are dependent tiles.
+    """
+    # Separate tile and dependent_tiles
+    if isinstance(ts, tuple):
+        tile = ts[0]
+        dep_tiles = ts[1:]
+    else:
+        tile = ts
+        dep_tiles = None
+    registrar.addTile(tile, dep_tiles)
 
+
+def update_tile_positions(tiles, positions, dep_positions):
+    """
+    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles, as passed to the registrar
+    positions (list of tuples): the registered position of each tile
+    dep_positions (list of lists of tuples): the registered position of each dependent tile
+    returns:
+        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
+        MD_POS metadata
+    """
     # Update positions, by creating DataArrays with the same data, but different MD_POS
+    updatedTiles = []
     for i, ts in enumerate(tiles):
         # Return tuple of positions if dependent tiles are present
         if isinstance(ts, tuple):
@@ -87,20 +95,44 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
     return updatedTiles
 
 
-def weave(tiles, method=WEAVER_MEAN, adjust_brightness=False):
+def register(tiles, method=REGISTER_GLOBAL_SHIFT):
+    """
+    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration.
+    If it's tuples, the first tile of each tuple is the “main tile”, and the following ones are
+    dependent tiles.
+    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar
+    returns:
+        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
+        MD_POS metadata
+    """
+    registrar = get_registrar(method)
+
+    # Register tiles
+    for ts in tiles:
+        add_registration_tile(registrar, ts)
+
+    # Compute the positions
+    positions, dep_positions = registrar.getPositions()
+
+    return update_tile_positions(tiles, positions, dep_positions)
+
+
+def weave(tiles, method=WEAVER_MEAN, adjust_brightness=False, output_file=None):
     """
     tiles (list of DataArray or DataArrayShadow of shape YX): The tiles to draw
     method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
+    output_file (None or str): if a path is given, the image is written in this
+      file (as .npy), and the returned image is memory-mapped to it.
     return:
         image (DataArray of shape Y'X'): A large image containing all the tiles
     """
 
     if method == WEAVER_MEAN:
-        weaver = MeanWeaver(adjust_brightness)
+        weaver = MeanWeaver(adjust_brightness, output_file)
     elif method == WEAVER_COLLAGE:
-        weaver = CollageWeaver(adjust_brightness)
+        weaver = CollageWeaver(adjust_brightness, output_file)
     elif method == WEAVER_COLLAGE_REVERSE:
-        weaver = CollageWeaverReverse(adjust_brightness)
+        weaver = CollageWeaverReverse(adjust_brightness, output_file)
     else:
         raise ValueError("Invalid weaver %s" % (method,))
 
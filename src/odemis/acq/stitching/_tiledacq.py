@@ -21,9 +21,11 @@ import copy
 import logging
 import math
 import os
+import shutil
+import tempfile
 import threading
 import time
-from concurrent.futures import CancelledError, TimeoutError
+from concurrent.futures import CancelledError, Future, TimeoutError, ThreadPoolExecutor
 from concurrent.futures._base import RUNNING, FINISHED, CANCELLED
 from enum import Enum
 
@@ -37,7 +39,8 @@ from odemis.acq.align.autofocus import AutoFocus, MTD_EXHAUSTIVE
 from odemis.util.focus import MeasureOpticalFocus
 from odemis.acq.align.roi_autofocus import autofocus_in_roi, estimate_autofocus_in_roi_time
 from odemis.acq.stitching._constants import WEAVER_MEAN, REGISTER_IDENTITY, REGISTER_GLOBAL_SHIFT
-from odemis.acq.stitching._simple import register, weave
+from odemis.acq.stitching._simple import register, weave, get_registrar, add_registration_tile, \
+    update_tile_positions
 from odemis.acq.stream import Stream, EMStream, ARStream, \
     SpectrumStream, FluoStream, MultipleDetectorStream, util, executeAsyncTask, \
     CLStream
@@ -71,6 +74,50 @@ class FocusingMethod(Enum):
     MAX_INTENSITY_PROJECTION = 3
 
 
+class DiskTileStore(object):
+    """
+    Keeps the tiles in a temporary directory, instead of in memory. The tiles
+    are returned as DataArrays memory-mapped to their file, so only the parts
+    actually used are loaded in memory.
+    """
+
+    def __init__(self, dirname=None):
+        """
+        :param dirname: (str or None) the directory where to create the temporary
+          directory. If None, the default temporary directory is used.
+        """
+        self.path = tempfile.mkdtemp(prefix=".odemis-tiles-", dir=dirname)
+        self._count = 0
+        self._lock = threading.Lock()
+        logging.debug("Storing the tiles in %s", self.path)
+
+    def newFilename(self, name):
+        """
+        :param name: (str) base name of the file
+        :returns: (str) the full path of a new file in the store
+        """
+        with self._lock:
+            fn = os.path.join(self.path, "%s-%.6d.npy" % (name, self._count))
+            self._count += 1
+        return fn
+
+    def store(self, da):
+        """
+        Write a DataArray to the store.
+        :param da: (DataArray) the data to store
+        :returns: (DataArray) the same data and metadata, but read from the file
+        """
+        fn = self.newFilename("tile")
+        numpy.save(fn, da)
+        return DataArray(numpy.load(fn, mmap_mode="r"), da.metadata.copy())
+
+    def close(self):
+        """
+        Delete all the files of the store
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
 class TiledAcquisitionTask(object):
     """
     The goal of this task is to acquire a set of tiles then stitch them together
@@ -78,7 +125,7 @@ class TiledAcquisitionTask(object):
 
     def __init__(self, streams, stage, area, overlap, settings_obs=None, log_path=None, future=None, zlevels=None,
                  registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN, focusing_method=FocusingMethod.NONE,
-                 focus_points=None, focus_range=None):
+                 focus_points=None, focus_range=None, stitched_path=None):
         """
         :param streams: (list of Streams) the streams to acquire
         :param stage: (Actuator) the sample stage to move to the possible tiles locations
@@ -98,6 +145,10 @@ class TiledAcquisitionTask(object):
            If MAX_INTENSITY_PROJECTION is used, zlevels must be provided too.
         :param focus_points: (list of tuples) list of focus points corresponding to the known (x, y, z) at good focus.
               If None, the focus will not be adjusted based on the stage position.
+        :param stitched_path: (str or None) if a filename is given, the acquisition is done "out-of-core",
+           to allow acquiring areas bigger than the memory: the tiles are stored in a temporary
+           directory (next to the file), and the stitched images are written as pyramidal images
+           to this file. The result is then the data opened from the file (DataArrayShadows).
         """
         self._future = future
         self._streams = streams
@@ -210,6 +261,24 @@ class TiledAcquisitionTask(object):
         self._weaver = weaver
         self._focus_plane = {}
 
+        self._stitched_path = stitched_path
+        self._tile_store = None  # DiskTileStore, during an out-of-core acquisition
+        if stitched_path:
+            self._stitched_exporter = dataio.find_fittest_converter(stitched_path)
+            if not getattr(self._stitched_exporter, "CAN_SAVE_PYRAMID", False):
+                raise ValueError("Format of %s doesn't support pyramidal images" % (stitched_path,))
+
+        # The tiles are saved (and stored, in out-of-core mode) and registered by
+        # worker threads, while the next tiles are being acquired.
+        # Saving in order, with a single thread, to not compete for the disk
+        self._save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="TileSaver")
+        # The registrar expects the tiles in the acquisition order => single thread
+        self._reg_executor = model.CancellableThreadPoolExecutor(max_workers=1)
+        self._tile_registrar = None  # Registrar for the tiles acquired so far (or None)
+        self._registered_das = []  # list of tuples of DataArrays (or Futures) passed to the registrar
+        self._reg_futures = []  # Futures of the registration of each tile
+        self._reg_error = None  # None or ValueError raised by the registrar
+
     def _getFov(self, sd):
         """
         sd (Stream or DataArray): If it's a stream, it must be a live stream,
@@ -480,7 +549,12 @@ class TiledAcquisitionTask(object):
         """
         # Number of pixels for acquisition
         pxs = sum(self._estimateStreamPixels(s) for s in self._streams)
-        pxs *= self._nx * self._ny
+        if self._stitched_path:
+            # Out-of-core: only the tiles being processed are in memory. The
+            # registration works on one row of tiles at a time.
+            pxs *= self._nx + 2
+        else:
+            pxs *= self._nx * self._ny
 
         # Memory calculation
         mem_est = pxs * self.MEMPP
@@ -492,6 +566,26 @@ class TiledAcquisitionTask(object):
 
         return mem_sufficient, mem_est
 
+    def estimateDiskSpace(self):
+        """
+        Makes an estimate for the amount of disk space needed to store the tiles
+        and the stitched images during an out-of-core acquisition.
+        :returns (bool) True if sufficient space is available, (float) estimated space in bytes
+        """
+        if not self._stitched_path:
+            return True, 0
+
+        # The tiles, the stitched images (with some margin for the overlap, and
+        # the zoom levels), and the final file (typically, compressed)
+        pxs = sum(self._estimateStreamPixels(s) for s in self._streams) * self._nx * self._ny
+        bpp = 2  # Most of the detectors are 16 bits
+        space_est = pxs * bpp * 3
+        dirname = os.path.dirname(os.path.abspath(self._stitched_path))
+        space_free = shutil.disk_usage(dirname).free
+        logging.debug("Estimating %g GB needed on disk, while %g GB available",
+                      space_est / 1024 ** 3, space_free / 1024 ** 3)
+        return space_est < space_free, space_est
+
     STITCH_SPEED = 1e8  # px/s
 
     def estimateTime(self, remaining=None):
@@ -543,10 +637,76 @@ class TiledAcquisitionTask(object):
             else:
                 fn_tile = "%s-%.5dx%.5d%s" % (self._fn_bs, ix, iy, self._fn_ext)
             logging.debug("Will save data of tile %dx%d to %s", ix, iy, fn_tile)
-            self._exporter.export(os.path.join(self._log_dir, fn_tile), das)
+            try:
+                self._exporter.export(os.path.join(self._log_dir, fn_tile), das)
+            except Exception:
+                logging.exception("Failed to save data of tile %dx%d", ix, iy)
+
+        # Run in a separate thread, while the next tile is being acquired
+        self._save_executor.submit(save_tile, ix, iy, das, stream_cube_id)
+
+    def _storeTile(self, das):
+        """
+        Write the tile to the tile store, in a separate thread, while the next
+        tile is being acquired.
+        :param das: (tuple of DataArrays) the data of the tile
+        :returns: (Future) returns the tuple of DataArrays, read from the store
+        """
+        return self._save_executor.submit(lambda: tuple(self._tile_store.store(da) for da in das))
+
+    @staticmethod
+    def _getTileData(das):
+        """
+        :param das: (tuple of DataArrays, or Future returning it) the data of a tile
+        :returns: (tuple of DataArrays) the data of the tile, waiting for it if needed
+        """
+        if isinstance(das, Future):
+            return das.result()
+        return das
+
+    def _startRegistration(self):
+        """
+        Prepare the registrar, so that the tiles can be registered as soon as
+        they are acquired.
+        """
+        self._tile_registrar = get_registrar(self._registrar)
+        self._registered_das = []
+        self._reg_futures = []
+        self._reg_error = None
+
+    def _registerTile(self, das):
+        """
+        Pass the tile to the registrar, in a separate thread, while the next tiles
+        are being acquired.
+        :param das: (tuple of DataArrays, or Future returning it) the sorted
+          data of the tile, as returned by _sortDAs
+        """
+        if self._tile_registrar is None or not das:
+            return
+
+        self._registered_das.append(das)
+        self._reg_futures.append(self._reg_executor.submit(self._addRegistrationTile, das))
+
+    def _addRegistrationTile(self, das):
+        """
+        Add a tile to the registrar. Runs in the registration thread.
+        """
+        if self._reg_error is not None or self._future._task_state == CANCELLED:
+            return  # No need to register anymore
+        try:
+            add_registration_tile(self._tile_registrar, self._getTileData(das))
+        except ValueError as ex:
+            # Will fallback to the identity registration when stitching
+            self._reg_error = ex
 
-        # Run in a separate thread
-        threading.Thread(target=save_tile, args=(ix, iy, das, stream_cube_id), ).start()
+    def _stopRegistration(self):
+        """
+        Cancel the registration of the tiles not yet registered, and discard the registrar
+        """
+        self._reg_executor.cancel()
+        self._tile_registrar = None
+        self._registered_das = []
+        self._reg_futures = []
 
     def _acquireStreamCompressedZStack(self, i, ix, iy, stream):
         """
@@ -638,6 +798,7 @@ class TiledAcquisitionTask(object):
         da_list = []  # for each position, a list of DataArrays
         prev_idx = [0, 0]
         i = 0
+        self._startRegistration()
         # Make sure to begin from starting position
         logging.debug("Moving to tile (0, 0) at %s m", self._starting_pos)
         self._future.running_subf = self._stage.moveAbs(self._starting_pos)
@@ -666,9 +827,20 @@ class TiledAcquisitionTask(object):
                 self._save_tiles(ix, iy, das)
 
             # Sort tiles (largest sem on first position)
-            da_list.append(self._sortDAs(das, self._streams))
+            das = self._sortDAs(das, self._streams)
+            if self._tile_store:
+                # Out-of-core: only keep the tiles on disk (written while moving to the next tile)
+                das = self._storeTile(das)
+            da_list.append(das)
+            # Register the tile against the previous ones, while moving to the next tile
+            self._registerTile(das)
 
             i += 1
+
+        if self._tile_store:
+            # Wait for all the tiles to be stored (the registered tiles are the same objects)
+            da_list = [self._getTileData(das) for das in da_list]
+            self._registered_das = [self._getTileData(das) for das in self._registered_das]
         return da_list
 
     def _get_z_on_focus_plane(self, x, y):
@@ -835,35 +1007,75 @@ class TiledAcquisitionTask(object):
         Stitch the acquired tiles to create a complete view of the required total area
         :return: (list of DataArrays): a stitched data for each stream acquisition
         """
-        st_data = []
         logging.info("Computing big image out of %d images", len(da_list))
 
-        # TODO: Do this registration step in a separate thread while acquiring
         try:
-            das_registered = register(da_list, method=self._registrar)
+            das_registered = self._getRegisteredTiles(da_list)
         except ValueError as exp:
             logging.warning("Registration with %s failed %s. Retrying with identity registrar.", self._registrar, exp)
             das_registered = register(da_list, method=REGISTER_IDENTITY)
 
         logging.info("Using weaving method %s.", self._weaver)
-        # Weave every stream
+        # Weave every stream, in parallel
         if isinstance(das_registered[0], tuple):
-            for s in range(len(das_registered[0])):
-                streams = []
-                for da in das_registered:
-                    streams.append(da[s])
-                da = weave(streams, self._weaver)
-                st_data.append(da)
+            streams_tiles = [[da[s] for da in das_registered] for s in range(len(das_registered[0]))]
         else:
-            da = weave(das_registered, self._weaver)
-            st_data.append(da)
-        return st_data
+            streams_tiles = [das_registered]
+
+        if self._tile_store:
+            # Out-of-core: the stitched images are written to disk too
+            weave_stream = lambda tiles: weave(tiles, self._weaver,
+                                               output_file=self._tile_store.newFilename("stitched"))
+        else:
+            weave_stream = lambda tiles: weave(tiles, self._weaver)
+
+        if len(streams_tiles) == 1:
+            return [weave_stream(streams_tiles[0])]
+        with ThreadPoolExecutor(max_workers=len(streams_tiles), thread_name_prefix="Weaver") as executor:
+            return list(executor.map(weave_stream, streams_tiles))
+
+    def _exportStitchedData(self, st_data):
+        """
+        Write the stitched images as a pyramidal file, and open it again
+        :param st_data: (list of DataArrays) the stitched data, memory-mapped
+        :returns: (list of DataArrayShadows) the same data, read from the file
+        """
+        logging.info("Saving stitched images to %s", self._stitched_path)
+        self._stitched_exporter.export(self._stitched_path, st_data, pyramid=True)
+        return self._stitched_exporter.open_data(self._stitched_path).content
+
+    def _getRegisteredTiles(self, da_list):
+        """
+        Computes the registered position of the tiles. If the tiles have already
+        been passed to the registrar during the acquisition, it waits for it to
+        be done, and only computes the final positions.
+        :param da_list: (list of tuples of DataArrays) the tiles
+        :returns: (list of tuples of DataArrays) the tiles, with the MD_POS updated
+        :raises ValueError: if the registration failed
+        """
+        registered = (self._tile_registrar is not None and
+                      len(self._registered_das) == len(da_list) and
+                      all(r is d for r, d in zip(self._registered_das, da_list)))
+        if not registered:
+            logging.debug("Tiles not registered during acquisition, registering them now")
+            self._stopRegistration()
+            return register(da_list, method=self._registrar)
+
+        # Wait for all the tiles to be registered
+        for f in self._reg_futures:
+            f.result()
+        if self._reg_error is not None:
+            raise self._reg_error
+
+        positions, dep_positions = self._tile_registrar.getPositions()
+        return update_tile_positions(da_list, positions, dep_positions)
 
     def run(self):
         """
         Runs the tiled acquisition procedure
         returns:
-            (list of DataArrays): a stitched data for each stream acquisition
+            (list of DataArrays): a stitched data for each stream acquisition. In case of
+              out-of-core acquisition, these are DataArrayShadows, read from the stitched file.
         raise:
             CancelledError: if acquisition is cancelled
             Exception: if it failed before any result were acquired
@@ -872,6 +1084,8 @@ class TiledAcquisitionTask(object):
             return
         self._future._task_state = RUNNING
         st_data = []
+        if self._stitched_path:
+            self._tile_store = DiskTileStore(os.path.dirname(os.path.abspath(self._stitched_path)))
         try:
             # Acquire the needed tiles
             da_list = self._acquireTiles()
@@ -883,6 +1097,8 @@ class TiledAcquisitionTask(object):
                 # Stitch the acquired tiles
                 self._future.set_progress(end=self.estimateTime(0) + time.time())
                 st_data = self._stitchTiles(da_list)
+                if self._stitched_path and st_data:
+                    st_data = self._exportStitchedData(st_data)
 
             if self._future._task_state == CANCELLED:
                 raise CancelledError()
@@ -894,6 +1110,14 @@ class TiledAcquisitionTask(object):
             self._future.running_subf.cancel()
             raise
         finally:
+            self._stopRegistration()
+            # Wait for the tiles to be saved (and stored, before deleting the store),
+            # and stop the worker threads
+            self._save_executor.shutdown(wait=True)
+            self._reg_executor.shutdown(wait=True)
+            if self._tile_store:
+                self._tile_store.close()
+                self._tile_store = None
             logging.info("Tiled acquisition ended")
             with self._future._task_lock:
                 self._future._task_state = FINISHED
@@ -924,7 +1148,7 @@ def estimateTiledAcquisitionMemory(*args, **kwargs):
 
 def acquireTiledArea(streams, stage, area, overlap=0.2, settings_obs=None, log_path=None, zlevels=None,
                      registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN, focusing_method=FocusingMethod.NONE,
-                     focus_points=None, focus_range=None):
+                     focus_points=None, focus_range=None, stitched_path=None):
     """
     Start a tiled acquisition task for the given streams (SEM or FM) in order to
     build a complete view of the TEM grid. Needed tiles are first acquired for
@@ -941,12 +1165,16 @@ def acquireTiledArea(streams, stage, area, overlap=0.2, settings_obs=None, log_p
     # Create a tiled acquisition task
     task = TiledAcquisitionTask(streams, stage, area, overlap, settings_obs, log_path, future=future, zlevels=zlevels,
                                 registrar=registrar, weaver=weaver, focusing_method=focusing_method,
-                                focus_points=focus_points, focus_range=focus_range)
+                                focus_points=focus_points, focus_range=focus_range,
+                                stitched_path=stitched_path)
     future.task_canceller = task._cancelAcquisition  # let the future cancel the task
     # Estimate memory and check if it's sufficient to decide on running the task
     mem_sufficient, mem_est = task.estimateMemory()
     if not mem_sufficient:
         raise IOError("Not enough RAM to safely acquire the overview: %g GB needed" % (mem_est / 1024 ** 3,))
+    space_sufficient, space_est = task.estimateDiskSpace()
+    if not space_sufficient:
+        raise IOError("Not enough disk space to acquire the overview: %g GB needed" % (space_est / 1024 ** 3,))
 
     future.set_progress(end=task.estimateTime() + time.time())
     # connect the future to the task and run in a thread
@@ -16,9 +16,11 @@ You should have received a copy of the GNU General Public License along with Ode
 """
 
 from abc import ABCMeta
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import copy
 import numpy
+import os
 from abc import abstractmethod
 from odemis import model, util
 from odemis.util import img
@@ -38,13 +40,17 @@ class Weaver(metaclass=ABCMeta):
     A weaver assembles a set of small images with MD_POS metadata (tiles) into one large image.
     """
 
-    def __init__(self, adjust_brightness=False):
+    def __init__(self, adjust_brightness=False, output_file=None):
         """
         adjust_brightness (bool): True if brightness correction should be applied (useful in case of
         tiles with strong bleaching/depletion effects)
+        output_file (None or str): if a path is given, the weaved image is directly
+          written into this file, as a memory-mapped .npy file, instead of being
+          kept in memory. This allows to weave images bigger than the memory.
         """
         self.tiles = []
         self.adjust_brt = adjust_brightness
+        self.output_file = output_file
         self.tbbx_px = None  # the bounding boxes of each tile in pixel coordinates
         self.gbbx_px = None  # the global bounding box of the weaved image in pixel coordinates
         self.gbbx_phy = None  # the global bounding box of the weaved image in physical coordinates
@@ -166,6 +172,49 @@ class Weaver(metaclass=ABCMeta):
         md[model.MD_DIMS] = "YX"
         return md
 
+    def _create_image(self):
+        """
+        Create the weaved image, filled with the minimum value of the tiles,
+        in memory or in the output file.
+        return (2D ndarray): image of the shape of the global bounding box
+        """
+        logging.debug("Generating global image of size %dx%d px",
+                      self.gbbx_px[-2], self.gbbx_px[-1])
+        shape = (self.gbbx_px[-1], self.gbbx_px[-2])
+        dtype = self.tiles[0].dtype
+        if self.output_file:
+            im = numpy.lib.format.open_memmap(self.output_file, mode="w+", dtype=dtype, shape=shape)
+        else:
+            im = numpy.empty(shape, dtype=dtype)
+        # Create a background of the image using the minimum value of self.tiles
+        im[...] = min(t.min() for t in self.tiles)
+        return im
+
+    def _find_overlaps(self):
+        """
+        Find which previous tiles each tile overlaps with
+        return (list of list of int): for each tile, the indices of the previous
+          tiles overlapping with it.
+        """
+        # To avoid comparing every pair of tiles, the tiles are first sorted in
+        # cells of a grid, of the size of the largest tile.
+        cw = max(b[2] - b[0] for b in self.tbbx_px)
+        ch = max(b[3] - b[1] for b in self.tbbx_px)
+        cells = {}  # (int, int) -> list of int
+        overlaps = []
+        for i, b in enumerate(self.tbbx_px):
+            cell_idx = [(cx, cy) for cx in range(b[0] // cw, (b[2] - 1) // cw + 1)
+                                 for cy in range(b[1] // ch, (b[3] - 1) // ch + 1)]
+            candidates = set()
+            for c in cell_idx:
+                candidates.update(cells.get(c, ()))
+            overlaps.append(sorted(j for j in candidates
+                                   if (self.tbbx_px[j][0] < b[2] and b[0] < self.tbbx_px[j][2] and
+                                       self.tbbx_px[j][1] < b[3] and b[1] < self.tbbx_px[j][3])))
+            for c in cell_idx:
+                cells.setdefault(c, []).append(i)
+        return overlaps
+
     def _adjust_brightness(self, tile, tiles):
         """
         Adjusts the brightness of a tile, so its mean corresponds to the mean of a list of tiles.
@@ -212,13 +261,9 @@ class CollageWeaver(Weaver):
         Weave tiles by pasting the tiles where their center position is.
         return (2D DataArray): The weaved image.
         """
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
+        im = self._create_image()
 
+        # Paste each tile
         for b, t in zip(self.tbbx_px, self.tiles):
             if self.adjust_brt:
                 t = self._adjust_brightness(t, self.tiles)
@@ -240,28 +285,24 @@ class CollageWeaverReverse(Weaver):
         Weave tiles by filling parts of the global image that are still empty with the new tile.
         return (2D DataArray): The weaved image.
         """
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
+        im = self._create_image()
 
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=bool)
-
-        for b, t in zip(self.tbbx_px, self.tiles):
+        # Paste each tile
+        overlaps = self._find_overlaps()
+        for b, t, ovl in zip(self.tbbx_px, self.tiles, overlaps):
             # Part of image overlapping with tile
             roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
+            # The part of the tile already filled by the previous tiles
+            moi = numpy.zeros(t.shape, dtype=bool)
+            for j in ovl:
+                o = self.tbbx_px[j]
+                moi[max(o[1] - b[1], 0):o[3] - b[1], max(o[0] - b[0], 0):o[2] - b[0]] = True
 
             if self.adjust_brt:
                 t = self._adjust_brightness(t, self.tiles)
 
             # Insert image at positions that are still empty
             roi[~moi] = t[~moi]
-
-            # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
         return im
 
 
@@ -271,53 +312,25 @@ class MeanWeaver(Weaver):
     average of the pixel of each tile.
     """
 
-    def weave_tiles(self):
+    def __init__(self, adjust_brightness=False, output_file=None):
         """
-        Weave tiles by using a smooth gradient.
-        return (2D DataArray): The weaved image.
+        See Weaver
         """
-        #  The part of the tile that does not overlap
-        # with any previous tiles is inserted into the part of the
-        # ovv image that is still empty. This part is determined by a mask, which indicates
-        # the parts of the image that already contain image data (True) and the ones that are still
-        # empty (False). For the overlapping parts, the tile is multiplied with weights corresponding
-        # to a gradient that has its maximum at the center of the tile and
-        # smoothly decreases toward the edges. The function for creating the weights is
-        # a distance measure resembling the maximum-norm, i.e. equidistant points lie
-        # on a rectangle (instead of a circle like for the euclidean norm). Additionally,
-        # the x and y values generating this norm are raised to the power of 6 to
-        # create a steeper gradient. The value 6 is quite arbitrary and was found to give
-        # good results during experimentation.
-        # The part of the overview image that overlaps with the new tile is multiplied with the
-        # complementary weights (1 -  weights) and the weighted overlapping parts of the new tile and
-        # the ovv image are added, so the resulting image contains a gradient in the overlapping regions
-        # between all the tiles that have been inserted before and the newly inserted tile.
-
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
-
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=bool)
-
-        for b, t in zip(self.tbbx_px, self.tiles):
-            # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-
-            if self.adjust_brt:
-                self._adjust_brightness(t, self.tiles)
-            # Insert image at positions that are still empty
-            roi[~moi] = t[~moi]
-
-            # Create gradient in overlapping region. Ratio between old image and new tile values determined by
-            # distance to the center of the tile
+        super().__init__(adjust_brightness, output_file)
+        self._weights = {}  # tile shape -> 2D array of float: the blending weights
 
+    def _get_weights(self, shape):
+        """
+        Get the weights to blend a tile with the previous ones
+        shape (int, int): shape of the tile
+        return (2D ndarray of float): weight of the previous tiles, from 0 at the
+          center of the tile, to 1 on the borders.
+        """
+        w = self._weights.get(shape)
+        if w is None:
             # Create weight matrix with decreasing values from its center that
             # has the same size as the tile.
-            sz = numpy.array(roi.shape)
+            sz = numpy.array(shape)
             hh, hw = sz / 2  # half-height, half-width
             x = numpy.linspace(-hw, hw, sz[1])
             y = numpy.linspace(-hh, hh, sz[0])
@@ -331,10 +344,112 @@ class MeanWeaver(Weaver):
             # rest of the region. However, this approach does not solve the hardcoding problem
             # since the overlap region is still arbitrary. Future solutions might adaptively
             # select this region.
+            w.flags.writeable = False
+            self._weights[shape] = w
+        return w
 
-            # Use weights to create gradient in overlapping region
-            roi[moi] = (t * (1 - w))[moi] + (roi * w)[moi]
+    @staticmethod
+    def _split_rectangles(rects):
+        """
+        Split the union of rectangles into non-overlapping rectangles
+        rects (list of (int, int, int, int)): ltrb of each rectangle
+        return (list of (int, int, int, int)): ltrb of each rectangle, which
+          cover the same area, but don't overlap
+        """
+        xs = sorted({r[0] for r in rects} | {r[2] for r in rects})
+        ys = sorted({r[1] for r in rects} | {r[3] for r in rects})
+        splitted = []
+        for y0, y1 in zip(ys[:-1], ys[1:]):
+            # Merge the consecutive cells of the row which are covered
+            start = None
+            for x0, x1 in zip(xs[:-1], xs[1:]):
+                covered = any(r[0] <= x0 and x1 <= r[2] and r[1] <= y0 and y1 <= r[3] for r in rects)
+                if covered and start is None:
+                    start = x0
+                elif not covered and start is not None:
+                    splitted.append((start, y0, x0, y1))
+                    start = None
+            if start is not None:
+                splitted.append((start, y0, xs[-1], y1))
+        return splitted
+
+    def _weave_tile(self, im, i, overlaps):
+        """
+        Insert a tile in the final image, blending it with the previous tiles
+        im (2D ndarray): the final image
+        i (int): index of the tile
+        overlaps (list of int): indices of the previous tiles which overlap with this tile
+        """
+        b = self.tbbx_px[i]
+        t = self.tiles[i]
+        if self.adjust_brt:
+            t = self._adjust_brightness(t, self.tiles)
+
+        # Part of image overlapping with tile
+        roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
+
+        # The areas of the tile already containing data (in tile coordinates)
+        rects = []
+        for j in overlaps:
+            o = self.tbbx_px[j]
+            rects.append((max(o[0], b[0]) - b[0], max(o[1], b[1]) - b[1],
+                          min(o[2], b[2]) - b[0], min(o[3], b[3]) - b[1]))
+        rects = self._split_rectangles(rects) if rects else []
+
+        # Keep the previous data, before inserting the tile
+        prev = [roi[r[1]:r[3], r[0]:r[2]].copy() for r in rects]
+        roi[...] = t
+
+        # Create gradient in overlapping region. Ratio between old image and new tile values determined by
+        # distance to the center of the tile
+        w = self._get_weights(t.shape)
+        for r, p in zip(rects, prev):
+            sl = numpy.s_[r[1]:r[3], r[0]:r[2]]
+            roi[sl] = t[sl] * (1 - w[sl]) + p * w[sl]
+
+    def weave_tiles(self):
+        """
+        Weave tiles by using a smooth gradient.
+        return (2D DataArray): The weaved image.
+        """
+        #  The part of the tile that does not overlap
+        # with any previous tiles is inserted into the part of the
+        # ovv image that is still empty. For the overlapping parts, the tile is multiplied with weights corresponding
+        # to a gradient that has its maximum at the center of the tile and
+        # smoothly decreases toward the edges. The function for creating the weights is
+        # a distance measure resembling the maximum-norm, i.e. equidistant points lie
+        # on a rectangle (instead of a circle like for the euclidean norm). Additionally,
+        # the x and y values generating this norm are raised to the power of 6 to
+        # create a steeper gradient. The value 6 is quite arbitrary and was found to give
+        # good results during experimentation.
+        # The part of the overview image that overlaps with the new tile is multiplied with the
+        # complementary weights (1 -  weights) and the weighted overlapping parts of the new tile and
+        # the ovv image are added, so the resulting image contains a gradient in the overlapping regions
+        # between all the tiles that have been inserted before and the newly inserted tile.
+        # Only the areas where the tile overlaps with previous tiles (typically
+        # strips on the borders) are blended, the rest is just copied.
+        # The tiles are inserted in order, but the tiles which don't depend on
+        # each other (ie, no overlap, and all their previous overlapping tiles are
+        # inserted) are inserted in parallel.
+
+        im = self._create_image()
+
+        # Group the tiles by "level": a tile is at the level after the highest
+        # level of the previous tiles it overlaps with.
+        overlaps = self._find_overlaps()
+        levels = []
+        tile_level = []
+        for i, ovl in enumerate(overlaps):
+            lvl = max((tile_level[j] + 1 for j in ovl), default=0)
+            tile_level.append(lvl)
+            if lvl == len(levels):
+                levels.append([])
+            levels[lvl].append(i)
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            for tiles_idx in levels:
+                futures = [executor.submit(self._weave_tile, im, i, overlaps[i]) for i in tiles_idx]
+                for f in futures:
+                    f.result()  # Raise an exception if it failed
 
-            # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
         return im
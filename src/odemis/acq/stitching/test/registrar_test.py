@@ -23,9 +23,11 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 import copy
 import itertools
 import logging
+import math
 import os
 import random
 import re
+import time
 import unittest
 import warnings
 
@@ -33,6 +35,7 @@ import numpy
 
 import odemis
 from odemis import model
+from odemis.acq.align.shift import MeasureShift, MeasureOverlapShift
 from odemis.acq.stitching import IdentityRegistrar, ShiftRegistrar, GlobalShiftRegistrar
 from odemis.acq.stitching.test.stitching_test import decompose_image
 from odemis.dataio import find_fittest_converter
@@ -912,5 +915,78 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                     self.assertAlmostEqual(dep_tile[1], p[1] + r2 * px_size[1])
 
 
+
+class TestRegistrationSpeed(unittest.TestCase):
+    """
+    Benchmark the registration on a large grid of tiles
+    """
+
+    def test_grid_20x20(self):
+        """Register a synthetic 20x20 grid, and compare with the full-FFT shift measurement"""
+        num, tile_size, overlap = 20, 256, 0.15
+        step = int(tile_size * (1 - overlap))
+        px_size = 1e-6
+        rng = numpy.random.default_rng(1)
+        # Random texture, smoothed just a little bit
+        size = step * (num - 1) + tile_size + 20
+        img = rng.integers(0, 1000, (size, size)).astype(numpy.float32)
+        img = (img[:-1, :-1] + img[1:, :-1] + img[:-1, 1:] + img[1:, 1:]).astype(numpy.uint16)
+
+        tiles = []
+        exp_pos = []
+        for row in range(num):
+            for col in range(num):
+                # Actual position (top-left, px), with the first tile at the expected position
+                x, y = col * step, row * step
+                if row or col:
+                    x += rng.integers(-5, 6)
+                    y += rng.integers(-5, 6)
+                    x, y = max(x, 0), max(y, 0)
+                md = {
+                    model.MD_PIXEL_SIZE: (px_size, px_size),
+                    # The stage position reported is the ideal one
+                    model.MD_POS: ((col * step + tile_size / 2) * px_size, -(row * step + tile_size / 2) * px_size),
+                }
+                tiles.append(model.DataArray(img[y:y + tile_size, x:x + tile_size], md))
+                exp_pos.append(((x + tile_size / 2) * px_size, -(y + tile_size / 2) * px_size))
+
+        for registrar_cls in (ShiftRegistrar, GlobalShiftRegistrar):
+            registrar = registrar_cls()
+            tstart = time.time()
+            for t in tiles:
+                registrar.addTile(t)
+            positions, _ = registrar.getPositions()
+            dur = time.time() - tstart
+            logging.info("Registration of %dx%d tiles with %s took %g s",
+                         num, num, registrar_cls.__name__, dur)
+
+            # The relative position of each tile to its left neighbour should be correct
+            errors = []
+            for i in range(len(tiles)):
+                if i % num == 0:
+                    continue
+                rel_pos = numpy.subtract(positions[i], positions[i - 1])
+                exp_rel_pos = numpy.subtract(exp_pos[i], exp_pos[i - 1])
+                errors.append(math.hypot(*(rel_pos - exp_rel_pos)) / px_size)
+            self.assertLessEqual(numpy.median(errors), 1.5, "%s" % registrar_cls.__name__)
+
+        # Compare the shift measurement with the full-FFT one, on all the horizontal overlaps
+        strips = []
+        for row in range(num):
+            for col in range(num - 1):
+                prev_tile, tile = tiles[row * num + col], tiles[row * num + col + 1]
+                strips.append((tile[:, :tile_size - step], prev_tile[:, step:]))
+
+        tstart = time.time()
+        shifts_full = [MeasureShift(b, a) for b, a in strips]
+        dur_full = time.time() - tstart
+        tstart = time.time()
+        shifts_overlap = [MeasureOverlapShift(b, a) for b, a in strips]
+        dur_overlap = time.time() - tstart
+        logging.info("Measuring %d shifts took %g s with MeasureShift, and %g s with MeasureOverlapShift",
+                     len(strips), dur_full, dur_overlap)
+        numpy.testing.assert_array_equal(shifts_full, shifts_overlap)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -19,9 +19,10 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 """
 import logging
 import os
+import tempfile
 import time
 import unittest
-from concurrent.futures._base import CancelledError, FINISHED
+from concurrent.futures._base import CancelledError, FINISHED, RUNNING
 
 import numpy
 
@@ -30,7 +31,7 @@ from odemis import model
 from odemis.acq import stream
 from odemis.acq.acqmng import SettingsObserver
 from odemis.acq.stitching import WEAVER_COLLAGE_REVERSE, REGISTER_IDENTITY, \
-    WEAVER_MEAN, acquireTiledArea, FocusingMethod
+    WEAVER_MEAN, acquireTiledArea, FocusingMethod, register, weave, estimateTiledAcquisitionMemory
 from odemis.acq.stitching._tiledacq import TiledAcquisitionTask
 from odemis.util import testing, img
 from odemis.util.comp import compute_camera_fov, compute_scanner_fov
@@ -493,6 +494,55 @@ class CRYOSECOMTestCase(unittest.TestCase):
         self.assertIsInstance(data[0], model.DataArray)
         self.assertEqual(len(data[0].shape), 2)
 
+    def test_registration_during_acquisition(self):
+        """
+        Test the tiles are registered while acquiring, and give the same result
+        as registering them after the acquisition.
+        """
+        sem_fov = compute_scanner_fov(self.ebeam)
+        area = (0, 0, sem_fov[0] * 2.5, sem_fov[1] * 1.5)
+        overlap = 0.2
+        self.stage.moveAbs({'x': 0, 'y': 0}).result()
+        future = model.ProgressiveFuture()
+        tiled_acq_task = TiledAcquisitionTask(self.sem_streams, self.stage, area=area,
+                                              overlap=overlap, future=future)
+        future._task_state = RUNNING
+        da_list = tiled_acq_task._acquireTiles()
+        self.assertGreater(len(da_list), 1)
+        self.assertEqual(len(tiled_acq_task._registered_das), len(da_list))
+
+        data = tiled_acq_task._stitchTiles(da_list)
+        exp_data = weave([das[0] for das in register(da_list)], WEAVER_MEAN)
+        self.assertEqual(len(data), 1)
+        numpy.testing.assert_array_equal(data[0], exp_data)
+        self.assertEqual(data[0].metadata[model.MD_POS], exp_data.metadata[model.MD_POS])
+
+    def test_out_of_core(self):
+        """
+        Test the tiles and the stitched images are stored on disk, when a
+        stitched_path is given
+        """
+        sem_fov = compute_scanner_fov(self.ebeam)
+        area = (0, 0, sem_fov[0] * 2.5, sem_fov[1] * 1.5)
+        overlap = 0.2
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, "overview.ome.tiff")
+            mem_sufficient, mem_est = estimateTiledAcquisitionMemory(self.sem_streams, self.stage, area, overlap)
+            mem_sufficient_disk, mem_est_disk = estimateTiledAcquisitionMemory(self.sem_streams, self.stage, area,
+                                                                               overlap, stitched_path=fn)
+            self.assertLessEqual(mem_est_disk, mem_est)
+
+            self.stage.moveAbs({'x': 0, 'y': 0}).result()
+            future = acquireTiledArea(self.sem_streams, self.stage, area=area, overlap=overlap,
+                                      stitched_path=fn)
+            data = future.result()
+            self.assertEqual(len(data), 1)
+            self.assertIsInstance(data[0], model.DataArrayShadow)
+            self.assertEqual(len(data[0].shape), 2)
+            self.assertGreater(data[0].maxzoom, 0)
+            # Only the stitched file is left
+            self.assertEqual(os.listdir(tmpdir), ["overview.ome.tiff"])
+
     def test_progress(self):
         """
        Test progress update of acquireTiledArea function
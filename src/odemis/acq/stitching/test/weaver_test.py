@@ -358,6 +358,50 @@ class TestMeanWeaver(WeaverBaseTest, unittest.TestCase):
             # value than the value of the right pixel
             self.assertLess(row[-1], row[0])
 
+    def test_split_rectangles(self):
+        """
+        Test the union of rectangles is split into non-overlapping rectangles
+        """
+        # Typical overlap of a tile on a grid: strips on the top and on the left
+        rects = [(0, 0, 100, 10), (0, 0, 10, 100), (90, 0, 100, 10)]
+        split = MeanWeaver._split_rectangles(rects)
+        mask_exp = numpy.zeros((100, 100), dtype=int)
+        for r in rects:
+            mask_exp[r[1]:r[3], r[0]:r[2]] = 1
+        mask = numpy.zeros((100, 100), dtype=int)
+        for r in split:
+            mask[r[1]:r[3], r[0]:r[2]] += 1
+        numpy.testing.assert_array_equal(mask, mask_exp)
+
+    def test_output_file(self):
+        """
+        Test that weaving into a file gives the same result as in memory
+        """
+        # 3 x 4 tiles, irregularly placed
+        tiles = []
+        for i in range(3):
+            for j in range(4):
+                md = {
+                    model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                    model.MD_POS: ((j * 85 + random.randint(-3, 3)) * 1e-6, (i * 80 + random.randint(-3, 3)) * 1e-6),
+                }
+                tiles.append(model.DataArray(numpy.random.randint(0, 4000, (100, 100), dtype=numpy.uint16), md))
+
+        weaver = MeanWeaver()
+        for t in tiles:
+            weaver.addTile(t)
+        outd = weaver.getFullImage()
+
+        fn = "test_weaver.npy"
+        self.addCleanup(os.remove, fn)
+        weaver = MeanWeaver(output_file=fn)
+        for t in tiles:
+            weaver.addTile(t)
+        outd_file = weaver.getFullImage()
+        numpy.testing.assert_array_equal(outd_file, outd)
+        self.assertEqual(outd_file.metadata[model.MD_POS], outd.metadata[model.MD_POS])
+        numpy.testing.assert_array_equal(numpy.load(fn), outd)
+
 
 class TestCollageWeaverReverse(WeaverBaseTest, unittest.TestCase):
 
@@ -31,6 +31,7 @@ from odemis.model import (MD_POS, MD_PIXEL_SIZE, MD_ROTATION, MD_ACQ_DATE,
                           MD_POL_EY, MD_POL_EZ, MD_POL_DOP, MD_POL_DOLP, MD_POL_DOCP, MD_POL_UP, MD_POL_DS1N,
                           MD_POL_DS2N, MD_POL_DS3N, MD_POL_S1N, MD_POL_S2N, MD_POL_S3N, TINT_FIT_TO_RGB, TINT_RGB_AS_IS)
 from odemis.util import img
+from odemis.util.cache import LRUCache
 import threading
 import time
 import weakref
@@ -85,6 +86,80 @@ POL_POSITIONS_2_DISPLAY = {MD_POL_HORIZONTAL: "Horizontal",
                            }
 POL_MOVE_TIME = 6  # [s] extra time to move polarimetry hardware (value is very approximate)
 
+# Cache of the RGB projections of the static data. It's shared between all the
+# streams and projections, as several of them often display the same data.
+PROJECTION_CACHE_SIZE = 256 * 2 ** 20  # bytes
+_projection_cache = LRUCache(PROJECTION_CACHE_SIZE)
+_projection_cache_owners = {}  # id of the array owning the data -> weakref to it
+
+
+def _forgetProjectionOwner(owner_id):
+    """
+    Drop all the projections of an array which is gone
+    owner_id (int): the id of the array owning the data
+    """
+    _projection_cache_owners.pop(owner_id, None)
+    _projection_cache.purge(lambda k: k[0] == owner_id)
+
+# Cache of the tiles of the pyramidal data, raw and projected. It's shared
+# between all the streams and projections, so that a tile which is shown again
+# doesn't need to be read or projected again.
+TILE_CACHE_SIZE = 512 * 2 ** 20  # bytes
+_tile_cache = LRUCache(TILE_CACHE_SIZE)
+_tile_cache_owners = weakref.WeakSet()  # DataArrayShadows with tiles in the cache
+
+
+def _getCachedTile(das, key, ref=None):
+    """
+    Look for a tile in the tile cache
+    das (DataArrayShadow): the data (ie, the image of a file) the tile belongs to
+    key (tuple): identifies the tile within the data. For a raw tile, it's
+      ("raw", x, y, zoom), and for a projected tile the projection settings
+      are appended.
+    ref (None or object): an object which is only identified by its id in the
+      key (eg, a Colormap), and so must be the same as when the tile was stored.
+    return (None or DataArray): the tile, or None if it's not in the cache
+    """
+    cached = _tile_cache.get((id(das),) + key)
+    # The id could have been reused by a new DataArrayShadow (or ref)
+    if cached is not None and cached[0]() is das:
+        cref = cached[2]
+        if cref is ref or cref == ref:
+            return cached[1]
+    return None
+
+
+def _putCachedTile(das, key, tile, ref=None):
+    """
+    Store a tile in the tile cache
+    das (DataArrayShadow): the data the tile belongs to
+    key (tuple): identifies the tile within the data (cf _getCachedTile())
+    tile (DataArray): the tile to store
+    ref (None or object): kept along the tile, to be checked by _getCachedTile()
+    """
+    das_id = id(das)
+    _tile_cache.put((das_id,) + key, (weakref.ref(das), tile, ref), tile.nbytes)
+    if das not in _tile_cache_owners:
+        _tile_cache_owners.add(das)
+        # Drop all its tiles as soon as the data is gone
+        weakref.finalize(das, _tile_cache.purge, lambda k: k[0] == das_id)
+
+
+def _getRawTile(das, x, y, z):
+    """
+    Get a tile of a pyramidal data, from the tile cache if it was already read
+    das (DataArrayShadow): the data
+    x, y (0<=int): position of the tile
+    z (0<=int): zoom level
+    return (DataArray): the raw tile
+    """
+    key = ("raw", x, y, z)
+    tile = _getCachedTile(das, key)
+    if tile is None:
+        tile = das.getTile(x, y, z)
+        _putCachedTile(das, key, tile)
+    return tile
+
 
 class Stream(object):
     """ A stream combines a Detector, its associated Dataflow and an Emitter.
@@ -105,6 +180,10 @@ class Stream(object):
     # Minimum overhead time in seconds when acquiring an image
     SETUP_OVERHEAD = 0.1
 
+    # If True, the RGB projections of the raw data are cached, to be reused
+    # when the same data is projected again with the same settings.
+    CACHE_PROJECTIONS = False
+
     def __init__(self, name, detector, dataflow, emitter, focuser=None, opm=None,
                  hwdetvas=None, hwemtvas=None, detvas=None, emtvas=None, axis_map={},
                  raw=None, acq_type=None):
@@ -158,11 +237,6 @@ class Stream(object):
         else:
             self.raw = raw
 
-        # initialize the projected tiles cache
-        self._projectedTilesCache = {}
-        # initialize the raw tiles cache
-        self._rawTilesCache = {}
-
         # TODO: should better be based on a BufferedDataFlow: subscribing starts
         # acquisition and sends (raw) data to whoever is interested. .get()
         # returns the previous or next image acquired.
@@ -862,8 +936,7 @@ class Stream(object):
                     if (drange[1] - drange[0] > 4095 and
                             (prev_drange is None or
                              prev_drange[1] - prev_drange[0] < drange[1] - drange[0])):
-                        mn = int(data.view(numpy.ndarray).min())
-                        mx = int(data.view(numpy.ndarray).max())
+                        mn, mx = img.minmax(data)
 
                         # Try to find a range that contain the whole data, and also if the detector generate
                         # new data mostly still fit. We also don't want a too big range.
@@ -922,9 +995,7 @@ class Stream(object):
 
                         drange = (mn, mx)
                 else:  # float
-                    # cast to ndarray to ensure a scalar (instead of a DataArray)
-                    drange = (data.view(numpy.ndarray).min(),
-                              data.view(numpy.ndarray).max())
+                    drange = img.minmax(data)
                     if prev_drange:
                         drange = (min(drange[0], prev_drange[0]),
                                   max(drange[1], prev_drange[1]))
@@ -1028,8 +1099,7 @@ class Stream(object):
         return (DataArray): 3D DataArray
         """
         irange = self._getDisplayIRange()
-        rgbim = img.DataArray2RGB(data, irange, tint)
-        rgbim.flags.writeable = False
+        rgbim = self._convertToRGB(data, irange, tint)
         # Commented to prevent log flooding
         # if model.MD_ACQ_DATE in data.metadata:
         #     logging.debug("Computed RGB projection %g s after acquisition",
@@ -1038,6 +1108,48 @@ class Stream(object):
         md[model.MD_DIMS] = "YXC" # RGB format
         return model.DataArray(rgbim, md)
 
+    def _convertToRGB(self, data, irange, tint):
+        """
+        Convert a greyscale image to RGB. If CACHE_PROJECTIONS is True, the
+        result is cached, and reused the next time the same data is converted
+        with the same settings.
+        data (DataArray): 2D DataArray
+        irange (2 numbers): min/max values mapped to black/white
+        tint ((int, int, int) or Colormap): colouration of the image
+        return (numpy.ndarray): 3D array (YXC) of uint8, read-only
+        """
+        if not self.CACHE_PROJECTIONS:
+            rgbim = img.DataArray2RGB(data, irange, tint)
+            rgbim.flags.writeable = False
+            return rgbim
+
+        # The data is identified by its memory, and the array owning it. This
+        # way, views on the same raw data (eg, a Z slice) are also recognised.
+        owner = data
+        while isinstance(owner.base, numpy.ndarray):
+            owner = owner.base
+        tint_key = tuple(tint) if isinstance(tint, (tuple, list)) else id(tint)
+        owner_id = id(owner)
+        key = (owner_id, data.__array_interface__["data"][0], data.shape, data.strides,
+               data.dtype.str, tuple(irange), tint_key)
+
+        cached = _projection_cache.get(key)
+        if cached is not None:
+            cowner, ctint, rgbim = cached
+            # The memory could have been reused by a new array
+            if cowner() is owner and (ctint is tint or ctint == tint):
+                return rgbim
+
+        rgbim = img.DataArray2RGB(data, irange, tint)
+        rgbim.flags.writeable = False
+        _projection_cache.put(key, (weakref.ref(owner), tint, rgbim), rgbim.nbytes)
+        wowner = _projection_cache_owners.get(owner_id)
+        if wowner is None or wowner() is not owner:
+            _projection_cache_owners[owner_id] = weakref.ref(owner)
+            # Drop all its projections as soon as the data is gone
+            weakref.finalize(owner, _forgetProjectionOwner, owner_id)
+        return rgbim
+
     def _shouldUpdateImage(self):
         """
         Ensures that the image VA will be updated in the "near future".
@@ -1103,7 +1215,7 @@ class Stream(object):
         for x in range(num_tiles_x):
             tiles_column = []
             for y in range(num_tiles_y):
-                tile = das.getTile(x, y, z)
+                tile = _getRawTile(das, x, y, z)
                 tiles_column.append(tile)
             tiles.append(tiles_column)
 
@@ -1211,6 +1323,37 @@ class Stream(object):
     def _onIntensityRange(self, irange):
         self._shouldUpdateImage()
 
+    def _computeHistogram(self, data, step=1, compact=False):
+        """
+        Update the data range, and compute the histogram of the given data.
+        data (DataArray): the raw data
+        step (1<=int): only one pixel every step, along X and Y, is counted
+        compact (bool): if True, only the histogram to be displayed is computed
+        return hist, chist, edges:
+          hist (ndarray): the histogram used to find the best intensity range.
+            If compact is True, it's the same as chist.
+          chist (ndarray): the histogram with at most 256 bins, to be displayed
+          edges (tuple of 2 numbers): the values of the first and last bins
+        """
+        # Depth can change at each image (depends on hardware settings)
+        if step > 1:
+            self._updateDRange(data[..., ::step, ::step])
+        else:
+            self._updateDRange(data)
+
+        # Initially, _drange might be None, in which case it will be guessed
+        if compact:
+            chist, edges = img.histogram(data, irange=self._drange, length=256, step=step)
+            hist = chist
+        else:
+            hist, edges = img.histogram(data, irange=self._drange, step=step)
+            if hist.size > 256:
+                chist = img.compactHistogram(hist, 256)
+            else:
+                chist = hist
+
+        return hist, chist, edges
+
     def _updateHistogram(self, data=None):
         """
         data (DataArray): the raw data to use, default to .raw[0] - background
@@ -1236,15 +1379,7 @@ class Stream(object):
                 except Exception as ex:
                     logging.info("Failed to subtract background when computing histogram: %s", ex)
 
-        # Depth can change at each image (depends on hardware settings)
-        self._updateDRange(data)
-
-        # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
-        if hist.size > 256:
-            chist = img.compactHistogram(hist, 256)
-        else:
-            chist = hist
+        hist, chist, edges = self._computeHistogram(data)
         self.histogram._full_hist = hist
         self.histogram._edges = edges
         # First update the value, before the intensityRange subscribers are called...
@@ -229,15 +229,7 @@ class RepetitionStream(LiveStream):
                 return
             data = self.raw[0]
 
-        # Depth can change at each image (depends on hardware settings)
-        self._updateDRange(data)
-
-        # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
-        if hist.size > 256:
-            chist = img.compactHistogram(hist, 256)
-        else:
-            chist = hist
+        hist, chist, edges = self._computeHistogram(data)
         self.histogram._full_hist = hist
         self.histogram._edges = edges
         # First update the value, before the intensityRange subscribers are called...
@@ -22,6 +22,7 @@ from concurrent import futures
 from concurrent.futures.thread import ThreadPoolExecutor
 import gc
 import logging
+import math
 import numpy
 from odemis import model, util
 from odemis.acq.align import FindEbeamCenter
@@ -36,6 +37,9 @@ import weakref
 
 from ._base import Stream
 
+# Minimum number of pixels used to compute the histogram, when subsampling
+HISTOGRAM_MIN_PIXELS = 256 * 256
+
 
 class LiveStream(Stream):
     """
@@ -62,6 +66,11 @@ class LiveStream(Stream):
                                          range=((0, 0, 0, 0), (1, 1, 1, 1)),
                                          cls=(int, float))
 
+        # While playing, the histogram is computed on only one pixel every
+        # histogram_subsample, along X and Y. When paused, it's computed on
+        # every pixel. 1 means the whole image is always used.
+        self.histogram_subsample = model.IntContinuous(4, range=(1, 64))
+
         self._ht_needs_recompute = threading.Event()
         self._hthread = threading.Thread(target=self._histogram_thread,
                                          args=(weakref.ref(self),),
@@ -99,6 +108,8 @@ class LiveStream(Stream):
             msg = "Unsubscribing from dataflow of component %s"
             logging.debug(msg, self._detector.name)
             self._dataflow.unsubscribe(self._onNewData)
+            # The histogram was approximated, now there is time to get it exact
+            self._shouldUpdateHistogram()
 
     def getSingleFrame(self):
         """
@@ -170,6 +181,22 @@ class LiveStream(Stream):
         # synchronization allows to delay it (without accumulation).
         self._ht_needs_recompute.set()
 
+    def _computeHistogram(self, data, step=1, compact=False):
+        if self.is_active.value and data.ndim >= 2:
+            # Subsample, but keep enough pixels for the histogram to be representative
+            npixels = data.shape[-1] * data.shape[-2]
+            max_step = max(1, int(math.sqrt(npixels / HISTOGRAM_MIN_PIXELS)))
+            step = max(step, min(self.histogram_subsample.value, max_step))
+        # The full histogram is only needed to find the best intensity range
+        compact = compact or not self.auto_bc.value
+        return super(LiveStream, self)._computeHistogram(data, step, compact)
+
+    def _onAutoBC(self, enabled):
+        super(LiveStream, self)._onAutoBC(enabled)
+        if enabled:
+            # The histogram might have been only the compact one => get the full one
+            self._shouldUpdateHistogram()
+
     @staticmethod
     def _histogram_thread(wstream):
         """
@@ -20,6 +20,7 @@ You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError
 import threading
 import weakref
 import logging
@@ -27,6 +28,7 @@ import time
 import math
 import gc
 import numpy
+import os
 
 from odemis.acq.stream import POL_POSITIONS
 from odemis.model import TINT_FIT_TO_RGB
@@ -41,9 +43,32 @@ from odemis.util import img, angleres
 from scipy import ndimage
 from odemis.model import MD_PIXEL_SIZE, MD_POL_EPHI, MD_POL_EX, MD_POL_EY, MD_POL_EZ, MD_POL_ETHETA, MD_POL_DS0, \
     MD_POL_S0, MD_POL_DOP, MD_POL_DOLP, MD_POL_UP
+from odemis.acq.stream._base import _getCachedTile, _getRawTile, _putCachedTile
 from odemis.acq.stream._static import StaticSpectrumStream
 from abc import abstractmethod
 
+# Maximum number of tiles (around the visible area) loaded in advance
+MAX_PREFETCH_TILES = 64
+
+# Pool of threads shared by all the projections to load and project the tiles.
+# Created only when needed.
+_tile_executor = None
+_tile_executor_lock = threading.Lock()
+
+
+def _getTileExecutor():
+    """
+    return (ThreadPoolExecutor): the executor to load the tiles
+    """
+    global _tile_executor
+    with _tile_executor_lock:
+        if _tile_executor is None:
+            # Reading the tiles is partly limited by the disk access, so use at
+            # least 2 threads, even with a single CPU
+            nworkers = max(2, os.cpu_count() or 1)
+            _tile_executor = ThreadPoolExecutor(max_workers=nworkers, thread_name_prefix="TileLoader")
+        return _tile_executor
+
 
 class DataProjection(object):
 
@@ -191,8 +216,7 @@ class RGBProjection(DataProjection):
         """
         # TODO replace by local irange
         irange = self.stream._getDisplayIRange()
-        rgbim = img.DataArray2RGB(data, irange, tint)
-        rgbim.flags.writeable = False
+        rgbim = self.stream._convertToRGB(data, irange, tint)
         # Commented to prevent log flooding
         # if model.MD_ACQ_DATE in data.metadata:
         #     logging.debug("Computed RGB projection %g s after acquisition",
@@ -811,6 +835,9 @@ class RGBSpatialProjection(RGBProjection):
     RGBSpatialProjection might be created (via the use of the __new__ operator).
     That is the recommended way to create a RGBSpatialProjection.
     """
+    # If True, the tiles around the visible area are loaded in advance, in the
+    # direction of the movement of the view
+    PREFETCH_TILES = True
 
     def __new__(cls, stream):
 
@@ -847,12 +874,13 @@ class RGBSpatialProjection(RGBProjection):
             self.rect = model.TupleContinuous(full_rect, rect_range)
             self.mpp.subscribe(self._onMpp)
             self.rect.subscribe(self._onRect)
-            # initialize the projected tiles cache
-            self._projectedTilesCache = {}
-            # initialize the raw tiles cache
-            self._rawTilesCache = {}
-            # When True, the projected tiles cache should be invalidated
+            # When True, the display settings changed, so all the projected
+            # tiles of the current image have to be updated
             self._projectedTilesInvalid = True
+            # (int, (int, int, int, int)) or None: zoom level and tiles of the previous image
+            self._prev_tiles_area = None
+            # (x, y, z) -> (settings key, Future): tiles being loaded in advance
+            self._prefetch_futures = {}
 
         self._shouldUpdateImage()
 
@@ -868,17 +896,18 @@ class RGBSpatialProjection(RGBProjection):
         exp = round(exp)
         return ps0 * 2 ** exp
 
-    def _projectXY2RGB(self, data, tint=(255, 255, 255)):
+    def _projectXY2RGB(self, data, tint=(255, 255, 255), irange=None):
         """
         Project a 2D spatial DataArray into a RGB representation
         data (DataArray): 2D DataArray
         tint ((int, int, int)): colouration of the image, in RGB.
+        irange (None or (number, number)): the intensity range to map to the
+          RGB values. If None, the current display range of the stream is used.
         return (DataArray): 3D DataArray
         """
-        # TODO replace by local irange
-        irange = self.stream._getDisplayIRange()
-        rgbim = img.DataArray2RGB(data, irange, tint)
-        rgbim.flags.writeable = False
+        if irange is None:
+            irange = self.stream._getDisplayIRange()
+        rgbim = self.stream._convertToRGB(data, irange, tint)
         # Commented to prevent log flooding
         # if model.MD_ACQ_DATE in data.metadata:
         #     logging.debug("Computed RGB projection %g s after acquisition",
@@ -916,7 +945,7 @@ class RGBSpatialProjection(RGBProjection):
         if isinstance(raw[0], model.DataArrayShadow):
             tx, px = divmod(pixel_pos[0], raw[0].tile_shape[0])
             ty, py = divmod(pixel_pos[1], raw[0].tile_shape[1])
-            raw_tile = raw[0].getTile(tx, ty, 0)
+            raw_tile = _getRawTile(raw[0], tx, ty, 0)
             return raw_tile[py, px]
         else:
             return raw[0][pixel_pos[1], pixel_pos[0]]
@@ -978,55 +1007,63 @@ class RGBSpatialProjection(RGBProjection):
             int(round(rect[1] / (-ps[1]) + img_shape[1] / 2)) - 1,
         )
 
-    def _getTile(self, x, y, z, prev_raw_cache, prev_proj_cache):
+    def _getTileSettings(self):
+        """
+        Read the current display settings, which the projected tiles depend on
+        return (tuple, tuple): the settings (intensity range, tint, z index),
+          and a (hashable) key representing them
+        """
+        tint = self.stream.tint.value
+        tint_key = tuple(tint) if isinstance(tint, (tuple, list)) else id(tint)
+        irange = tuple(self.stream._getDisplayIRange())
+        zidx = self.stream.zIndex.value if model.hasVA(self.stream, "zIndex") else None
+        return (irange, tint, zidx), (irange, tint_key, zidx)
+
+    def _getTile(self, x, y, z, settings=None):
         """
-        Get a tile from a DataArrayShadow. Uses cache.
-        The cache for projected tiles and the cache for raw tiles has always the same tiles
+        Get a tile from a DataArrayShadow, and its projection. The tiles are
+        looked for first in the tile cache, which is shared with all the
+        projections of the same data.
         x (int): X coordinate of the tile
         y (int): Y coordinate of the tile
         z (int): zoom level where the tile is
-        prev_raw_cache (dictionary): raw tiles cache from the
-            last execution of _updateImage
-        prev_proj_cache (dictionary): projected tiles cache from the
-            last execution of _updateImage
+        settings (None or (tuple, tuple)): the display settings, as returned by
+          _getTileSettings(). If None, the current settings are used.
         return (DataArray, DataArray): raw tile and projected tile
         """
-        # the key of the tile on the cache
-        tile_key = "%d-%d-%d" % (x, y, z)
-
-        # if the raw tile has been already cached, read it from the cache
-        if tile_key in prev_raw_cache:
-            raw_tile = prev_raw_cache[tile_key]
-        elif tile_key in self._rawTilesCache:
-            raw_tile = self._rawTilesCache[tile_key]
-        else:
-            # The tile was not cached, so it must be read from the file
-            raw_tile = self.stream.raw[0].getTile(x, y, z)
-
-        # if the projected tile has been already cached, read it from the cache
-        if tile_key in prev_proj_cache:
-            proj_tile = prev_proj_cache[tile_key]
-        elif tile_key in self._projectedTilesCache:
-            proj_tile = self._projectedTilesCache[tile_key]
-        else:
-            # The tile was not cached, so it must be projected again
-            proj_tile = self._projectTile(raw_tile)
+        das = self.stream.raw[0]
+        raw_tile = _getRawTile(das, x, y, z)
+
+        # The projected tile depends on the display settings
+        if settings is None:
+            settings = self._getTileSettings()
+        (irange, tint, zidx), settings_key = settings
+        key = ("proj", x, y, z) + settings_key
+        # For a Colormap, the key only contains its id => also check it's the same
+        proj_tile = _getCachedTile(das, key, tint)
+        if proj_tile is None:
+            proj_tile = self._projectTile(raw_tile, irange, tint, zidx)
+            _putCachedTile(das, key, proj_tile, tint)
 
-        # cache raw and projected tiles
-        self._rawTilesCache[tile_key] = raw_tile
-        self._projectedTilesCache[tile_key] = proj_tile
         return raw_tile, proj_tile
 
-    def _projectTile(self, tile):
+    def _projectTile(self, tile, irange=None, tint=None, zidx=None):
         """
         Project the tile
         tile (DataArray): Raw tile
+        irange (None or (number, number)): the intensity range to use. If None,
+          the current display range of the stream is used.
+        tint (None or tint): the tint to use. If None, the current tint of the
+          stream is used.
+        zidx (None or int): the index in Z to use, for ZYX data. If None, the
+          current zIndex of the stream is used.
         return (DataArray): Projected tile
         """
         dims = tile.metadata.get(model.MD_DIMS, "CTZYX"[-tile.ndim::])
         ci = dims.find("C")  # -1 if not found
         # handle the tint
-        tint = self.stream.tint.value
+        if tint is None:
+            tint = self.stream.tint.value
 
         if dims in ("CYX", "YXC") and tile.shape[ci] in (3, 4):  # is RGB?
             # Take the RGB data as-is, just needs to make sure it's in the right order
@@ -1045,84 +1082,177 @@ class RGBSpatialProjection(RGBProjection):
             tile.metadata[model.MD_DIMS] = "YXC"  # RGB format
             return tile
         elif dims in ("ZYX",) and model.hasVA(self.stream, "zIndex"):
-            tile = img.getYXFromZYX(tile, self.stream.zIndex.value)
+            if zidx is None:
+                zidx = self.stream.zIndex.value
+            tile = img.getYXFromZYX(tile, zidx)
             tile.metadata[model.MD_DIMS] = "ZYX"
         else:
             tile = img.ensure2DImage(tile)
 
-        return self._projectXY2RGB(tile, tint)
+        return self._projectXY2RGB(tile, tint, irange)
+
+    def _getTilesArea(self, z):
+        """
+        Get the tiles inside the region defined by .rect
+        z (int): zoom level
+        return (int, int, int, int): X/Y indices of the top-left and bottom-right tiles
+        """
+        das = self.stream.raw[0]
+        rect = self._rectWorldToPixel(self.rect.value)
+        # convert the rect coords to tile indexes
+        rect = [l / (2 ** z) for l in rect]
+        return tuple(int(math.floor(l / das.tile_shape[0])) for l in rect)
 
     def _getTilesFromSelectedArea(self):
         """
         Get the tiles inside the region defined by .rect and .mpp
+        The tiles are loaded and projected in parallel.
         return (DataArray, DataArray): Raw tiles and projected tiles
         """
+        executor = _getTileExecutor()
 
-        # This custom exception is used when the .mpp or .rect values changes while
-        # generating the tiles. If the values changes, everything needs to be recomputed
-        class NeedRecomputeException(Exception):
-            pass
-
-        das = self.stream.raw[0]
-
-        # store the previous cache to use in this execution
-        prev_raw_cache = self._rawTilesCache
-        prev_proj_cache = self._projectedTilesCache
-        # Execute at least once. If mpp and rect changed in
-        # the last execution of the loops, execute again
-        need_recompute = True
-        while need_recompute:
+        # Execute at least once. If mpp, rect or the display settings changed
+        # while the tiles are loaded, execute again
+        while True:
             z = self._zFromMpp()
-            rect = self._rectWorldToPixel(self.rect.value)
-            # convert the rect coords to tile indexes
-            rect = [l / (2 ** z) for l in rect]
-            rect = [int(math.floor(l / das.tile_shape[0])) for l in rect]
-            x1, y1, x2, y2 = rect
-            # the 4 lines below avoids that lots of old tiles
-            # stays in instance caches
-            prev_raw_cache.update(self._rawTilesCache)
-            prev_proj_cache.update(self._projectedTilesCache)
-            # empty current caches
-            self._rawTilesCache = {}
-            self._projectedTilesCache = {}
-
-            raw_tiles = []
-            projected_tiles = []
-            need_recompute = False
+            x1, y1, x2, y2 = self._getTilesArea(z)
+            # The display settings can change from now on => start again,
+            # so that all the tiles use the new settings
+            self._projectedTilesInvalid = False
+            settings = self._getTileSettings()
+
+            # Reuse the tiles already being loaded in advance, and cancel the others
+            prefetched = self._prefetch_futures
+            self._prefetch_futures = {}
+            futures = {}
+            for x in range(x1, x2 + 1):
+                for y in range(y1, y2 + 1):
+                    sk, f = prefetched.pop((x, y, z), (None, None))
+                    if sk != settings[1] or (f.done() and f.exception() is not None):
+                        if f is not None:
+                            f.cancel()
+                        f = executor.submit(self._getTile, x, y, z, settings)
+                    futures[(x, y)] = f
+            for _, f in prefetched.values():
+                f.cancel()
+
             try:
-                for x in range(x1, x2 + 1):
-                    rt_column = []
-                    pt_column = []
-
-                    for y in range(y1, y2 + 1):
-                        # the projected tiles cache is invalid
-                        if self._projectedTilesInvalid:
-                            self._projectedTilesCache = {}
-                            prev_proj_cache = {}
-                            self._projectedTilesInvalid = False
-                            raise NeedRecomputeException()
-
-                        # check if the image changed in the middle of the process
-                        if self._im_needs_recompute.is_set():
-                            self._im_needs_recompute.clear()
-                            # Raise the exception, so everything will be calculated again,
-                            # but using the cache from the last execution
-                            raise NeedRecomputeException()
-
-                        raw_tile, proj_tile = \
-                            self._getTile(x, y, z, prev_raw_cache, prev_proj_cache)
-                        rt_column.append(raw_tile)
-                        pt_column.append(proj_tile)
-
-                    raw_tiles.append(tuple(rt_column))
-                    projected_tiles.append(tuple(pt_column))
-
-            except NeedRecomputeException:
-                # image changed
-                need_recompute = True
+                raw_tiles, projected_tiles = self._waitTiles(futures, (x1, y1, x2, y2))
+            except CancelledError:
+                # The area or the settings changed => everything will be calculated
+                # again, but the tiles already computed are in the cache
+                for f in futures.values():
+                    f.cancel()
+                continue
+
+            if self.PREFETCH_TILES:
+                self._prefetchTiles(z, (x1, y1, x2, y2), settings)
+            return raw_tiles, projected_tiles
+
+    def _waitTiles(self, futures, area):
+        """
+        Wait for all the tiles of the area to be loaded
+        futures (dict (int, int) -> Future): future of each tile
+        area (int, int, int, int): X/Y indices of the top-left and bottom-right tiles
+        return (DataArray, DataArray): Raw tiles and projected tiles
+        raise CancelledError: if the image has to be recomputed before all the
+          tiles are loaded.
+        """
+        x1, y1, x2, y2 = area
+        raw_tiles = []
+        projected_tiles = []
+        for x in range(x1, x2 + 1):
+            rt_column = []
+            pt_column = []
+            for y in range(y1, y2 + 1):
+                f = futures[(x, y)]
+                while True:
+                    # check if the image changed in the middle of the process
+                    if self._projectedTilesInvalid or self._im_needs_recompute.is_set():
+                        self._im_needs_recompute.clear()
+                        raise CancelledError()
+                    try:
+                        raw_tile, proj_tile = f.result(timeout=0.05)
+                        break
+                    except TimeoutError:
+                        pass
+                rt_column.append(raw_tile)
+                pt_column.append(proj_tile)
+
+            raw_tiles.append(tuple(rt_column))
+            projected_tiles.append(tuple(pt_column))
 
         return tuple(raw_tiles), tuple(projected_tiles)
 
+    def _getTilesCount(self, z):
+        """
+        z (int): zoom level
+        return (int, int): number of tiles along X and Y at the given zoom level
+        """
+        das = self.stream.raw[0]
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        shape = (das.shape[dims.index("X")], das.shape[dims.index("Y")])
+        return tuple(int(math.ceil((s // 2 ** z) / ts)) for s, ts in zip(shape, das.tile_shape))
+
+    def _prefetchTiles(self, z, area, settings):
+        """
+        Start loading (in the background) the tiles which are likely to be
+        displayed next: the ones around the current area, starting by the
+        direction of the movement, and the ones of the next zoom level, if the
+        view is zooming.
+        z (int): zoom level of the current area
+        area (int, int, int, int): X/Y indices of the top-left and bottom-right
+          tiles currently displayed
+        settings (tuple, tuple): the display settings, as returned by _getTileSettings()
+        """
+        prev = self._prev_tiles_area
+        self._prev_tiles_area = (z, area)
+        x1, y1, x2, y2 = area
+
+        tiles = []
+        if prev is not None and prev[0] == z:
+            # Panning (or not moving): the tiles on the border, in the
+            # direction of the movement first
+            px1, py1, px2, py2 = prev[1]
+            dx = (x1 + x2) - (px1 + px2)
+            dy = (y1 + y2) - (py1 + py2)
+            cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+            border = [(x, y, z) for x in range(x1 - 1, x2 + 2) for y in range(y1 - 1, y2 + 2)
+                      if not (x1 <= x <= x2 and y1 <= y <= y2)]
+            border.sort(key=lambda t: -(dx * (t[0] - cx) + dy * (t[1] - cy)))
+            tiles.extend(border)
+        elif prev is not None and prev[0] > z and z > 0:
+            # Zooming in: the tiles of the next zoom level, in the same area
+            tiles.extend((x, y, z - 1) for x in range(x1 * 2, x2 * 2 + 2)
+                                       for y in range(y1 * 2, y2 * 2 + 2))
+        elif prev is not None and prev[0] < z < self.stream.raw[0].maxzoom:
+            # Zooming out: the tiles of the previous zoom level, around the area
+            tiles.extend((x, y, z + 1) for x in range((x1 - 1) // 2, (x2 + 1) // 2 + 1)
+                                       for y in range((y1 - 1) // 2, (y2 + 1) // 2 + 1))
+
+        executor = _getTileExecutor()
+        counts = {}
+        for x, y, tz in tiles[:MAX_PREFETCH_TILES]:
+            if tz not in counts:
+                counts[tz] = self._getTilesCount(tz)
+            nx, ny = counts[tz]
+            if not (0 <= x < nx and 0 <= y < ny):
+                continue
+            f = executor.submit(self._prefetchTile, x, y, tz, settings)
+            self._prefetch_futures[(x, y, tz)] = (settings[1], f)
+
+    def _prefetchTile(self, x, y, z, settings):
+        """
+        Load a tile in the cache. Errors are only logged, as the tile might
+        not be needed anyway.
+        return (DataArray, DataArray): raw tile and projected tile
+        """
+        try:
+            return self._getTile(x, y, z, settings)
+        except Exception:
+            logging.debug("Failed to prefetch tile %d, %d at zoom %d", x, y, z, exc_info=True)
+            raise
+
     def _updateImage(self):
         """ Recomputes the image with all the raw data available
         """
@@ -1188,24 +1318,20 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
 
     def projectAsRaw(self):
         try:
-            data = self.stream.calibrated.value
-            raw_md = self.stream.calibrated.value.metadata
+            calibrated = self.stream.calibrated.value
+            raw_md = calibrated.metadata
             md = {k: raw_md[k] for k in (model.MD_PIXEL_SIZE, model.MD_POS, model.MD_THETA_LIST) if k in raw_md}
 
             # Average time or theta values if they exist (iow, flatten axis 1).
-            if data.shape[1] > 1:
-                data = numpy.mean(data, axis=1)
-                data = data[:, 0, :, :]
-            else:
-                data = data[:, 0, 0, :, :]
+            data = self.stream._getSpectrumCube(calibrated)
 
             # pick only the data inside the bandwidth
             spec_range = self.stream._get_bandwidth_in_pixel()
 
             logging.debug("Spectrum range picked: %s px", spec_range)
 
-            av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
-            av_data = img.ensure2DImage(av_data).astype(data.dtype)
+            av_data = self.stream._getBandImage(spec_range[0], spec_range[1], calibrated)
+            av_data = av_data.astype(data.dtype)
             return model.DataArray(av_data, md)
 
         except Exception:
@@ -1265,15 +1391,8 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
         """
 
         try:
-            data = self.stream.calibrated.value
-            raw_md = self.stream.calibrated.value.metadata
-
-            # Average time or theta values if they exist (iow, flatten axis 1).
-            if data.shape[1] > 1:
-                data = numpy.mean(data, axis=1)
-                data = data[:, 0, :, :]
-            else:
-                data = data[:, 0, 0, :, :]
+            calibrated = self.stream.calibrated.value
+            raw_md = calibrated.metadata
 
             # pick only the data inside the bandwidth
             spec_range = self.stream._get_bandwidth_in_pixel()
@@ -1282,10 +1401,11 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
 
             irange = self.stream._getDisplayIRange()  # will update histogram if not yet present
 
+            # The averages over the bands (and time or theta) are cached by the stream,
+            # so that changing the tint, or coming back to a previous band is fast.
             if self.stream.tint.value != TINT_FIT_TO_RGB:
                 # TODO: use better intermediary type if possible?, cf semcomedi
-                av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = self.stream._getBandImage(spec_range[0], spec_range[1], calibrated)
                 rgbim = img.DataArray2RGB(av_data, irange, self.stream.tint.value)
 
             else:
@@ -1306,15 +1426,12 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
                 rrange[1] = max(rrange)
 
                 # FIXME: unoptimized, as each channel is duplicated 3 times, and discarded
-                av_data = numpy.mean(data[rrange[0]:rrange[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = self.stream._getBandImage(rrange[0], rrange[1], calibrated)
                 rgbim = img.DataArray2RGB(av_data, irange)
-                av_data = numpy.mean(data[grange[0]:grange[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = self.stream._getBandImage(grange[0], grange[1], calibrated)
                 gim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 1] = gim[:, :, 0]
-                av_data = numpy.mean(data[brange[0]:brange[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = self.stream._getBandImage(brange[0], brange[1], calibrated)
                 bim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 2] = bim[:, :, 0]
 
@@ -1336,6 +1453,8 @@ class LineSpectrumProjection(RGBProjection):
     def __init__(self, stream):
 
         super(LineSpectrumProjection, self).__init__(stream)
+        # (key, scipy.sparse matrix): the interpolation weights of the last line
+        self._line_weights = None
 
         if model.hasVA(self.stream, "selected_time"):
             self.stream.selected_time.subscribe(self._on_selected_time)
@@ -1395,41 +1514,22 @@ class LineSpectrumProjection(RGBProjection):
         if l < 1:  # a line of just one pixel is considered not valid
             return None
 
-        # FIXME: if the data has a width of 1 (ie, just a line), and the
-        # requested width is an even number, the output is empty (because all
-        # the interpolated points are outside of the data.
-
-        # Coordinates of each point: ndim of data (5-2), pos on line (Y), spectrum (X)
-        # The line is scanned from the end till the start so that the spectra
-        # closest to the origin of the line are at the bottom.
-        coord = numpy.empty((3, width, n, spec2d.shape[0]))
-        coord[0] = numpy.arange(spec2d.shape[0])  # spectra = all
-        coord_spc = coord.swapaxes(2, 3)  # just a view to have (line) space as last dim
-        coord_spc[-1] = numpy.linspace(start[0], end[0], n)  # X axis
-        coord_spc[-2] = numpy.linspace(start[1], end[1], n)  # Y axis
-
-        # Spread over the width
-        # perpendicular unit vector
-        pv = (-v[1] / l, v[0] / l)
-        width_coord = numpy.empty((2, width))
-        spread = (width - 1) / 2
-        width_coord[-1] = numpy.linspace(pv[0] * -spread, pv[0] * spread, width)  # X axis
-        width_coord[-2] = numpy.linspace(pv[1] * -spread, pv[1] * spread, width)  # Y axis
-
-        coord_cw = coord[1:].swapaxes(0, 2).swapaxes(1, 3)  # view with coordinates and width as last dims
-        coord_cw += width_coord
-
-        # Interpolate the values based on the data
+        # The weights only depend on the line, so they are reused when only the
+        # time/angle changes.
+        key = (spec2d.shape[1:], tuple(start), tuple(end), n, width)
+        if self._line_weights is None or self._line_weights[0] != key:
+            self._line_weights = key, img.getLineProfileWeights(spec2d.shape[1:], start, end, n, width)
+        pixels, weights = self._line_weights[1]
+
+        # Interpolate all the wavelengths at once, as a (sparse) matrix
+        # multiplication: (n, K) x (K, C) -> (n, C), with K the pixels used
+        spec_px = numpy.ascontiguousarray(spec2d.reshape(spec2d.shape[0], -1)[:, pixels].T)
+        spec1d = numpy.asarray(weights @ spec_px)
         if width == 1:
-            # simple version for the most usual case
-            spec1d = ndimage.map_coordinates(spec2d, coord[:, 0, :, :], order=1)
-        else:
-            # FIXME: the mean should be dependent on how many pixels inside the
-            # original data were pick on each line. Currently if some pixels fall
-            # out of the original data, the outside pixels count as 0.
-            # force the intermediate values to float, as mean() still needs to run
-            spec1d_w = ndimage.map_coordinates(spec2d, coord, output=float, order=1)
-            spec1d = spec1d_w.mean(axis=0)
+            # Keep the same type as the data, for the most usual case
+            if spec2d.dtype.kind in "biu":
+                spec1d = numpy.rint(spec1d)
+            spec1d = spec1d.astype(spec2d.dtype)
         assert spec1d.shape == (n, spec2d.shape[0])
 
         # Use metadata to indicate spatial distance between pixel
@@ -1702,9 +1802,8 @@ class MeanSpectrumProjection(DataProjection):
         md = dict(data.metadata)
         md[model.MD_DIMS] = "C"
 
-        # flatten all but the C dimension, for the average
-        data = data.reshape((data.shape[0], numpy.prod(data.shape[1:])))
-        av_data = numpy.mean(data, axis=1)
+        # average over all but the C dimension (cached by the stream)
+        av_data = self.stream._getMeanSpectrum(data)
 
         self.image.value = model.DataArray(av_data, md)
 
@@ -33,6 +33,7 @@ import weakref
 from collections.abc import Iterable
 
 import numpy
+import psutil
 try:
     import arpolarimetry
 except ImportError:
@@ -42,8 +43,23 @@ from odemis import model, util
 from odemis.acq import calibration
 from odemis.model import MD_POL_MODE, MD_POL_S0, MD_POS, VigilantAttribute
 from odemis.util import almost_equal, conversion, find_closest, img, spectrum
+from odemis.util.cache import LRUCache
 from ._base import POL_POSITIONS, POL_POSITIONS_RESULTS, Stream
 
+# Maximum memory used by each spectrum stream to keep the reductions of the
+# calibrated data (mean spectrum, images of the spectrum bands...)
+SPECTRUM_REDUCTIONS_CACHE_SIZE = 256 * 2 ** 20  # bytes
+
+# The cumulative sum along the spectrum ("band index"), to compute the average
+# over any band in constant time, is only built for data with at least that many
+# wavelengths. For less, directly averaging the band is fast enough.
+BAND_INDEX_MIN_WAVELENGTHS = 64
+# Maximum ratio of the available memory the band index can use
+BAND_INDEX_MAX_MEMORY_RATIO = 0.25
+# If the available memory drops below that ratio of the total memory, the band
+# index is dropped
+BAND_INDEX_LOW_MEMORY_RATIO = 0.05
+
 
 class StaticStream(Stream):
     """
@@ -51,6 +67,9 @@ class StaticStream(Stream):
     For testing and static images.
     """
 
+    # The data doesn't change, so the same projections are often recomputed
+    CACHE_PROJECTIONS = True
+
     def __init__(self, name, raw, *args, **kwargs):
         """
         Note: parameters are different from the base class.
@@ -699,6 +718,18 @@ class StaticSpectrumStream(StaticStream):
         self.calibrated = model.VigilantAttribute(None)
         # Store the previous parameters used to calibrate the data to skip unnecessary calls
         self._calib_parameters = (None, None)  # numpy arrays or None
+        # (raw data, background, DataArray): the data after background correction,
+        # to only apply the efficiency compensation when just it changes
+        self._bckg_corrected = (None, None, None)
+        # The values derived from the calibrated data, computed on demand, and
+        # dropped whenever the calibrated data changes
+        self._reductions_lock = threading.Lock()
+        self._reductions_src = None  # the calibrated data of the reductions
+        self._reductions = LRUCache(SPECTRUM_REDUCTIONS_CACHE_SIZE)
+        # (DataArray, None or ndarray): the calibrated data, and its band index
+        # (of shape C+1 YX), if it's (already) built.
+        self._band_index = (None, None)
+        self._band_index_thread = None
         # Immediately compute it, without any correction, as it can still be
         # different from image if it's an angular spectrum dataset.
         self._updateCalibratedData(image, bckg=None, coef=self.efficiencyCompensation.value)
@@ -859,7 +890,13 @@ class StaticSpectrumStream(StaticStream):
             self.calibrated.value = None
             return
 
-        calibrated = calibration.apply_spectrum_corrections(data, bckg, coef)
+        # The background correction (and the projection of the angular data) is
+        # typically the longest step, so reuse it if only the coef changed.
+        prev_data, prev_bckg, bckg_corrected = self._bckg_corrected
+        if data is not prev_data or bckg is not prev_bckg:
+            bckg_corrected = calibration.apply_spectrum_background(data, bckg)
+            self._bckg_corrected = (data, bckg, bckg_corrected)
+        calibrated = calibration.apply_spectrum_efficiency(bckg_corrected, coef)
 
         # If angular spectrum, the length of the A dimension might have changed
         if hasattr(self, "selected_angle"):  # update the list of angles
@@ -873,8 +910,147 @@ class StaticSpectrumStream(StaticStream):
             self.selected_angle.value = self.selected_angle.value
 
         self._calib_parameters = (bckg, coef)
+        with self._reductions_lock:
+            self._band_index = (None, None)  # Release the memory early
         self.calibrated.value = calibrated
 
+    def _getReduction(self, key, compute, calibrated=None):
+        """
+        Get a value derived from the calibrated data. It's computed only the
+        first time, and then cached, until the calibrated data changes.
+        key (tuple): identifies the reduction
+        compute (callable DataArray -> ndarray): computes the reduction from
+          the calibrated data
+        calibrated (None or DataArray): the calibrated data. If None, the
+          current .calibrated is used.
+        return (ndarray): the reduction, read-only
+        """
+        if calibrated is None:
+            calibrated = self.calibrated.value
+        with self._reductions_lock:
+            if self._reductions_src is not calibrated:
+                self._reductions.clear()
+                self._reductions_src = calibrated
+            red = self._reductions.get(key)
+
+        if red is None:
+            red = compute(calibrated)
+            red.flags.writeable = False
+            with self._reductions_lock:
+                if self._reductions_src is calibrated:
+                    self._reductions.put(key, red)
+        return red
+
+    def _getMeanSpectrum(self, calibrated=None):
+        """
+        calibrated (None or DataArray): the calibrated data. If None, the
+          current .calibrated is used.
+        return (ndarray of shape C): the spectrum averaged over all the other
+          dimensions of the calibrated data
+        """
+        def mean_spectrum(data):
+            # flatten all but the C dimension, for the average
+            return numpy.mean(data.reshape((data.shape[0], -1)), axis=1)
+        return self._getReduction(("mean_spectrum",), mean_spectrum, calibrated)
+
+    def _getSpectrumCube(self, calibrated=None):
+        """
+        calibrated (None or DataArray): the calibrated data. If None, the
+          current .calibrated is used.
+        return (DataArray of shape CYX): the calibrated data, averaged over
+          the time or angle dimension
+        """
+        if calibrated is None:
+            calibrated = self.calibrated.value
+        if calibrated.shape[1] <= 1:
+            return calibrated[:, 0, 0, :, :]  # Just a view, nothing to cache
+
+        def mean_time(data):
+            return numpy.mean(data, axis=1)[:, 0, :, :]
+        return self._getReduction(("spectrum_cube",), mean_time, calibrated)
+
+    def _getBandImage(self, low_px, high_px, calibrated=None):
+        """
+        Average the calibrated data over a spectrum band (and the time or angle)
+        low_px (int): index of the first wavelength of the band
+        high_px (int): index of the last wavelength of the band (included)
+        calibrated (None or DataArray): the calibrated data. If None, the
+          current .calibrated is used.
+        return (DataArray of shape YX): the average over the band
+        """
+        def mean_band(calibrated):
+            index = self._getBandIndex(calibrated)
+            if index is not None:
+                # The sum is just the difference between two planes
+                n = high_px - low_px + 1
+                return img.ensure2DImage((index[high_px + 1] - index[low_px]) / n)
+            data = self._getSpectrumCube(calibrated)
+            return img.ensure2DImage(numpy.mean(data[low_px:high_px + 1], axis=0))
+        return self._getReduction(("band", low_px, high_px), mean_band, calibrated)
+
+    def _getBandIndex(self, calibrated):
+        """
+        Get the cumulative sum of the spectrum cube along the wavelengths. The
+        first time it's requested, it's built in a separate thread.
+        calibrated (DataArray): the calibrated data
+        return (None or ndarray of shape C+1 YX): the band index, or None if
+          it's not available (yet)
+        """
+        if calibrated.shape[0] < BAND_INDEX_MIN_WAVELENGTHS:
+            return None
+
+        with self._reductions_lock:
+            src, index = self._band_index
+            if src is not calibrated:
+                # Build it in the background, and meanwhile, compute the bands directly
+                self._band_index = (calibrated, None)
+                self._band_index_thread = threading.Thread(target=self._buildBandIndex,
+                                                           args=(calibrated,),
+                                                           name="Band index computation")
+                self._band_index_thread.daemon = True
+                self._band_index_thread.start()
+                return None
+
+            if index is not None:
+                mem = psutil.virtual_memory()
+                if mem.available < mem.total * BAND_INDEX_LOW_MEMORY_RATIO:
+                    logging.info("Dropping band index of %s, as memory is low", self.name.value)
+                    self._band_index = (calibrated, None)
+                    return None
+
+        return index
+
+    def _buildBandIndex(self, calibrated):
+        """
+        Compute the band index, and store it in ._band_index
+        calibrated (DataArray): the calibrated data
+        """
+        try:
+            cube = self._getSpectrumCube(calibrated)
+            # Find the smallest type able to hold the sum of the whole spectrum
+            dtype = numpy.dtype(util.get_best_dtype_for_acc(cube.dtype, cube.shape[0]))
+            if dtype.kind == "f":
+                dtype = numpy.dtype(numpy.float64)  # Float32 would lose too much precision
+            shape = (cube.shape[0] + 1,) + cube.shape[1:]
+            nbytes = numpy.prod(shape) * dtype.itemsize
+            if nbytes > psutil.virtual_memory().available * BAND_INDEX_MAX_MEMORY_RATIO:
+                logging.info("Not building band index of %s, as it'd need %d MB",
+                             self.name.value, nbytes // 2 ** 20)
+                return
+
+            logging.debug("Building band index of %s, of shape %s and type %s",
+                          self.name.value, shape, dtype)
+            index = numpy.empty(shape, dtype=dtype)
+            index[0] = 0
+            numpy.cumsum(cube, axis=0, dtype=dtype, out=index[1:])
+            index.flags.writeable = False
+
+            with self._reductions_lock:
+                if self._band_index[0] is calibrated:
+                    self._band_index = (calibrated, index)
+        except Exception:
+            logging.exception("Failed to build band index")
+
     def _setBackground(self, bckg):
         """
         Setter of the background.
@@ -37,10 +37,11 @@ from odemis.acq import drift
 from odemis.acq import leech
 from odemis.acq.leech import AnchorDriftCorrector
 from odemis.acq.stream._live import LiveStream
+from odemis.dataio import hdf5
 from odemis.util.driver import guessActuatorMoveDuration
 from odemis.model import MD_POS, MD_DESCRIPTION, MD_PIXEL_SIZE, MD_ACQ_DATE, MD_AD_LIST, \
     MD_DWELL_TIME, MD_EXP_TIME, MD_DIMS, MD_THETA_LIST, MD_WL_LIST, MD_ROTATION, \
-    MD_ROTATION_COR
+    MD_ROTATION_COR, MD_POL_MODE
 from odemis.model import hasVA
 from odemis.util import units, executeAsyncTask, almost_equal, img, angleres
 import queue
@@ -168,6 +169,9 @@ class MultipleDetectorStream(Stream, metaclass=ABCMeta):
 
         # currently scanned area location based on px_idx, or None if no scanning
         self._current_scan_area = None  # l,t,r,b (int)
+        # Histogram of the acquired SEM data, updated with each new tile, or
+        # None if it's not possible (ie, the data is not 8 or 16 bits unsigned)
+        self._live_hist = None
 
         # Start threading event for live update overlay
         self._live_update_period = 2
@@ -833,12 +837,24 @@ class MultipleDetectorStream(Stream, metaclass=ABCMeta):
             da = model.DataArray(numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=raw_data.dtype), md)
             self._live_data[n].append(da)
             self._acq_mask = numpy.zeros(shape=rep[::-1] * numpy.array(tile_shape), dtype=bool)
+            if n == 0:
+                # Same histogram as img.histogram() computes on the whole data
+                if raw_data.dtype.kind == "u" and raw_data.itemsize <= 2:
+                    self._live_hist = numpy.zeros(numpy.iinfo(raw_data.dtype).max + 1, dtype=numpy.int64)
+                else:
+                    self._live_hist = None
 
         self._acq_mask[px_idx[0] * tile_shape[0]:(px_idx[0] + 1) * tile_shape[0],
                        px_idx[1] * tile_shape[1]:(px_idx[1] + 1) * tile_shape[1]] = True
         self._live_data[n][pol_idx][
                        px_idx[0] * tile_shape[0]:(px_idx[0] + 1) * tile_shape[0],
                        px_idx[1] * tile_shape[1]:(px_idx[1] + 1) * tile_shape[1]] = raw_data
+        if n == 0 and self._live_hist is not None:
+            # Only count the new pixels, instead of the whole data at each live
+            # update. The counts only go up to the max value of the new pixels,
+            # which avoids allocating a full histogram for every pixel.
+            bc = numpy.bincount(raw_data.ravel())
+            self._live_hist[:bc.size] += bc
 
     def _assembleLiveData2D(self, n, raw_data, px_idx, rep, pol_idx):
         """
@@ -902,7 +918,7 @@ class MultipleDetectorStream(Stream, metaclass=ABCMeta):
         else:  # No data at all
             logging.warning("No final data for stream %s/%d", self.name.value, n)
 
-    def _projectXY2RGB(self, data, tint=(255, 255, 255)):
+    def _projectXY2RGB(self, data, tint=(255, 255, 255), hist=None):
         """
         Projects a 2D spatial DataArray into a RGB representation.
 
@@ -912,6 +928,8 @@ class MultipleDetectorStream(Stream, metaclass=ABCMeta):
 
         data (DataArray): 2D DataArray
         tint ((int, int, int)): colouration of the image, in RGB.
+        hist (None or ndarray): histogram of the acquired pixels of data, with
+          one bin per value, starting from 0. If None, it is computed from the data.
         return (DataArray): 3D DataArray.
         """
 
@@ -919,9 +937,13 @@ class MultipleDetectorStream(Stream, metaclass=ABCMeta):
         scan_area = self._current_scan_area
         if scan_area is None:
             return None
-        data_acq = data[acq_mask]
 
-        hist, edges = img.histogram(data_acq)
+        if hist is not None:
+            # Already computed as the data came in => no need to look at all the data
+            hist, edges = hist.copy(), (0, len(hist) - 1)
+        else:
+            data_acq = data[acq_mask]
+            hist, edges = img.histogram(data_acq)
         irange = img.findOptimalRange(hist, edges, 1/256)
         rgbim = img.DataArray2RGB(data, irange, tint)
         md = self._find_metadata(data.metadata)
@@ -953,7 +975,7 @@ class MultipleDetectorStream(Stream, metaclass=ABCMeta):
                 raise
 
         self.streams[0].raw = [raw_data]  # For GetBoundingBox()
-        rgbim = self._projectXY2RGB(raw_data)
+        rgbim = self._projectXY2RGB(raw_data, hist=self._live_hist)
         # Don't update if the acquisition is already over
         if self._current_scan_area is None:
             return
@@ -972,6 +994,10 @@ class SEMCCDMDStream(MultipleDetectorStream):
     image integration will be performed.
     """
 
+    # If True, the CCD data of each polarization is kept as a separate cube.
+    # Otherwise, the cubes are averaged into a single one (cf _assembleFinalData()).
+    _keep_pol_separated = False
+
     def __init__(self, name, streams):
         """
         :param streams (list of Streams): In addition to the requirements of
@@ -1008,6 +1034,17 @@ class SEMCCDMDStream(MultipleDetectorStream):
         self._trigger = self._ccd.softwareTrigger
         self._ccd_idx = len(self._streams) - 1  # optical detector is always last in streams
 
+        # None or str: path of an HDF5 file, to which the CCD data is written
+        # during the acquisition, pixel per pixel, instead of being kept in
+        # memory. This allows to acquire data larger than the memory. At the
+        # end, the file contains all the data, and the CCD data in .raw are
+        # DataArrayShadows, read from the file only when needed.
+        self.outputFile = None
+        self._writer = None  # HDF5Writer during the acquisition, if writing to a file
+        # (int, int) -> ndarray: for each cube (stream, polarisation), the
+        # current row, pixel-major, when writing to a file
+        self._live_rows = {}
+
     def _estimateRawAcquisitionTime(self):
         """
         :returns (float): Time in s for acquiring the whole image, without drift correction.
@@ -1140,6 +1177,117 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
         self._raw.append(da)
 
+    def _openOutputFile(self):
+        """
+        Create the output file, if the CCD data should be written to a file
+        during the acquisition (ie, .outputFile is set).
+        :raises ValueError: if the data cannot be written to a file, because
+          multiple polarizations are acquired, which should be averaged.
+        """
+        self._live_rows = {}
+        if self.outputFile:
+            if self._analyzer and self._acquireAllPol.value and not self._keep_pol_separated:
+                # The cubes would need to be all stored, and then read back, to be averaged
+                raise ValueError("Cannot write to a file an acquisition with multiple polarizations")
+            logging.info("Writing the acquisition data to %s", self.outputFile)
+            self._writer = hdf5.open_writer(self.outputFile)
+        else:
+            self._writer = None
+
+    def _closeOutputFile(self):
+        """
+        Close the output file, if still opened (ie, in case of error).
+        """
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        self._live_rows = {}
+
+    def _initLiveCube(self, n, shape, dtype, md):
+        """
+        Add a new data cube (initially all 0's) to ._live_data, to be filled
+        pixel per pixel with _setLiveCubePixel().
+        The data is stored pixel-major (ie, YX are the first dimensions), so that
+        the data of each pixel is contiguous in memory. The cube in ._live_data
+        is a view of it, with the YX dimensions last, so no copy is needed at
+        the end of the acquisition.
+        If writing to a file, the cube is stored in the file, instead of memory,
+        and ._live_data only contains the index of the image in the file. Only
+        the current row is kept in memory, and written at once when complete.
+        :param n: (int) number of the current stream
+        :param shape: (tuple of int) shape of the cube (the last 2 dims are Y and X)
+        :param dtype: (numpy.dtype) type of the data
+        :param md: (dict) metadata of the cube
+        """
+        shape = tuple(shape)
+        if self._writer:
+            pol_idx = len(self._live_data[n])
+            self._live_data[n].append(self._writer.add_image(shape, dtype, md))
+            self._live_rows[(n, pol_idx)] = numpy.zeros(shape[-1:] + shape[:-2], dtype=dtype)
+        else:
+            cube = numpy.zeros(shape[-2:] + shape[:-2], dtype=dtype)
+            cube = numpy.moveaxis(cube, (0, 1), (-2, -1))
+            self._live_data[n].append(model.DataArray(cube, md))
+
+    def _setLiveCubePixel(self, n, pol_idx, px_idx, data):
+        """
+        Store the data of one pixel into a cube created by _initLiveCube().
+        The pixels must be passed row by row, with X changing fast.
+        :param n: (int) number of the current stream
+        :param pol_idx: (int) polarisation index
+        :param px_idx: (tuple of int) pixel index: y, x
+        :param data: (ndarray) the data of the pixel, with the same shape as
+          the cube, without the YX dimensions.
+        """
+        if self._writer:
+            row = self._live_rows[(n, pol_idx)]
+            row[px_idx[1]] = data
+            if px_idx[1] == row.shape[0] - 1:  # Row complete => write it
+                block = numpy.moveaxis(row, 0, -1)[..., None, :]
+                self._writer.append(self._live_data[n][pol_idx], block, (px_idx[0], 0))
+        else:
+            # The data of the pixel is contiguous in memory (see _initLiveCube())
+            self._live_data[n][pol_idx][..., px_idx[0], px_idx[1]] = data
+
+    def _assembleAllFinalData(self):
+        """
+        Process all the (intermediary) ._live_data to the right shape/format for the final ._raw.
+        If writing to a file, the rest of the data is also written to the file,
+        and the CCD data is read back from it (lazily).
+        """
+        if not self._writer:
+            for stream_idx, das in enumerate(self._live_data):
+                self._assembleFinalData(stream_idx, das)
+            return
+
+        # The CCD data is already in the file, as separate images. Assemble
+        # the other streams as usual (they are small), and save them too.
+        for stream_idx, das in enumerate(self._live_data):
+            if stream_idx != self._ccd_idx:
+                self._assembleFinalData(stream_idx, das)
+        for da in self._raw:
+            self._writer.add_data(da)
+
+        ccd_imgs = self._live_data[self._ccd_idx]
+        mds = {i: self._getWrittenMetadata(self._writer.metadata[i], len(ccd_imgs))
+               for i in ccd_imgs}
+        self._writer.finalize(mds)
+        self._writer = None
+        self._live_rows = {}
+
+        acqd = hdf5.open_data(self.outputFile)
+        self._raw.extend(acqd.content[i] for i in ccd_imgs)
+
+    def _getWrittenMetadata(self, md, n):
+        """
+        Compute the metadata changes of the CCD data written to the file, to
+        match what _assembleFinalData() does when the data is in memory.
+        :param md: (dict) metadata of one CCD image in the file
+        :param n: (int) number of CCD images in the file
+        :returns: (dict) metadata to update
+        """
+        return {}
+
     def _runAcquisition(self, future):
         """
         Acquires images from multiple detectors via software synchronisation.
@@ -1179,6 +1327,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
             self._acq_data = [[] for _ in self._streams]  # just to be sure it's really empty
             self._live_data = [[] for _ in self._streams]
+            self._openOutputFile()
             # In case of long integration time, one ImageIntegrator per stream
             self._img_intor = [None for _ in self._streams]
             self._raw = []
@@ -1354,8 +1503,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             self._current_scan_area = None  # Indicate we are done for the live update
 
             # Process all the (intermediary) ._live_data to the right shape/format for the final ._raw
-            for stream_idx, das in enumerate(self._live_data):
-                self._assembleFinalData(stream_idx, das)
+            self._assembleAllFinalData()
 
             self._stopLeeches()
 
@@ -1381,6 +1529,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             return self.raw
         finally:
             self._current_scan_area = None  # Indicate we are done for the live (also in case of error)
+            self._closeOutputFile()
             for s in self._streams:
                 s._unlinkHwVAs()
             self._dc_estimator = None
@@ -1615,6 +1764,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
             self._acq_data = [[] for _ in self._streams]  # just to be sure it's really empty
             self._live_data = [[] for _ in self._streams]
+            self._openOutputFile()
             self._current_scan_area = (0, 0, 0, 0)
             self._raw = []
             self._anchor_raw = []
@@ -1810,8 +1960,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             self._current_scan_area = None  # Indicate we are done for the live update
 
             # Process all the (intermediary) ._live_data to the right shape/format for the final ._raw
-            for stream_idx, das in enumerate(self._live_data):
-                self._assembleFinalData(stream_idx, das)
+            self._assembleAllFinalData()
 
             self._stopLeeches()
 
@@ -1850,6 +1999,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
                 sstage.moveAbs(pos0).result()
 
+            self._closeOutputFile()
             for s in self._streams:
                 s._unlinkHwVAs()
             self._acq_data = [[] for _ in self._streams]  # regain a bit of memory
@@ -2198,10 +2348,9 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
             md[MD_DESCRIPTION] = self._streams[n].name.value
 
             # Shape of spectrum data = C11YX
-            da = numpy.zeros(shape=(spec_shape[1], 1, 1, rep[1], rep[0]), dtype=raw_data.dtype)
-            self._live_data[n].append(model.DataArray(da, md))
+            self._initLiveCube(n, (spec_shape[1], 1, 1, rep[1], rep[0]), raw_data.dtype, md)
 
-        self._live_data[n][pol_idx][:, 0, 0, px_idx[0], px_idx[1]] = raw_data.reshape(spec_shape[1])
+        self._setLiveCubePixel(n, pol_idx, px_idx, raw_data.reshape(spec_shape[1], 1, 1))
 
 
 class SEMTemporalMDStream(MultipleDetectorStream):
@@ -2454,6 +2603,7 @@ class SEMAngularSpectrumMDStream(SEMCCDMDStream):
     Multiple detector stream made of SEM & angular spectrum.
     Data format: SEM (2D=XY) + AngularSpectrum(4D=CA1YX).
     """
+    _keep_pol_separated = True
 
     def _assembleLiveData(self, n, raw_data, px_idx, rep, pol_idx):
         """
@@ -2516,14 +2666,13 @@ class SEMAngularSpectrumMDStream(SEMCCDMDStream):
             md[MD_DESCRIPTION] = self._streams[n].name.value
 
             # Shape of spectrum data = CA1YX
-            da = numpy.zeros(shape=(spec_res, angle_res, 1, rep[1], rep[0]), dtype=raw_data.dtype)
-            self._live_data[n].append(model.DataArray(da, md))
+            self._initLiveCube(n, (spec_res, angle_res, 1, rep[1], rep[0]), raw_data.dtype, md)
 
         # Detector image has a shape of (angle, lambda)
         raw_data = raw_data.T  # transpose to (lambda, angle)
         if self._sccd.wl_inverted:  # Flip the wavelength axis if needed
             raw_data = raw_data[::-1, ...]  # invert C
-        self._live_data[n][pol_idx][:,:, 0, px_idx[0], px_idx[1]] = raw_data.reshape(spec_res, angle_res)
+        self._setLiveCubePixel(n, pol_idx, px_idx, raw_data.reshape(spec_res, angle_res, 1))
 
     def _assembleFinalData(self, n, data):
         """
@@ -2540,6 +2689,12 @@ class SEMAngularSpectrumMDStream(SEMCCDMDStream):
 
         self._raw.extend(data)
 
+    def _getWrittenMetadata(self, md, n):
+        # Same as _assembleFinalData()
+        if n > 1:
+            return {MD_DESCRIPTION: md[MD_DESCRIPTION] + " " + md[MD_POL_MODE]}
+        return {}
+
 
 class SEMTemporalSpectrumMDStream(SEMCCDMDStream):
     """
@@ -2577,12 +2732,11 @@ class SEMTemporalSpectrumMDStream(SEMCCDMDStream):
             md[MD_DESCRIPTION] = self._streams[n].name.value
 
             # Shape of spectrum data = CT1YX
-            da = numpy.zeros(shape=(spec_res, temp_res, 1, rep[1], rep[0]), dtype=raw_data.dtype)
-            self._live_data[n].append(model.DataArray(da, md))
+            self._initLiveCube(n, (spec_res, temp_res, 1, rep[1], rep[0]), raw_data.dtype, md)
 
         # Detector image has a shape of (time, lambda)
         raw_data = raw_data.T  # transpose to (lambda, time)
-        self._live_data[n][pol_idx][:, :, 0, px_idx[0], px_idx[1]] = raw_data.reshape(spec_res, temp_res)
+        self._setLiveCubePixel(n, pol_idx, px_idx, raw_data.reshape(spec_res, temp_res, 1))
 
 
 class SEMARMDStream(SEMCCDMDStream):
@@ -2591,6 +2745,8 @@ class SEMARMDStream(SEMCCDMDStream):
     It handles acquisition, but not rendering (so .image always returns an empty
     image).
     """
+    _keep_pol_separated = True
+
     def _assembleLiveData(self, n, raw_data, px_idx, rep, pol_idx):
         """
         :param n: (int) number of the current stream
@@ -2605,7 +2761,11 @@ class SEMARMDStream(SEMCCDMDStream):
             return super(SEMARMDStream, self)._assembleLiveData(n, raw_data, px_idx, rep, pol_idx)
 
         raw_data.metadata[MD_DESCRIPTION] = self._streams[n].name.value
-        self._live_data[n].append(raw_data)
+        if self._writer:
+            # Each image is stored separately in the file
+            self._live_data[n].append(self._writer.add_data(raw_data))
+        else:
+            self._live_data[n].append(raw_data)
 
     def _assembleFinalData(self, n, data):
         """
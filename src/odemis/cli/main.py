@@ -279,23 +279,29 @@ def print_events(component, pretty):
         print_event(name, value, pretty)
 
 
-def print_vattribute(component, name, va, pretty):
+def print_vattribute(component, name, va, pretty, snapshot=None):
     """
     Print on one line the information about a VigilantAttribute
     component (Component): the component containing the VigilantAttribute
     name (str): the name of the VigilantAttribute
     va (VigilantAttribute): the VigilantAttribute to display
     pretty (bool): whether to display for the user (True) or for a machine (False)
+    snapshot (None or dict): the state of the VA, as returned by model.getVASnapshot().
+      If None, it is read from the VA.
     """
-    if va.unit:
+    if snapshot is None:
+        snapshot = model.getVASnapshot(va)
+
+    unit = snapshot["unit"]
+    if unit:
         if pretty:
-            unit = u" (unit: %s)" % va.unit
+            str_unit = u" (unit: %s)" % unit
         else:
-            unit = u"\tunit:%s" % va.unit
+            str_unit = u"\tunit:%s" % unit
     else:
-        unit = u""
+        str_unit = u""
 
-    if va.readonly:
+    if snapshot["readonly"]:
         if pretty:
             readonly = u"RO "
         else:
@@ -303,31 +309,31 @@ def print_vattribute(component, name, va, pretty):
     else:
         readonly = u""
 
-    # we cannot discover if it continuous or enumerated, just try and see if it fails
-    try:
-        varange = va.range
+    if "range" in snapshot:
+        varange = snapshot["range"]
         if pretty:
             str_range = u" (range: %s → %s)" % (varange[0], varange[1])
         else:
             str_range = u"\trange:%s" % str(varange)
-    except AttributeError:
+    else:
         str_range = u""
 
-    try:
-        vachoices = va.choices # set or dict
+    if "choices" in snapshot:
+        vachoices = snapshot["choices"]  # set or dict
         if pretty:
-            if isinstance(va.choices, dict):
+            if isinstance(vachoices, dict):
                 str_choices = u" (choices: %s)" % u", ".join(
                                 u"%s: '%s'" % i for i in vachoices.items())
             else:
                 str_choices = u" (choices: %s)" % u", ".join([str(c) for c in vachoices])
         else:
             str_choices = u"\tchoices:%s" % str(vachoices)
-    except AttributeError:
+    else:
         str_choices = ""
 
+    # If the value couldn't be read, that will fail the same way as before
+    val = snapshot["value"] if "value" in snapshot else va.value
     if pretty:
-        val = va.value
         if name in VAS_COMPS:
             try:
                 val = {c.name for c in val}
@@ -336,7 +342,7 @@ def print_vattribute(component, name, va, pretty):
                 # Leave the value as-is
 
         # Convert to nicer unit for user
-        if va.unit and va.unit == "rad" and isinstance(val, numbers.Real):
+        if unit == "rad" and isinstance(val, numbers.Real):
             try:
                 val_converted = u" = %s°" % (math.degrees(val),)
             except Exception:
@@ -346,11 +352,11 @@ def print_vattribute(component, name, va, pretty):
             val_converted = u""
 
         # For position, it's trickier, as the unit is on .axes
-        if (name == "position" and isinstance(va.value, dict) and
+        if (name == "position" and isinstance(val, dict) and
             hasattr(component, "axes") and isinstance(component.axes, dict)
            ):
             pos_deg = {}
-            for an, pos in va.value.items():
+            for an, pos in val.items():
                 try:
                     axis_def = component.axes[an]
                 except KeyError:
@@ -371,17 +377,21 @@ def print_vattribute(component, name, va, pretty):
         else:
             sval = str(val)
         print(u"\t" + name + u" (%sVigilant Attribute)\t value: %s%s%s%s%s" %
-              (readonly, sval, unit, str_range, str_choices, val_converted))
+              (readonly, sval, str_unit, str_range, str_choices, val_converted))
     else:
         print(u"%s\ttype:%sva\tvalue:%s%s%s%s" %
-              (name, readonly, str(va.value), unit, str_range, str_choices))
+              (name, readonly, str(val), str_unit, str_range, str_choices))
 
 
-def print_vattributes(component, pretty):
+def print_vattributes(component, pretty, snapshots=None):
+    """
+    snapshots (None or dict str -> dict): VA name -> snapshot of the VA
+    """
     for name, va in model.getVAs(component).items():
         if name in VAS_HIDDEN:
             continue
-        print_vattribute(component, name, va, pretty)
+        snapshot = snapshots.get(name) if snapshots is not None else None
+        print_vattribute(component, name, va, pretty, snapshot)
 
 
 def map_metadata_names():
@@ -397,8 +407,13 @@ def map_metadata_names():
     return ret
 
 
-def print_metadata(component, pretty):
-    md = component.getMetadata()
+def print_metadata(component, pretty, md=None):
+    """
+    md (None or dict): the metadata of the component. If None, it is read from
+      the component.
+    """
+    if md is None:
+        md = component.getMetadata()
 
     md2name = map_metadata_names()
     if pretty:
@@ -416,20 +431,36 @@ def print_metadata(component, pretty):
             name = md2name.get(key, "'%s'" % (key,))
             print(u"%s\ttype:metadata\tvalue:%s" % (name, value))
 
-def print_attributes(component, pretty):
+def print_attributes(component, pretty, snapshot=None):
+    """
+    snapshot (None or dict): the state of the component, as returned by
+      model.getComponentsSnapshot(). If None, everything is read from the component.
+    """
+    if snapshot is None:
+        vas_snapshot = None
+        affects = component.affects.value
+        md = None
+    else:
+        vas_snapshot = snapshot["vas"]
+        # If the value couldn't be read, it's missing => don't show it
+        affects = vas_snapshot.get("affects", {}).get("value")
+        md = snapshot.get("metadata")
+
     if pretty:
         print(u"Component '%s':" % component.name)
         print(u"\trole: %s" % component.role)
-        print(u"\taffects: " + ", ".join(u"'%s'" % n for n in sorted(component.affects.value)))
+        if affects is not None:
+            print(u"\taffects: " + ", ".join(u"'%s'" % n for n in sorted(affects)))
     else:
         print(u"name\tvalue:%s" % component.name)
         print(u"role\tvalue:%s" % component.role)
-        print(u"affects\tvalue:" + u"\t".join(component.affects.value))
+        if affects is not None:
+            print(u"affects\tvalue:" + u"\t".join(affects))
     print_roattributes(component, pretty)
-    print_vattributes(component, pretty)
+    print_vattributes(component, pretty, vas_snapshot)
     print_data_flows(component, pretty)
     print_events(component, pretty)
-    print_metadata(component, pretty)
+    print_metadata(component, pretty, md)
 
 def get_component(comp_name):
     """
@@ -472,8 +503,9 @@ def list_properties(comp_name, pretty=True):
     pretty (bool): if True, display with pretty-printing
     """
     if comp_name == "*":
-        for c in model.getComponents():
-            print_attributes(c, pretty)
+        # Get everything at once, which is much faster than reading every VA
+        for c, snapshot in model.getComponentsSnapshot().items():
+            print_attributes(c, pretty, snapshot)
             print("")
     else:
         component = get_component(comp_name)
@@ -212,6 +212,52 @@ class TestWithBackend(unittest.TestCase):
         self.assertTrue(b"swVersion" in output)
         self.assertTrue(b"power" in output)
 
+    def test_list_prop_all(self):
+        try:
+            # change the stdout
+            out = BytesIO()
+            sys.stdout = out
+
+            cmdline = ["cli", "--list-prop", "*"]
+            ret = main.main(cmdline)
+        except SystemExit as exc:
+            ret = exc.code
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+
+        output = out.getvalue()
+        self.assertTrue(b"Light Engine" in output)
+        self.assertTrue(b"Camera" in output)
+        self.assertTrue(b"exposureTime" in output)
+
+    def test_snapshot_speed(self):
+        """
+        Compare the time to connect to all the components (as a client does at
+        startup) and read all their VAs, one by one or via a snapshot.
+        """
+        # Startup from scratch: no proxy to the backend yet
+        model._core._microscope = None
+        startt = time.time()
+        comps = model.getComponents()
+        dur_startup = time.time() - startt
+        vas_values = {}
+        for c in comps:
+            for n, va in model.getVAs(c).items():
+                vas_values[(c.name, n)] = va.value
+        dur_std = time.time() - startt
+
+        model._core._microscope = None
+        startt = time.time()
+        snapshots = model.getComponentsSnapshot()
+        dur_snapshot = time.time() - startt
+        print("Startup with getComponents() took %g s, and reading all VAs %g s in total. "
+              "Startup with snapshot took %g s" % (dur_startup, dur_std, dur_snapshot))
+
+        self.assertEqual({c.name for c in snapshots}, {c.name for c in comps})
+        for c, snapshot in snapshots.items():
+            self.assertEqual(set(snapshot["vas"].keys()), set(model.getVAs(c).keys()))
+            self.assertIn("role", snapshot["roattributes"])
+        self.assertLess(dur_snapshot, dur_std)
+
     def test_encoding(self):
         """Check no problem happens due to unicode encoding to ascii"""
         f = open("test.txt", "w")
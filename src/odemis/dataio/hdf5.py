@@ -19,12 +19,17 @@ PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+from collections import deque
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import json
 import logging
+import math
 import os
 import time
 from typing import Union
+import zlib
 
 import h5py
 import numpy
@@ -32,8 +37,9 @@ from numpy.polynomial import polynomial
 
 import odemis
 from odemis import model
+from odemis.model import AcquisitionData, DataArrayShadow
 from odemis.util import fluo, img, spectrum
-from odemis.util.conversion import JsonExtraEncoder
+from odemis.util.conversion import JsonExtraEncoder, get_tile_md_pos
 
 # User-friendly name
 FORMAT = "HDF5"
@@ -127,7 +133,101 @@ _dtid = h5py.special_dtype(enum=('i', {
 _dictid = h5py.check_dtype(enum=_dtid)
 
 
-def _create_image_dataset(group, dataset_name, image, **kwargs):
+# Approximate size (in bytes) of each chunk, when the data is compressed. The
+# HDF5 documentation recommends between 10 KiB and 1 MiB (the default chunk cache size).
+CHUNK_SIZE = 256 * 1024
+# Compression level used for gzip (same as the default of h5py)
+GZIP_LEVEL = 4
+
+
+def get_chunk_shape(shape, dtype, dims, chunk_size=CHUNK_SIZE):
+    """
+    Compute a chunk shape adapted to the typical access of microscopy data.
+    The "spectral" dimensions (C, T and A) are kept whole, if possible, so that
+    reading the data at a given pixel only requires one chunk. The rest of the
+    chunk is a square in YX, which also fits reading a plane (or a tile).
+    shape (tuple of 0<int): the shape of the data
+    dtype (numpy.dtype): the type of the data
+    dims (str): the name of each dimension (eg, "CTZYX")
+    chunk_size (0<int): approximate size of a chunk in bytes
+    return (tuple of 0<int): the chunk shape, of the same length as shape
+    """
+    if len(dims) != len(shape):
+        raise ValueError("dims %s doesn't match shape %s" % (dims, shape))
+    itemsize = numpy.dtype(dtype).itemsize
+    chunks = [1] * len(shape)
+
+    spec_idx = [i for i, d in enumerate(dims) if d in "CTA"]
+    for i in spec_idx:
+        chunks[i] = shape[i]
+    # If the data of a pixel is too large, cut the longest spectral dimensions
+    while spec_idx and numpy.prod(chunks) * itemsize > chunk_size:
+        i = max(spec_idx, key=lambda i: chunks[i])
+        if chunks[i] == 1:
+            break
+        chunks[i] = int(math.ceil(chunks[i] / 2))
+
+    # Fill up the rest with a square in XY
+    n_px = max(1, chunk_size // (int(numpy.prod(chunks)) * itemsize))
+    side = int(math.sqrt(n_px))
+    if "Y" in dims:
+        yi = dims.index("Y")
+        chunks[yi] = max(1, min(shape[yi], side))
+        n_px //= chunks[yi]
+    if "X" in dims:
+        xi = dims.index("X")
+        chunks[xi] = max(1, min(shape[xi], n_px))
+
+    return tuple(chunks)
+
+
+def _compress_chunk(image, offset, chunks, level):
+    """
+    Compress one chunk of the image, as the HDF5 gzip filter would do.
+    image (numpy.ndarray): the complete image
+    offset (tuple of int): the position of the chunk in the image
+    chunks (tuple of int): the chunk shape
+    level (int): the gzip compression level
+    return (bytes): the compressed chunk
+    """
+    sl = tuple(slice(o, o + c) for o, c in zip(offset, chunks))
+    part = image[sl]
+    if part.shape != chunks:
+        # On the borders, the chunk is stored at full size, padded with 0
+        chunk = numpy.zeros(chunks, dtype=image.dtype)
+        chunk[tuple(slice(0, s) for s in part.shape)] = part
+    else:
+        chunk = numpy.ascontiguousarray(part)
+    # zlib releases the GIL, so this can run in parallel
+    return zlib.compress(chunk, level)
+
+
+def _write_compressed_chunks(dataset, image, level=GZIP_LEVEL):
+    """
+    Write the image into the dataset, by compressing each chunk in parallel.
+    dataset (h5py.Dataset): a chunked dataset, with only the gzip filter
+    image (numpy.ndarray): the data to write, of the same shape as the dataset
+    level (int): the gzip compression level
+    """
+    chunks = dataset.chunks
+    offsets = itertools.product(*(range(0, s, c) for s, c in zip(image.shape, chunks)))
+    nworkers = os.cpu_count() or 1
+    # Limit the number of compressed chunks waiting to be written, to keep the
+    # memory usage low. The chunks are written in order, from the main thread,
+    # as HDF5 doesn't support writing in parallel.
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        queue = deque()
+        for offset in offsets:
+            queue.append((offset, executor.submit(_compress_chunk, image, offset, chunks, level)))
+            if len(queue) > nworkers * 2:
+                o, f = queue.popleft()
+                dataset.id.write_direct_chunk(o, f.result())
+        while queue:
+            o, f = queue.popleft()
+            dataset.id.write_direct_chunk(o, f.result())
+
+
+def _create_image_dataset(group, dataset_name, image, compression=None, chunks=None, **kwargs):
     """
     Create a dataset respecting the HDF5 image specification
     http://www.hdfgroup.org/HDF5/doc/ADGuide/ImageSpec.html
@@ -135,11 +235,38 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     group (HDF group): the group that will contain the dataset
     dataset_name (string): name of the dataset
     image (numpy.ndimage): the image to create. It should have at least 2 dimensions
+    compression (None or str): compression filter to use
+    chunks (None or tuple of int): the chunk shape, when compressed. If None,
+      it is picked according to the dimensions of the image (MD_DIMS).
     returns the new dataset
     """
     assert(len(image.shape) >= 2)
-    image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
+    if compression == "gzip" and image.size > 0:
+        if chunks is None:
+            md = getattr(image, "metadata", {})
+            dims = md.get(model.MD_DIMS, "CTZYX"[-image.ndim::])
+            if len(dims) != image.ndim:
+                dims = "CTZYX"[-image.ndim::]
+            chunks = get_chunk_shape(image.shape, image.dtype, dims)
+        image_dataset = group.create_dataset(dataset_name, shape=image.shape, dtype=image.dtype,
+                                             chunks=chunks, compression=compression,
+                                             compression_opts=GZIP_LEVEL, **kwargs)
+        _write_compressed_chunks(image_dataset, image)
+    else:
+        image_dataset = group.create_dataset(dataset_name, data=image,
+                                             compression=compression, **kwargs)
+
+    _add_image_attrs(image_dataset, (image.min(), image.max()))
+    return image_dataset
+
 
+def _add_image_attrs(image_dataset, minmax):
+    """
+    Set the attributes of a dataset, as required by the HDF5 image specification
+    image_dataset (h5py.Dataset): the dataset containing the image
+    minmax (number, number): the minimum and maximum values of the image
+    """
+    image = image_dataset
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
     # FIXME: needs to be NULLTERM, not NULLPAD... but h5py doesn't allow to distinguish
     image_dataset.attrs["CLASS"] = numpy.string_("IMAGE")
@@ -157,13 +284,11 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     else:
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_GRAYSCALE")
         image_dataset.attrs["IMAGE_WHITE_IS_ZERO"] = numpy.array(0, dtype="uint8")
-        image_dataset.attrs["IMAGE_MINMAXRANGE"] = [image.min(), image.max()]
+        image_dataset.attrs["IMAGE_MINMAXRANGE"] = numpy.array(minmax, dtype=image.dtype)
 
     image_dataset.attrs["DISPLAY_ORIGIN"] = numpy.string_("UL") # not rotated
     image_dataset.attrs["IMAGE_VERSION"] = numpy.string_("1.2")
 
-    return image_dataset
-
 
 def _read_image_dataset(dataset):
     """
@@ -174,6 +299,19 @@ def _read_image_dataset(dataset):
      IOError: if it doesn't conform to the standard
      NotImplementedError: if the image uses so fancy standard features
     """
+    md = _read_image_dataset_md(dataset)
+    return model.DataArray(dataset[...], md)
+
+
+def _read_image_dataset_md(dataset):
+    """
+    Check a dataset respects the HDF5 image specification, without reading the data.
+    returns (dict): the metadata which can be deduced from the image attributes.
+      If RGB, the data has 3 dimensions, and the metadata MD_DIMS indicates the order.
+    raises
+     IOError: if it doesn't conform to the standard
+     NotImplementedError: if the image uses so fancy standard features
+    """
     # check basic format
     if len(dataset.shape) < 2:
         raise IOError("Image has a shape of %s" % (dataset.shape,))
@@ -184,7 +322,7 @@ def _read_image_dataset(dataset):
     # conversion is almost entirely different depending on subclass
     subclass = dataset.attrs.get("IMAGE_SUBCLASS", b"IMAGE_GRAYSCALE")
 
-    image = model.DataArray(dataset[...])
+    md = {}
     if subclass == b"IMAGE_GRAYSCALE":
         pass
     elif subclass == b"IMAGE_TRUECOLOR":
@@ -203,9 +341,9 @@ def _read_image_dataset(dataset):
 
         if il_mode == b"INTERLACE_PLANE":
             # colour is first dim
-            image.metadata[model.MD_DIMS] = "CYX"
+            md[model.MD_DIMS] = "CYX"
         elif il_mode == b"INTERLACE_PIXEL":
-            image.metadata[model.MD_DIMS] = "YXC"
+            md[model.MD_DIMS] = "YXC"
         else:
             raise NotImplementedError("Unable to handle images of subclass '%s'" % subclass)
 
@@ -217,7 +355,7 @@ def _read_image_dataset(dataset):
     if dorig != b"UL":
         logging.warning("Image rotation %s not handled", dorig)
 
-    return image
+    return md
 
 
 def _add_image_info(group, dataset, image):
@@ -686,6 +824,24 @@ def _parse_physical_data(pdgroup, da):
     returns (list of DataArrays): The same data, but broken into smaller
       DataArrays if necessary, and with additional metadata.
     """
+    mds = _parse_physical_metadata(pdgroup, da.metadata, da.shape)
+    if len(mds) > 1:
+        return [model.DataArray(c, md) for c, md in zip(da, mds)]
+    else:
+        return [da]
+
+
+def _parse_physical_metadata(pdgroup, md, shape):
+    """
+    Parse the metadata found in PhysicalData, and detect whether the image should
+    be separated per channel.
+    pdgroup (HDF Group): the group "PhysicalData" associated to an image
+    md (dict): the metadata of the image. It is updated if the image is not separated.
+    shape (tuple of int): the shape of the image
+    returns (list of dict): the metadata of each part of the image. If it
+      contains more than one item, the image should be separated along the first
+      dimension (C).
+    """
     # The information in PhysicalData might be different for each channel (e.g.
     # fluorescence image). In this case, the DA must be separated into smaller
     # ones, per channel.
@@ -700,18 +856,16 @@ def _parse_physical_data(pdgroup, da):
 
     if n > 1:
         # need to separate it
-        if n != da.shape[0]:
+        if n != shape[0]:
             logging.warning("Image has %d channels and %d metadata, failed to map",
-                            da.shape[0], n)
-            das = [da]
+                            shape[0], n)
+            mds = [md]
         else:
-            # list(da) does almost what we need, but metadata is shared
-            das = [model.DataArray(c, da.metadata.copy()) for c in da]
+            mds = [md.copy() for i in range(n)]
     else:
-        das = [da]
+        mds = [md]
 
-    for i, d in enumerate(das):
-        md = d.metadata
+    for i, md in enumerate(mds):
         try:
             cd = convert_to_str(pdgroup["ChannelDescription"][i])
             md[model.MD_DESCRIPTION] = cd
@@ -767,7 +921,7 @@ def _parse_physical_data(pdgroup, da):
         # extra settings
         read_metadata(pdgroup, i, md, "ExtraSettings", model.MD_EXTRA_SETTINGS, converter=json.loads)
 
-    return das
+    return mds
 
 
 def read_metadata(pdgroup, c_index, md, name, md_key, converter, bad_states=(ST_INVALID,)):
@@ -1592,8 +1746,6 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     f.close()
 
 
-# TODO: allow to append data to a file, or any other way to allow saving large
-# data without having everything in memory simultaneously.
 def export(filename, data, thumbnail=None):
     '''
     Write an HDF5 file with the given image and metadata
@@ -1617,6 +1769,252 @@ def export(filename, data, thumbnail=None):
     _saveAsHDF5(filename, data, thumbnail)
 
 
+# Size (in bytes) of the chunk cache of each dataset, when writing incrementally.
+# It should be large enough to hold a whole row of chunks, so that each chunk is
+# only compressed once, after all its pixels have been written.
+WRITER_CACHE_SIZE = 64 * 1024 * 1024
+# Minimum time (in s) between two flushes of the file, when writing incrementally.
+# The file is flushed after a row is complete, so that it's readable even if the
+# writer stops abruptly. However, each flush compresses the chunks which are
+# only partially written, so it should not happen too often.
+WRITER_FLUSH_PERIOD = 5
+
+
+def open_writer(filename, compressed=True):
+    """
+    Create an HDF5 file, to which the data can be written incrementally, as
+    it is acquired. This allows to save data larger than the memory.
+    filename (str): filename of the file to create (including path). If a file
+      already exists, it is overwritten.
+    compressed (bool): whether the data is compressed or not.
+    return (HDF5Writer): the file opened for writing. Once all the data has
+      been written, call .finalize() on it.
+    """
+    return HDF5Writer(filename, compressed)
+
+
+class HDF5Writer(object):
+    """
+    Writes an HDF5 (SVI) file, one block of data at a time.
+    The images are first preallocated on disk, with their metadata (add_image()),
+    then filled with append(), and the metadata is updated at the end, by
+    finalize(). The file is regularly flushed, so that if the writer stops
+    before finalize(), the data written so far can still be read.
+    Not thread-safe: all the calls should be done from the same thread.
+    """
+
+    def __init__(self, filename, compressed=True):
+        """
+        See open_writer()
+        """
+        self.filename = filename
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        # With w0=1, the chunks fully written are the first ones to be evicted
+        # from the cache (and so compressed).
+        # The groups are listed in creation order (instead of alphabetical
+        # order, where Acquisition10 comes before Acquisition2), so that the
+        # images are read back in the same order as they were added.
+        self._file = h5py.File(filename, "w", rdcc_nbytes=WRITER_CACHE_SIZE,
+                               rdcc_nslots=10007, rdcc_w0=1, track_order=True)
+        self._compression = "gzip" if compressed else None
+        self._groups = []  # HDF Group for each image
+        self._datasets = []  # h5py.Dataset for each image
+        self.metadata = []  # metadata for each image, can be updated until finalize()
+        self._written_md = []  # metadata for each image, as written in the file
+        self._minmax = []  # (min, max) or None, for each image
+        self._last_flush = time.time()
+
+    def add_image(self, shape, dtype, metadata=None):
+        """
+        Preallocate a new image in the file. Its content is initially all 0's.
+        shape (tuple of 0<int): the shape of the image, as it will be stored in
+          the file. So it should typically be 5D CTZYX (or CAZYX). The last 2
+          dimensions are always Y and X.
+        dtype (numpy.dtype): the type of the data
+        metadata (None or dict): the metadata of the image. It can be updated
+          when calling finalize().
+        return (int): the index of the image, to be passed to append().
+        """
+        if len(shape) < 2:
+            raise ValueError("Image must have at least 2 dimensions, but got shape %s" % (shape,))
+        if self._file is None:
+            raise IOError("File %s is already closed" % (self.filename,))
+        md = dict(metadata or {})
+        n = len(self._datasets)
+        ga = self._file.create_group("Acquisition%d" % n)
+        gi = ga.create_group("ImageData")
+
+        dtype = numpy.dtype(dtype)
+        kwargs = {}
+        if self._compression and numpy.prod(shape) > 0:
+            dims = md.get(model.MD_DIMS, "CTZYX"[-len(shape):])
+            if len(dims) != len(shape):
+                dims = "CTZYX"[-len(shape):]
+            chunks = get_chunk_shape(shape, dtype, dims)
+            # The data is typically written row by row, so make sure the cache
+            # can hold all the chunks of a row, or they'd be compressed several times.
+            chunk_bytes = int(numpy.prod(chunks)) * dtype.itemsize
+            if math.ceil(shape[-1] / chunks[-1]) * chunk_bytes > WRITER_CACHE_SIZE:
+                chunks = chunks[:-2] + (1, chunks[-1])
+            kwargs = {"chunks": chunks, "compression": self._compression,
+                      "compression_opts": GZIP_LEVEL}
+        ds = gi.create_dataset("Image", shape=tuple(shape), dtype=dtype, **kwargs)
+
+        self._groups.append(ga)
+        self._datasets.append(ds)
+        self.metadata.append(md)
+        self._written_md.append(None)
+        self._minmax.append(None)
+        self._write_metadata(n)
+        return n
+
+    def append(self, n, block, pos):
+        """
+        Write a block of data into an image.
+        n (int): index of the image, as returned by add_image()
+        block (numpy.ndarray): the data to write. The last 2 dimensions are Y and
+          X (height and width of the block), and the other dimensions must have
+          the same size as the image (but missing dimensions of size 1 are
+          accepted, as long as the number of elements matches).
+        pos (int, int): index (Y, X) of the first pixel of the block in the image
+        """
+        ds = self._datasets[n]
+        block = numpy.asarray(block)
+        if block.ndim < 2:
+            raise ValueError("Block must have at least 2 dimensions, but got shape %s" % (block.shape,))
+        h, w = block.shape[-2:]
+        block = block.reshape(ds.shape[:-2] + (h, w))
+        y, x = pos
+        if y < 0 or x < 0 or y + h > ds.shape[-2] or x + w > ds.shape[-1]:
+            raise IndexError("Block of %dx%d px at %s is outside of the image of shape %s" %
+                             (w, h, pos, ds.shape))
+        ds[..., y:y + h, x:x + w] = block
+
+        if block.size:
+            bmin, bmax = block.min(), block.max()
+            mm = self._minmax[n]
+            if mm is not None:
+                bmin, bmax = min(mm[0], bmin), max(mm[1], bmax)
+            self._minmax[n] = (bmin, bmax)
+
+        if x + w == ds.shape[-1] and time.time() > self._last_flush + WRITER_FLUSH_PERIOD:
+            self.flush()
+
+    def flush(self):
+        """
+        Write to disk all the data written so far (and the current range of
+        values of each image).
+        """
+        for ds, mm in zip(self._datasets, self._minmax):
+            if mm is not None:
+                _add_image_attrs(ds, mm)
+        self._file.flush()
+        self._last_flush = time.time()
+
+    def add_data(self, da):
+        """
+        Write a complete image at once. It's typically used for the small data
+          acquired along the large data written with append().
+        da (DataArray): the data to write, with the metadata. The dimensions are
+          reordered, as with export().
+        return (int): the index of the image
+        """
+        da = _adjustDimensions(da)
+        n = self.add_image(da.shape, da.dtype, da.metadata)
+        ds = self._datasets[n]
+        if da.size:
+            if ds.compression == "gzip":
+                _write_compressed_chunks(ds, da)
+            else:
+                ds[...] = da
+            self._minmax[n] = (da.min(), da.max())
+            _add_image_attrs(ds, self._minmax[n])
+        if time.time() > self._last_flush + WRITER_FLUSH_PERIOD:
+            self.flush()
+        return n
+
+    def finalize(self, metadata=None):
+        """
+        Update the metadata of all the images, and close the file.
+        metadata (None or dict int -> dict): for the given image indices, the
+          metadata to update (compared to the metadata passed to add_image()).
+        """
+        if metadata:
+            for n, md in metadata.items():
+                self.metadata[n].update(md)
+
+        for n, (ds, mm) in enumerate(zip(self._datasets, self._minmax)):
+            try:
+                changed = self.metadata[n] != self._written_md[n]
+            except ValueError:  # Some metadata is an array
+                changed = True
+            if changed:
+                self._write_metadata(n)
+            _add_image_attrs(ds, mm if mm is not None else (0, 0))
+
+        self.close()
+
+    def _write_metadata(self, n):
+        """
+        Write (or overwrite) the metadata of an image in the file.
+        n (int): index of the image
+        """
+        ga, ds, md = self._groups[n], self._datasets[n], self.metadata[n]
+        if self._written_md[n] is not None:
+            _remove_image_metadata(ga, ds)
+
+        # A placeholder with the same shape as the image, to pass the metadata,
+        # without taking any memory.
+        da = model.DataArray(numpy.broadcast_to(numpy.zeros((), dtype=ds.dtype), ds.shape), md)
+        da = _mergeCorrectionMetadata(da)
+        _add_image_attrs(ds, self._minmax[n] or (0, 0))
+        _h5py_enum_commit(ga, b"StateEnumeration", _dtstate)
+        _add_image_info(ga["ImageData"], ds, da)
+        _add_image_metadata(ga, da, None)
+        _add_svi_info(ga)
+        self._written_md[n] = dict(md)
+
+    def close(self):
+        """
+        Close the file, without writing the metadata. Typically used if the
+        acquisition failed. It's fine to call it multiple times.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _remove_image_metadata(group, dataset):
+    """
+    Remove all the metadata of an image written by HDF5Writer, so that it can
+    be written again.
+    group (HDF Group): the group of the acquisition ("AcquisitionN")
+    dataset (HDF Dataset): the image dataset, in the "ImageData" group
+    """
+    # Same workaround for the CLASS attribute as in _add_image_info()
+    ds_class = dataset.attrs.get("CLASS")
+    if ds_class is not None:
+        del dataset.attrs["CLASS"]
+    try:
+        for dim in dataset.dims:
+            for scale in dim.values():
+                dim.detach_scale(scale)
+    finally:
+        if ds_class is not None:
+            dataset.attrs["CLASS"] = ds_class
+
+    gi = group["ImageData"]
+    for name in list(gi.keys()):
+        if name != "Image":
+            del gi[name]
+    for name in list(group.keys()):
+        if name != "ImageData":
+            del group[name]
+
+
 def read_data(filename):
     """
     Read an HDF5 file and return its content (skipping the thumbnail).
@@ -1652,6 +2050,218 @@ def read_thumbnail(filename):
     return _thumbFromHDF5(filename)
 
 
+def open_data(filename):
+    """
+    Opens an HDF5 file, and return an AcquisitionData instance. The data is only
+    read from the file when it is actually needed.
+    filename (str): path to the file
+    return (AcquisitionData): an opened file
+    raises:
+        IOError in case the file format is not as expected.
+    """
+    return AcquisitionDataHDF5(filename)
+
+
+# Minimum size (in px) of a tile. Typically, the dataset chunks are smaller, so
+# the tiles are made of several chunks.
+MIN_TILE_SIZE = 256
+
+
+class DataArrayShadowHDF5(DataArrayShadow):
+    """
+    DataArrayShadow which reads the data from an HDF5 dataset, only when needed.
+    If the dataset is chunked, and the image is 2D, it supports reading it per tile.
+    """
+
+    def __init__(self, dataset, metadata=None, index=()):
+        """
+        dataset (h5py.Dataset): the dataset containing the data
+        metadata (dict str->val): The metadata
+        index (tuple of int): index of the data in the dataset, along the first
+          dimensions. Typically, it's empty, or the C index if the data is
+          separated per channel.
+        """
+        self._dataset = dataset
+        metadata = metadata if metadata is not None else {}
+        shape = dataset.shape[len(index):]
+
+        # If the data is chunked, and only 2D (with extra dimensions of length 1),
+        # present it as a 2D image that can be read per tile.
+        maxzoom, tile_shape = None, None
+        chunks = dataset.chunks
+        if (chunks is not None and len(shape) >= 2 and
+            all(s == 1 for s in shape[:-2]) and
+            metadata.get(model.MD_DIMS, "YX")[-2:] == "YX"):
+            index = index + (0,) * (len(shape) - 2)
+            shape = shape[-2:]
+            if model.MD_DIMS in metadata:
+                metadata[model.MD_DIMS] = "YX"
+            # Tiles are aligned on the chunks
+            maxzoom = 0
+            tile_shape = tuple(int(math.ceil(MIN_TILE_SIZE / c)) * c for c in (chunks[-1], chunks[-2]))
+            tile_shape = tuple(min(t, s) for t, s in zip(tile_shape, shape[::-1]))
+        self._index = index
+
+        DataArrayShadow.__init__(self, shape, dataset.dtype, metadata, maxzoom, tile_shape)
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return model.DataArray(self[...], self.metadata.copy())
+
+    def __getitem__(self, key):
+        """
+        Reads only the given part of the data. Reading along the dimensions
+        which are not split into many chunks is the most efficient.
+        key (slice, int, Ellipsis, or tuple of them): part of the data, as for
+          a numpy array (only basic indexing is supported)
+        return (numpy.ndarray): the data, without metadata
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        # Make sure the Ellipsis of the key doesn't expand over the index
+        if Ellipsis not in key:
+            key = key + (Ellipsis,)
+        return self._dataset[self._index + key]
+
+    def getTile(self, x, y, zoom):
+        """
+        Fetches one tile
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. Only 0 is supported.
+        return (DataArray): the tile, of shape tile_shape (or smaller on the borders)
+        """
+        if not hasattr(self, "maxzoom"):
+            raise ValueError("Image is not tiled")
+        if zoom != 0:
+            raise ValueError("Invalid zoom level %d" % (zoom,))
+
+        tw, th = self.tile_shape
+        tile = self[y * th:(y + 1) * th, x * tw:(x + 1) * tw]
+        if tile.size == 0:
+            raise ValueError("Tile %d,%d is out of the image" % (x, y))
+        tile = model.DataArray(tile, self.metadata.copy())
+        if model.MD_PIXEL_SIZE in self.metadata:
+            # calculate the center of the tile
+            tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+
+        return tile
+
+
+class AcquisitionDataHDF5(AcquisitionData):
+    """
+    Implements AcquisitionData for HDF5 files
+    """
+
+    def __init__(self, filename):
+        """
+        filename (str): The name of the HDF5 file
+        """
+        # The file stays open as long as the datasets are used
+        f = h5py.File(filename, "r")
+        data = self._getDataArrayShadows(f)
+        thumbnails = self._getThumbnailShadows(f)
+        AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
+
+    @staticmethod
+    def _getDataArrayShadows(f):
+        """
+        Same as _dataFromHDF5(), but creates DataArrayShadows.
+        f (h5py.File): the root of the file
+        return (list of DataArrayShadowHDF5)
+        """
+        # if follows SVI convention => use the special function
+        for obj in f.values():
+            if (isinstance(obj, h5py.Group) and
+                isinstance(obj.get("SVIData"), h5py.Group)):
+                return AcquisitionDataHDF5._getSVIDataArrayShadows(f)
+
+        data = []
+        # go rough: return any dataset with numbers (and more than one element)
+
+        def addIfWorthy(name, obj):
+            if (isinstance(obj, h5py.Dataset) and obj.dtype.kind in "biufc" and
+                numpy.prod(obj.shape) > 1):
+                data.append(DataArrayShadowHDF5(obj, {}))
+
+        f.visititems(addIfWorthy)
+        return data
+
+    @staticmethod
+    def _getSVIDataArrayShadows(f):
+        """
+        Same as _dataFromSVIHDF5(), but creates DataArrayShadows.
+        f (h5py.File): the root of the file
+        return (list of DataArrayShadowHDF5)
+        """
+        data = []
+        for obj in f.values():
+            # find all the expected and interesting objects
+            try:
+                svidata = obj["SVIData"]
+                imagedata = obj["ImageData"]
+                image = imagedata["Image"]
+                physicaldata = obj["PhysicalData"]
+            except KeyError:
+                continue  # not conforming => try next object
+
+            try:
+                md = _read_image_dataset_md(image)
+            except Exception:
+                logging.exception("Failed to read data of acquisition '%s'", obj.name)
+                continue
+
+            try:
+                md.update(_read_image_info(imagedata))
+            except Exception:
+                logging.exception("Failed to parse metadata of acquisition '%s'", obj.name)
+
+            mds = _parse_physical_metadata(physicaldata, md, image.shape)
+            if len(mds) > 1:
+                data.extend(DataArrayShadowHDF5(image, m, (i,)) for i, m in enumerate(mds))
+            else:
+                data.append(DataArrayShadowHDF5(image, md))
+        return data
+
+    @staticmethod
+    def _getThumbnailShadows(f):
+        """
+        Same as _thumbFromHDF5(), but creates DataArrayShadows.
+        f (h5py.File): the root of the file
+        return (list of DataArrayShadowHDF5)
+        """
+        thumbs = []
+        try:
+            grp = f["Preview"]
+        except KeyError:
+            # no thumbnail
+            return thumbs
+
+        # scan for images
+        for name, ds in grp.items():
+            # an image? (== has the attribute CLASS: IMAGE)
+            if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == b"IMAGE":
+                try:
+                    md = _read_image_dataset_md(ds)
+                except Exception:
+                    logging.info("Skipping image '%s' which couldn't be read.", name)
+                    continue
+
+                if name == "Image":
+                    try:
+                        md = _read_image_info(grp)
+                    except Exception:
+                        logging.debug("Failed to parse metadata of acquisition '%s'", name)
+                        continue
+
+                thumbs.append(DataArrayShadowHDF5(ds, md))
+
+        return thumbs
+
+
 def convert_to_str(s: Union[bytes, str]) -> str:
     """
     Make sure we can read both bytes (HDF5 ascii) and string (HDF5 utf8) metadata
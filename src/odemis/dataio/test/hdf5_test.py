@@ -492,6 +492,200 @@ class TestHDF5IO(unittest.TestCase):
         self.assertEqual(im[blue[::-1]].tolist(), [0, 0, 255])
         self.assertAlmostEqual(im.metadata[model.MD_POS], thumbnail.metadata[model.MD_POS])
 
+    def testExportChunked(self):
+        """
+        Checks the compressed data is chunked according to the dimensions
+        """
+        dtype = numpy.dtype("uint16")
+        wl_list = list(numpy.linspace(400e-9, 700e-9, 512))
+        spec = model.DataArray(numpy.random.randint(0, 1000, (512, 1, 1, 50, 70)).astype(dtype),
+                               {model.MD_WL_LIST: wl_list,
+                                model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+        sem = model.DataArray(numpy.random.randint(0, 1000, (1000, 1200)).astype(dtype))
+
+        startt = time.time()
+        hdf5.export(FILENAME, [spec, sem])
+        logging.info("Export took %g s", time.time() - startt)
+
+        f = h5py.File(FILENAME, "r")
+        # spectrum: all the wavelengths of a pixel are in the same chunk
+        chunks = f["Acquisition0/ImageData/Image"].chunks
+        self.assertEqual(chunks[0], spec.shape[0])
+        self.assertLessEqual(numpy.prod(chunks) * dtype.itemsize, 2 * hdf5.CHUNK_SIZE)
+        # greyscale image: square tiles
+        chunks = f["Acquisition1/ImageData/Image"].chunks
+        self.assertEqual(chunks[:3], (1, 1, 1))
+        self.assertEqual(chunks[3], chunks[4])
+        f.close()
+
+        rdata = hdf5.read_data(FILENAME)
+        numpy.testing.assert_array_equal(rdata[0], spec)
+        numpy.testing.assert_array_equal(rdata[1][0, 0, 0], sem)
+
+    def testChunkShape(self):
+        # Spectrum cube too large to fit one pixel in a chunk
+        chunks = hdf5.get_chunk_shape((2048, 2048, 1, 10, 10), numpy.float32, "CTZYX")
+        self.assertLessEqual(numpy.prod(chunks) * 4, hdf5.CHUNK_SIZE)
+        self.assertEqual(chunks[2:], (1, 1, 1))
+
+        # RGB
+        chunks = hdf5.get_chunk_shape((3, 1000, 1000), numpy.uint8, "CYX")
+        self.assertEqual(chunks[0], 3)
+
+        # Smaller than the chunk size
+        chunks = hdf5.get_chunk_shape((1, 1, 1, 20, 30), numpy.uint8, "CTZYX")
+        self.assertEqual(chunks, (1, 1, 1, 20, 30))
+
+    def testWriter(self):
+        """
+        Checks writing the data pixel per pixel gives the same file as export()
+        """
+        dtype = numpy.dtype("uint16")
+        wl_list = list(numpy.linspace(400e-9, 700e-9, 256))
+        md = {model.MD_WL_LIST: wl_list,
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, -2e-3),
+              model.MD_DIMS: "CTZYX",
+              model.MD_DESCRIPTION: "Spectrum"}
+        spec = model.DataArray(numpy.random.randint(0, 1000, (256, 1, 1, 20, 30)).astype(dtype), md)
+        sem = model.DataArray(numpy.random.randint(0, 1000, (200, 300)).astype(dtype),
+                              {model.MD_PIXEL_SIZE: (1e-7, 1e-7),
+                               model.MD_POS: (1e-3, -2e-3),
+                               model.MD_DESCRIPTION: "SEM"})
+
+        writer = hdf5.open_writer(FILENAME)
+        n = writer.add_image(spec.shape, dtype, {model.MD_DESCRIPTION: "Temporary"})
+        for px_idx in numpy.ndindex(*spec.shape[-2:]):
+            writer.append(n, spec[:, 0, 0, px_idx[0], px_idx[1]].reshape(-1, 1, 1), px_idx)
+        # Blocks of several pixels are also accepted
+        writer.append(n, spec[..., 10:20, 5:25], (10, 5))
+        writer.add_data(sem)
+        with self.assertRaises(IndexError):
+            writer.append(n, spec[..., 10:20, 20:30], (15, 20))
+        writer.finalize({n: md})
+
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), 2)
+        numpy.testing.assert_array_equal(rdata[0], spec)
+        self.assertEqual(rdata[0].metadata[model.MD_DESCRIPTION], "Spectrum")
+        numpy.testing.assert_almost_equal(rdata[0].metadata[model.MD_WL_LIST], wl_list)
+        self.assertEqual(rdata[0].metadata[model.MD_POS], md[model.MD_POS])
+        numpy.testing.assert_array_equal(rdata[1][0, 0, 0], sem)
+        self.assertEqual(rdata[1].metadata[model.MD_DESCRIPTION], "SEM")
+
+        f = h5py.File(FILENAME, "r")
+        ds = f["Acquisition0/ImageData/Image"]
+        self.assertEqual(ds.chunks[0], spec.shape[0])
+        self.assertEqual(list(ds.attrs["IMAGE_MINMAXRANGE"]), [spec.min(), spec.max()])
+        f.close()
+
+    def testWriterInterrupted(self):
+        """
+        Checks the data written so far can be read, if the writer stops before finalize()
+        """
+        dtype = numpy.dtype("uint16")
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, -2e-3),
+              model.MD_WL_LIST: list(numpy.linspace(400e-9, 700e-9, 16)),
+              model.MD_DESCRIPTION: "Spectrum"}
+        spec = numpy.random.randint(1, 1000, (16, 1, 1, 20, 30)).astype(dtype)
+
+        writer = hdf5.open_writer(FILENAME)
+        n = writer.add_image(spec.shape, dtype, md)
+        for y in range(5):
+            writer.append(n, spec[..., y:y + 1, :], (y, 0))
+        writer.flush()
+        # Simulate a crash, by copying the file as it is now on disk
+        crash_fn = "crash-" + FILENAME
+        with open(FILENAME, "rb") as f, open(crash_fn, "wb") as fc:
+            fc.write(f.read())
+        self.addCleanup(os.remove, crash_fn)
+        writer.close()
+
+        rdata = hdf5.read_data(crash_fn)
+        self.assertEqual(len(rdata), 1)
+        self.assertEqual(rdata[0].metadata[model.MD_DESCRIPTION], "Spectrum")
+        self.assertEqual(rdata[0].metadata[model.MD_POS], md[model.MD_POS])
+        numpy.testing.assert_array_equal(rdata[0][..., :5, :], spec[..., :5, :])
+        self.assertFalse(rdata[0][..., 5:, :].any())
+
+    def testWriterOrder(self):
+        """
+        Checks the images are read back in the order they were written, even with
+        more than 10 images
+        """
+        writer = hdf5.open_writer(FILENAME)
+        for i in range(12):
+            im = model.DataArray(numpy.full((2, 3), i, dtype=numpy.uint16),
+                                 {model.MD_DESCRIPTION: "Image %d" % i})
+            writer.add_data(im)
+        writer.finalize()
+
+        for data in (hdf5.read_data(FILENAME), hdf5.open_data(FILENAME).content):
+            self.assertEqual(len(data), 12)
+            for i, d in enumerate(data):
+                self.assertEqual(d.metadata[model.MD_DESCRIPTION], "Image %d" % i)
+
+    def testOpenData(self):
+        """
+        Checks that the data can be opened lazily, and read per part
+        """
+        # A greyscale image (compressed, so it's chunked), and a spectrum cube
+        size = (1000, 700)
+        dtype = numpy.dtype("uint16")
+        sem = model.DataArray(numpy.arange(size[0] * size[1], dtype=dtype).reshape(size[::-1]),
+                              {model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                               model.MD_POS: (1e-3, 2e-3),
+                               model.MD_DESCRIPTION: "sem"})
+        wl_list = list(numpy.linspace(400e-9, 700e-9, 50))
+        spec = model.DataArray(numpy.random.randint(0, 1000, (50, 1, 1, 30, 40)).astype(dtype),
+                               {model.MD_WL_LIST: wl_list,
+                                model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+        # thumbnail : small RGB completely red
+        tshape = (size[1] // 8, size[0] // 8, 3)
+        thumbnail = model.DataArray(numpy.zeros(tshape, numpy.uint8))
+        thumbnail[:, :, 0] += 255  # red
+
+        hdf5.export(FILENAME, [sem, spec], thumbnail)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 2)
+        self.assertEqual(len(acd.thumbnails), 1)
+
+        # Same data as read_data()
+        rdata = hdf5.read_data(FILENAME)
+        for das, da in zip(acd.content, rdata):
+            self.assertIsInstance(das, model.DataArrayShadow)
+            im = das.getData()
+            self.assertEqual(im.shape, das.shape)
+            numpy.testing.assert_array_equal(im.reshape(da.shape), da)
+
+        # The 2D image is presented as 2D, and can be read per tile
+        sdas = acd.content[0]
+        self.assertEqual(sdas.shape, size[::-1])
+        self.assertEqual(sdas.maxzoom, 0)
+        tw, th = sdas.tile_shape
+        tile = sdas.getTile(1, 1, 0)
+        numpy.testing.assert_array_equal(tile, sem[th:2 * th, tw:2 * tw])
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], sem.metadata[model.MD_PIXEL_SIZE])
+        # Center of the tile is at the right and top of the center of the image
+        self.assertGreater(tile.metadata[model.MD_POS][0], sem.metadata[model.MD_POS][0])
+        self.assertLess(tile.metadata[model.MD_POS][1], sem.metadata[model.MD_POS][1])
+        # Last tile is smaller
+        tile = sdas.getTile((size[0] - 1) // tw, (size[1] - 1) // th, 0)
+        self.assertEqual(tile.shape, ((size[1] - 1) % th + 1, (size[0] - 1) % tw + 1))
+
+        # The spectrum cube can be read per pixel
+        cdas = acd.content[1]
+        self.assertEqual(cdas.shape, spec.shape)
+        self.assertFalse(hasattr(cdas, "maxzoom"))
+        self.assertEqual(cdas.metadata[model.MD_WL_LIST], wl_list)
+        numpy.testing.assert_array_equal(cdas[:, 0, 0, 5, 7], spec[:, 0, 0, 5, 7])
+
+        im = acd.thumbnails[0].getData()
+        self.assertEqual(im.shape, tshape)
+        self.assertEqual(im[0, 0].tolist(), [255, 0, 0])
+
     def testReadAndSaveMDSpec(self):
         """
         Checks that we can save and read back the metadata of a spectrum image.
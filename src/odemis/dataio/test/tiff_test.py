@@ -32,6 +32,7 @@ from odemis.dataio import tiff
 from odemis.util import img
 import os
 import re
+import tempfile
 import time
 import unittest
 from unittest.case import skip
@@ -1939,12 +1940,70 @@ class TestTiffIO(unittest.TestCase):
         # read the subimage
         subimage = im.read_image()
         self.assertEqual(subimage.shape, (147, 128))
-        # Checking the values in the corner of the tile. The downsampling uses
-        # the neighbour pixels to calculate a pixel in the resized image.
-        self.assertEqual(subimage[0][0], 130)
-        self.assertEqual(subimage[0][-1], 385)
-        self.assertEqual(subimage[-1][0], 9893)
-        self.assertEqual(subimage[-1][-1], 10148)
+        # Checking the values in the corner of the tile. The downsampling
+        # averages each 2x2 pixels (the last odd row/column is dropped).
+        self.assertEqual(subimage[0][0], 129)
+        self.assertEqual(subimage[0][-1], 383)
+        self.assertEqual(subimage[-1][0], 9637)
+        self.assertEqual(subimage[-1][-1], 9891)
+
+    def testExportPyramidLevels(self):
+        """
+        Checks each zoom level is the 2x2 binning of the previous one
+        """
+        for dtype in (numpy.uint16, numpy.int16, numpy.float32):
+            arr = numpy.random.randint(-1000, 1000, (1100, 1500)).astype(dtype)
+            if dtype == numpy.uint16:
+                arr += 1000
+            data = model.DataArray(arr)
+
+            startt = time.time()
+            tiff.export(FILENAME, data, pyramid=True)
+            logging.info("Export of %s took %g s", dtype, time.time() - startt)
+
+            im = libtiff.TIFF.open(FILENAME)
+            numpy.testing.assert_array_equal(im.read_image(), arr)
+            sub_ifds = im.GetField(T.TIFFTAG_SUBIFD)
+            self.assertEqual(len(sub_ifds), 3)
+            prev = arr.astype(numpy.float64)
+            for sub_ifd in sub_ifds:
+                im.SetSubDirectory(sub_ifd)
+                subim = im.read_image()
+                self.assertEqual(subim.dtype, dtype)
+                h, w = prev.shape[0] // 2, prev.shape[1] // 2
+                self.assertEqual(subim.shape, (h, w))
+                exp = prev[:h * 2, :w * 2].reshape(h, 2, w, 2).mean(axis=(1, 3))
+                numpy.testing.assert_allclose(subim, exp, atol=0.5)
+                prev = subim.astype(numpy.float64)
+            im.close()
+
+    def testExportMemmapPyramid(self):
+        """
+        Checks a memory-mapped image is exported the same way as an image in memory
+        """
+        arr = numpy.random.randint(0, 4000, (700, 900)).astype(numpy.uint16)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mm = numpy.lib.format.open_memmap(os.path.join(tmpdir, "image.npy"), mode="w+",
+                                              dtype=arr.dtype, shape=arr.shape)
+            mm[...] = arr
+            self.assertTrue(tiff._is_memory_mapped(model.DataArray(mm)))
+            self.assertFalse(tiff._is_memory_mapped(model.DataArray(arr)))
+            tiff.export(FILENAME, model.DataArray(mm), pyramid=True)
+            del mm
+
+        im = libtiff.TIFF.open(FILENAME)
+        numpy.testing.assert_array_equal(im.read_image(), arr)
+        sub_ifds = im.GetField(T.TIFFTAG_SUBIFD)
+        self.assertEqual(len(sub_ifds), 2)
+        prev = arr.astype(numpy.float64)
+        for sub_ifd in sub_ifds:
+            im.SetSubDirectory(sub_ifd)
+            subim = im.read_image()
+            h, w = prev.shape[0] // 2, prev.shape[1] // 2
+            exp = prev[:h * 2, :w * 2].reshape(h, 2, w, 2).mean(axis=(1, 3))
+            numpy.testing.assert_allclose(subim, exp, atol=0.5)
+            prev = subim.astype(numpy.float64)
+        im.close()
 
     def testExportThinPyramid(self):
         """
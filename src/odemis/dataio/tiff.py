@@ -20,12 +20,16 @@ You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 import calendar
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import contextlib
 from datetime import datetime
 import json
 from libtiff import TIFF
 import logging
 import math
+import mmap
 import numpy
 from odemis import model, util
 import odemis
@@ -36,9 +40,11 @@ import operator
 import os
 import re
 import sys
+import tempfile
 import threading
 import time
 import uuid
+import zlib
 
 import libtiff.libtiff_ctypes as T  # for the constant names
 import xml.etree.ElementTree as ET
@@ -65,6 +71,7 @@ STIFF_SPLIT = ".0."  # pattern to replace with the "stiff" multiple file
 
 CAN_SAVE_PYRAMID = True # indicates the support for pyramidal export
 TILE_SIZE = 256 # Tile size of pyramidal images
+DEFLATE_LEVEL = 6  # zlib compression level of the tiles of pyramidal images
 LOSSY = False
 
 # We try to make it as much as possible looking like a normal (multi-page) TIFF,
@@ -1960,6 +1967,153 @@ def _genResizedShapes(data):
     return resized_shapes
 
 
+def _is_memory_mapped(arr):
+    """
+    arr (numpy.ndarray): an array, or a view on an array
+    return (bool): True if the data of the array is memory-mapped from a file
+    """
+    while arr is not None:
+        if isinstance(arr, (numpy.memmap, mmap.mmap)):
+            return True
+        arr = getattr(arr, "base", None)
+    return False
+
+
+def _downsample_tile(src, dst, ys, xs):
+    """
+    Compute a region of an image as the 2x2 binning of a larger image.
+    src (numpy.ndarray): the image at the larger scale, 2D (YX) or 3D (YXC).
+    dst (numpy.ndarray): the image to update, with YX half the size of src
+      (rounded down).
+    ys (slice): the rows of dst to compute
+    xs (slice): the columns of dst to compute
+    """
+    sy = slice(ys.start * 2, ys.stop * 2, 2)
+    sy1 = slice(ys.start * 2 + 1, ys.stop * 2, 2)
+    sx = slice(xs.start * 2, xs.stop * 2, 2)
+    sx1 = slice(xs.start * 2 + 1, xs.stop * 2, 2)
+    acc = src[sy, sx].astype(util.get_best_dtype_for_acc(src.dtype, 4))
+    acc += src[sy1, sx]
+    acc += src[sy, sx1]
+    acc += src[sy1, sx1]
+    if dst.dtype.kind in "ui":
+        dst[ys, xs] = (acc + 2) // 4  # round to nearest
+    else:
+        dst[ys, xs] = acc / 4
+
+
+def _encode_tile(arr, y, x, compression, src=None):
+    """
+    Prepare a tile to be written as-is (raw) in a TIFF file.
+    arr (numpy.ndarray): the whole image, 2D (YX) or 3D (YXC)
+    y (int): position of the first row of the tile
+    x (int): position of the first column of the tile
+    compression (int): COMPRESSION_NONE or COMPRESSION_ADOBE_DEFLATE
+    src (None or numpy.ndarray): if not None, the tile of arr is first computed
+      by binning this image (which has twice the size of arr).
+    return (bytes): the encoded tile
+    """
+    h = min(TILE_SIZE, arr.shape[0] - y)
+    w = min(TILE_SIZE, arr.shape[1] - x)
+    if src is not None:
+        _downsample_tile(src, arr, slice(y, y + h), slice(x, x + w))
+
+    # If the tile is over the edge of the image, fill with 0
+    tile = numpy.zeros((TILE_SIZE, TILE_SIZE) + arr.shape[2:], dtype=arr.dtype)
+    tile[:h, :w] = arr[y:y + h, x:x + w]
+    if compression == T.COMPRESSION_NONE:
+        return tile.tobytes()
+
+    if tile.dtype.kind in "ui":
+        # Horizontal predictor (each sample - same sample of the previous pixel)
+        tile[:, 1:] -= tile[:, :-1].copy()
+    # zlib releases the GIL, so this can run in parallel
+    return zlib.compress(tile, DEFLATE_LEVEL)
+
+
+def _write_tiles(f, executor, arr, compression, write_rgb, src=None):
+    """
+    Write an image as a tiled TIFF directory. The tiles are encoded in parallel.
+    f (libtiff file handle): Handle of a TIFF file
+    executor (ThreadPoolExecutor): the pool to run the encoding
+    arr (numpy.ndarray): the image to write, 2D (YX) or 3D for RGB (YXC or CYX)
+    compression (int): COMPRESSION_NONE or COMPRESSION_ADOBE_DEFLATE
+    write_rgb (boolean): True if the image is RGB, False if the image is grayscale
+    src (None or numpy.ndarray): if not None, the content of arr is computed
+      while writing, by binning this image (which has twice the size of arr).
+    """
+    if arr.dtype.kind == "f":
+        sample_format = T.SAMPLEFORMAT_IEEEFP
+    elif arr.dtype.kind in "ub":
+        sample_format = T.SAMPLEFORMAT_UINT
+    elif arr.dtype.kind == "i":
+        sample_format = T.SAMPLEFORMAT_INT
+    else:
+        raise NotImplementedError("Cannot write tiles of type %s" % (arr.dtype,))
+
+    f.SetField(T.TIFFTAG_COMPRESSION, compression)
+    if compression != T.COMPRESSION_NONE and arr.dtype.kind in "ui":
+        f.SetField(T.TIFFTAG_PREDICTOR, T.PREDICTOR_HORIZONTAL)
+    f.SetField(T.TIFFTAG_BITSPERSAMPLE, arr.itemsize * 8)
+    f.SetField(T.TIFFTAG_SAMPLEFORMAT, sample_format)
+    f.SetField(T.TIFFTAG_ORIENTATION, T.ORIENTATION_TOPLEFT)
+    f.SetField(T.TIFFTAG_TILEWIDTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_TILELENGTH, TILE_SIZE)
+
+    # Each plane is a 2D (YX) or 3D (YXC) array
+    if arr.ndim == 2:
+        planes = [(arr, src)]
+        f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_MINISBLACK)
+        f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+    elif arr.ndim == 3 and write_rgb:
+        if arr.shape[2] in (3, 4):  # YXC
+            planar_config = T.PLANARCONFIG_CONTIG
+            depth = arr.shape[2]
+            planes = [(arr, src)]
+        else:  # CYX
+            planar_config = T.PLANARCONFIG_SEPARATE
+            depth = arr.shape[0]
+            planes = [(arr[i], None if src is None else src[i]) for i in range(depth)]
+        f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_RGB)
+        f.SetField(T.TIFFTAG_SAMPLESPERPIXEL, depth)
+        f.SetField(T.TIFFTAG_PLANARCONFIG, planar_config)
+        if depth == 4:  # RGBA
+            f.SetField(T.TIFFTAG_EXTRASAMPLES, [T.EXTRASAMPLE_UNASSALPHA], count=1)
+        elif depth > 4:  # No idea...
+            f.SetField(T.TIFFTAG_EXTRASAMPLES, [T.EXTRASAMPLE_UNSPECIFIED] * (depth - 3),
+                       count=(depth - 3))
+    else:
+        raise NotImplementedError("Cannot write tiles of shape %s" % (arr.shape,))
+
+    height, width = planes[0][0].shape[:2]
+    f.SetField(T.TIFFTAG_IMAGEWIDTH, width)
+    f.SetField(T.TIFFTAG_IMAGELENGTH, height)
+
+    # The tiles are numbered by plane, then row, then column, which is also
+    # the order in which they are submitted.
+    positions = ((p, y, x) for p in planes
+                 for y in range(0, height, TILE_SIZE)
+                 for x in range(0, width, TILE_SIZE))
+    # Limit the number of encoded tiles waiting to be written, to keep the
+    # memory usage low. The tiles are written in order, from this thread, as
+    # libtiff doesn't support writing in parallel.
+    maxqueue = (os.cpu_count() or 1) * 2
+    queue = deque()
+    tile_idx = 0
+    for (parr, psrc), y, x in positions:
+        queue.append(executor.submit(_encode_tile, parr, y, x, compression, psrc))
+        while len(queue) > maxqueue or (queue and queue[0].done()):
+            buf = queue.popleft().result()
+            T.libtiff.TIFFWriteRawTile(f, tile_idx, buf, len(buf))
+            tile_idx += 1
+    while queue:
+        buf = queue.popleft().result()
+        T.libtiff.TIFFWriteRawTile(f, tile_idx, buf, len(buf))
+        tile_idx += 1
+
+    f.WriteDirectory()
+
+
 def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
     """
     f (libtiff file handle): Handle of a TIFF file
@@ -1978,6 +2132,13 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
     # https://docs.openmicroscopy.org/ome-model/6.0.1/ome-tiff/specification.html#sub-resolutions
     # (It should be very similar to the current implementation)
 
+    # The tiles are compressed with deflate, instead of the requested compression
+    # (typically LZW), because zlib can run in parallel, outside of libtiff.
+    if compression is None:
+        compression = T.COMPRESSION_NONE
+    else:
+        compression = T.COMPRESSION_ADOBE_DEFLATE
+
     # generate the sizes of the zoom levels to be generated and saved
     resized_shapes = _genResizedShapes(arr)
 
@@ -1987,17 +2148,26 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
         # when this tag is present.
         f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
 
-    # write the original image
-    f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
-    # generate the rescaled images and write the tiled image
-    for resized_shape in resized_shapes:
-        # rescale the image
-        subim = img.rescale_hq(arr, resized_shape)
-
-        # Before writting the actual data, we set the special metadata
-        f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
-        # write the tiled image to the TIFF file
-        f.write_tiles(subim, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+    # If the image is too big to be in memory (and so it's mapped from a file),
+    # the zoom levels are also stored in (temporary) files.
+    on_disk = _is_memory_mapped(arr)
+    arr = numpy.asarray(arr)
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        # write the original image
+        _write_tiles(f, executor, arr, compression, write_rgb)
+        # Each zoom level is computed from the previous one, by binning 2x2
+        # pixels, while writing it.
+        prev = arr
+        for resized_shape in resized_shapes:
+            if on_disk:
+                with tempfile.TemporaryFile() as tf:
+                    subim = numpy.memmap(tf, dtype=arr.dtype, mode="w+", shape=resized_shape)
+            else:
+                subim = numpy.empty(resized_shape, dtype=arr.dtype)
+            # Before writting the actual data, we set the special metadata
+            f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+            _write_tiles(f, executor, subim, compression, write_rgb, src=prev)
+            prev = subim
 
 
 def export(filename, data, thumbnail=None, compressed=True, multiple_files=False, pyramid=False):
@@ -2213,8 +2383,34 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
 
         tile_shape = (num_tcols, num_trows)
 
+        # Each thread reading tiles opens its own handle on the file, so that
+        # the tiles can be read (and decoded) simultaneously.
+        self._thread_files = threading.local()
+
         DataArrayShadow.__init__(self, shape, dtype, metadata, maxzoom, tile_shape)
 
+    def _getThreadFile(self, tiff_info):
+        """
+        Get the handle on the TIFF file dedicated to the current thread
+        tiff_info (dict): information about the source tiff file
+        return (None or TIFF): the handle, or None if the file couldn't be
+          opened again (in which case, the shared handle should be used)
+        """
+        tiff_file = getattr(self._thread_files, "handle", None)
+        if tiff_file is None:
+            try:
+                with tiff_info['lock']:
+                    filename = tiff_info['handle'].FileName()
+                if isinstance(filename, bytes):
+                    filename = filename.decode(sys.getfilesystemencoding())
+                tiff_file = TIFF.open(filename, mode='r')
+            except Exception as ex:
+                logging.info("Failed to open the TIFF file again, will read the tiles sequentially: %s", ex)
+                tiff_file = False
+            # It'll be automatically closed when the thread or this object is gone
+            self._thread_files.handle = tiff_file
+        return tiff_file or None
+
     def getTile(self, x, y, zoom):
         '''
         Fetches one tile
@@ -2231,8 +2427,14 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
             # It is the case when the DataArray has multiple pixelData (eg, when data has more than 2D).
             raise NotImplementedError("DataArray has multiple pixelData")
 
-        with tiff_info['lock']:
+        tiff_file = self._getThreadFile(tiff_info)
+        if tiff_file is None:  # Use the shared handle
+            lock = tiff_info['lock']
             tiff_file = tiff_info['handle']
+        else:  # Only used by this thread => no need to lock
+            lock = contextlib.nullcontext()
+
+        with lock:
             tiff_file.SetDirectory(tiff_info['dir_index'])
 
             if zoom != 0:
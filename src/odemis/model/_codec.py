@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+# Lossless compression of arrays, used to send the DataArrays of the DataFlows
+# over the network.
+# The bytes of the array are first "shuffled" (all the first bytes of each
+# element, then all the second bytes...), which groups together the bytes which
+# change slowly, and makes the compression much more efficient on images.
+
+import logging
+import numpy
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+if not lz4 and not zstandard:
+    logging.info("lz4 and zstandard modules not available, data compression will be slow")
+
+# codec name -> (compress function, decompress function)
+_CODECS = {
+    "zlib": (lambda b: zlib.compress(b, 1), zlib.decompress),
+}
+if lz4:
+    _CODECS["lz4"] = (lambda b: lz4.frame.compress(b, compression_level=0),
+                      lz4.frame.decompress)
+if zstandard:
+    # The (de)compressor objects are not thread-safe, so create a new one every time
+    _CODECS["zstd"] = (lambda b: zstandard.ZstdCompressor(level=1).compress(b),
+                       lambda b: zstandard.ZstdDecompressor().decompress(b))
+
+# Order of preference for each kind of dtype. lz4 is the fastest, which is the
+# most important for integers (ie, camera images). zstd compresses better the
+# floats, which are typically noisier.
+_PREFERENCES = {
+    "i": ("lz4", "zstd", "zlib"),
+    "u": ("lz4", "zstd", "zlib"),
+    "f": ("zstd", "lz4", "zlib"),
+}
+_DEFAULT_PREFERENCE = ("zstd", "lz4", "zlib")
+
+
+def get_codecs():
+    """
+    return (list of str): names of the codecs available
+    """
+    return list(_CODECS.keys())
+
+
+def choose_codec(dtype, codecs):
+    """
+    Pick the best codec for a given type of data
+    dtype (numpy.dtype): type of the data to compress
+    codecs (list of set of str): the codecs supported by each receiver
+    return (str): name of the codec, which is available locally and supported
+      by all the receivers
+    raise LookupError: if no codec is supported by all the receivers
+    """
+    for c in _PREFERENCES.get(numpy.dtype(dtype).kind, _DEFAULT_PREFERENCE):
+        if c in _CODECS and all(c in rc for rc in codecs):
+            return c
+    raise LookupError("No common codec found among %s" % (codecs,))
+
+
+def compress(data, codec):
+    """
+    data (numpy.ndarray): the array to compress. It may be non-contiguous.
+    codec (str): name of the codec to use
+    return (bytes): the compressed data
+    """
+    data = numpy.ascontiguousarray(data)
+    if data.itemsize > 1:
+        # Shuffle: transpose the bytes
+        buf = data.view(numpy.uint8).reshape(-1, data.itemsize).T.tobytes()
+    else:
+        buf = memoryview(data).cast("B")
+    return _CODECS[codec][0](buf)
+
+
+def decompress(buf, codec, dtype, shape):
+    """
+    buf (buffer): the data, as compressed by compress()
+    codec (str): name of the codec used
+    dtype (str or numpy.dtype): the type of the array
+    shape (tuple of int): the shape of the array
+    return (numpy.ndarray): the original array
+    """
+    dtype = numpy.dtype(dtype)
+    raw = numpy.frombuffer(_CODECS[codec][1](buf), dtype=numpy.uint8)
+    if dtype.itemsize > 1:
+        # Unshuffle (and make it C contiguous)
+        raw = numpy.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T)
+    return raw.view(dtype).reshape(shape)
@@ -94,6 +94,28 @@ def getEvents(component):
     return dict(evts)
 
 
+def getVASnapshot(va):
+    """
+    va (VigilantAttributeBase): the VA to describe
+    returns (dict str -> value): "value", "unit", "readonly", and if the VA has
+      them "range" and "choices". If the value cannot be read, "value" is
+      missing.
+    """
+    snapshot = {"unit": va.unit, "readonly": va.readonly}
+    try:
+        snapshot["value"] = va.value
+    except Exception:
+        logging.warning("Failed to read the value of VA %s", va, exc_info=True)
+
+    # Only some VAs have range or choices, and the only way to know is to try
+    for attr in ("range", "choices"):
+        try:
+            snapshot[attr] = getattr(va, attr)
+        except AttributeError:
+            pass
+    return snapshot
+
+
 class ComponentBase(metaclass=ABCMeta):
     """Abstract class for a component"""
 
@@ -147,6 +169,34 @@ class Component(ComponentBase):
                 _vattributes.dump_vigilant_attributes(self),
                 _dataflow.dump_events(self))
 
+    def _getsnapshot(self):
+        """
+        Describe the current state of all the attributes of the component, so
+        that a client can get everything in a single call.
+        It must already be registered to a Pyro daemon.
+        return (dict str -> value):
+          "roattributes" (dict str -> value): name -> value of the roattributes
+          "vas" (dict str -> dict): name of the VA -> "value", "unit",
+            "readonly", and if the VA has them "range" and "choices"
+          "dataflows" (dict str -> str): name of the DataFlow -> its URI
+          "metadata" (dict str -> value): the metadata, if the component has any
+        """
+        daemon = self._pyroDaemon
+        vas = {}
+        for name, va in _vattributes.dump_vigilant_attributes(self).items():
+            vas[name] = getVASnapshot(va)
+
+        dataflows = {name: str(daemon.uriFor(df))
+                     for name, df in _dataflow.dump_dataflows(self).items()}
+
+        snapshot = {"roattributes": _core.dump_roattributes(self),
+                    "vas": vas,
+                    "dataflows": dataflows,
+                    }
+        if hasattr(self, "getMetadata"):
+            snapshot["metadata"] = self.getMetadata()
+        return snapshot
+
     def __str__(self):
         try:
             return "%s '%s'" % (self.__class__.__name__, self.name)
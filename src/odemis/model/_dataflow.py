@@ -24,17 +24,27 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 # losslessly and with metadata attached (see _metadata for the conventional ones).
 
 import Pyro4
+import collections
 import logging
 import numpy
 from odemis.model import _metadata
 from odemis.util import inspect_getmembers
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
+import socket
 import threading
 import time
 import zmq
 
-from . import _core
+from . import _codec, _core, _shm
+
+# How the DataFlowProxies receive the data: "ipc", "tcp", or "auto". "auto"
+# uses TCP only if the IPC socket of the DataFlow is not accessible (ie, the
+# DataFlow is on another computer). The data sent via TCP is compressed.
+DATAFLOW_TRANSPORT = os.environ.get("ODEMIS_DATAFLOW_TRANSPORT", "auto")
+# Network interface (IP address) on which the data is sent via TCP. By default,
+# only the local computer can receive it. Use "*" to accept all the interfaces.
+DATAFLOW_TCP_INTERFACE = os.environ.get("ODEMIS_DATAFLOW_TCP_INTERFACE", "127.0.0.1")
 
 
 class DataArray(numpy.ndarray):
@@ -93,6 +103,88 @@ class DataArray(numpy.ndarray):
     #     return numpy.ndarray.__array_wrap__(self, out_arr, context)
 
 
+class ListenerQueue(object):
+    """
+    Delivers the data to one listener of a DataFlow, from a separate thread,
+    so that a slow listener doesn't block the generation of the data (nor the
+    other listeners). When the listener is too slow, the oldest data is
+    discarded, according to the maximum length of the queue.
+    """
+
+    def __init__(self, dataflow, listener, max_queue):
+        """
+        dataflow (DataFlowBase): the dataflow which sends the data
+        listener (WeakMethod): the callback
+        max_queue (0 <= int): maximum number of data waiting to be delivered.
+          1 means only the latest data is delivered, 0 means no data is ever
+          discarded (dangerous if the listener is slower than the generator).
+        """
+        self._dataflow = dataflow
+        self._listener = listener
+        self.max_queue = max_queue
+        self._queue = collections.deque(maxlen=max_queue or None)
+        self._cond = threading.Condition()
+        self._must_stop = False
+        self.dropped = 0  # number of data discarded
+        self.delivered = 0  # number of data passed to the listener
+
+        self._thread = threading.Thread(target=self._run,
+                                        name="DataFlow listener queue %r" % (listener,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, data):
+        with self._cond:
+            if self.max_queue and len(self._queue) == self.max_queue:
+                self.dropped += 1  # The deque automatically drops the oldest one
+            self._queue.append(data)
+            self._cond.notify()
+
+    def stop(self):
+        """
+        Stop delivering data (the data still in the queue is discarded).
+        Doesn't wait for the current delivery to be over.
+        """
+        with self._cond:
+            self._must_stop = True
+            self._queue.clear()
+            self._cond.notify()
+
+    def get_stats(self):
+        """
+        return (dict str -> int): max_queue, queued (number of data waiting),
+          dropped, delivered
+        """
+        return {"max_queue": self.max_queue,
+                "queued": len(self._queue),
+                "dropped": self.dropped,
+                "delivered": self.delivered}
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._queue and not self._must_stop:
+                        self._cond.wait()
+                    if self._must_stop:
+                        return
+                    data = self._queue.popleft()
+
+                try:
+                    self._listener(self._dataflow, data)
+                except WeakRefLostError:
+                    # Same as when notified directly, so that the generation
+                    # is stopped if it was the last listener
+                    self._dataflow.unsubscribe(self._listener)
+                    return
+                except Exception:
+                    logging.exception("Exception when notifying a data_flow")
+                self.delivered += 1
+                del data  # Don't hold it while waiting
+        finally:
+            self._dataflow = None
+
+
 class DataFlowBase(object):
     """
     This is an abstract class that must be extended by each detector which
@@ -103,6 +195,7 @@ class DataFlowBase(object):
     """
     def __init__(self):
         self._listeners = set()
+        self._queues = {}  # WeakMethod -> ListenerQueue, for the listeners with a queue
         self._lock = threading.RLock()  # need to be acquired to modify the set
 
     # to be overridden
@@ -111,37 +204,87 @@ class DataFlowBase(object):
 #        # TODO timeout argument?
 #        pass
 
-    def subscribe(self, listener):
+    def subscribe(self, listener, max_queue=None):
         """
         Register a callback function to be called when the ActiveValue is
         listener (function): callback function which takes as arguments
            dataflow (this object) and data (the new data array)
+        max_queue (None or 0 <= int): how to deliver the data if the listener is
+          slower than the generator. If None, the listener is called directly
+          by the generator (and for remote dataflows, data is discarded
+          according to .max_discard). Otherwise, the listener is called from
+          a separate thread, with at most max_queue data waiting (the oldest
+          data is discarded first). 1 means only the latest data is delivered,
+          and 0 that all the data is delivered.
         """
         # TODO update rate argument to indicate how often we need an update?
         assert callable(listener)
 
         with self._lock:
             count_before = len(self._listeners)
-            self._listeners.add(WeakMethod(listener))
+            self._add_listener(listener, max_queue)
             logging.debug("Listener %r subscribed, now %d subscribers", listener, len(self._listeners))
             if count_before == 0:
                 try:
                     self.start_generate()
                 except Exception as ex:
                     logging.error("Subscribing listener %r to the dataflow failed. %s", listener, ex)
-                    self._listeners.discard(WeakMethod(listener))
+                    self._remove_listener(WeakMethod(listener))
                     logging.debug("Listener %r unsubscribed, now %d subscribers", listener, len(self._listeners))
                     raise
 
     def unsubscribe(self, listener):
         with self._lock:
             count_before = len(self._listeners)
-            self._listeners.discard(WeakMethod(listener))
+            self._remove_listener(WeakMethod(listener))
             count_after = len(self._listeners)
             logging.debug("Listener %r unsubscribed, now %d subscribers", listener, count_after)
             if count_before > 0 and count_after == 0:
                 self.stop_generate()
 
+    def _add_listener(self, listener, max_queue):
+        """
+        listener (callable)
+        max_queue (None or 0 <= int): see subscribe()
+        """
+        if max_queue is not None and max_queue < 0:
+            raise ValueError("max_queue must be positive, but got %s" % (max_queue,))
+
+        wlistener = WeakMethod(listener)
+        queue = self._queues.pop(wlistener, None)
+        if queue:  # Already subscribed => update the queue
+            queue.stop()
+        self._listeners.add(wlistener)
+        if max_queue is not None:
+            self._queues[wlistener] = ListenerQueue(self, wlistener, max_queue)
+
+    def _remove_listener(self, wlistener):
+        """
+        wlistener (WeakMethod)
+        """
+        self._listeners.discard(wlistener)
+        queue = self._queues.pop(wlistener, None)
+        if queue:
+            queue.stop()
+
+    def get_listener_stats(self, listener):
+        """
+        Report how the data is delivered to a (local) listener
+        listener (callable): a callback currently subscribed
+        return (dict str -> value): max_queue (None or int), queued (int): number
+          of data waiting to be delivered, dropped (int): number of data
+          discarded since the subscription, delivered (int or None): number of
+          data passed to the listener since the subscription (None if unknown).
+        raise KeyError: if the listener is not subscribed
+        """
+        wlistener = WeakMethod(listener)
+        if wlistener not in self._listeners:
+            raise KeyError("Listener %r is not subscribed" % (listener,))
+        queue = self._queues.get(wlistener)
+        if queue:
+            return queue.get_stats()
+        return {"max_queue": None, "queued": 0, "dropped": 0, "delivered": None}
+
 #    # to be overridden
 #    def synchronizedOn(self, event):
 #        raise NotImplementedError("This DataFlow doesn't support Event synchronization")
@@ -181,6 +324,10 @@ class DataFlowBase(object):
         # to allow modify the set while calling
         snapshot_listeners = frozenset(self._listeners)
         for l in snapshot_listeners:
+            queue = self._queues.get(l)
+            if queue:
+                queue.put(data)
+                continue
             try:
                 l(self, data)
             except WeakRefLostError:
@@ -208,6 +355,15 @@ class DataFlow(DataFlowBase):
         self.pipe = None
         self._max_discard = max_discard
 
+        # To share the data via shared memory with the remote listeners
+        self._shm_lock = threading.Lock()
+        self._shm_ring = None  # ShmRingWriter
+        self._shm_readers = {}  # remote listener -> int (reader index in the ring)
+
+        # To send the data via TCP, to the remote listeners on other computers
+        self._tcp_listeners = {}  # remote listener -> set of str (codecs supported)
+        self._tcp_publisher = None  # TcpPublisherThread
+
     def _getproxystate(self):
         """
         Equivalent to __getstate__() of the proxy version
@@ -293,6 +449,13 @@ class DataFlow(DataFlowBase):
             self.pipe = None
             self._ctx.term()
             self._ctx = None
+        with self._shm_lock:
+            if self._shm_ring:
+                self._shm_ring.close()
+                self._shm_ring = None
+        if self._tcp_publisher:
+            self._tcp_publisher.terminate()
+            self._tcp_publisher = None
 
     def _count_listeners(self):
         return len(self._listeners) + len(self._remote_listeners)
@@ -328,16 +491,42 @@ class DataFlow(DataFlowBase):
     # speed up a bit calls to them), but as Pyro doesn't ensure the order, it's
     # not possible because it could lead to wrong behaviour in case of quick
     # subscribe/unsubscribe.
-    def subscribe(self, listener):
+    def subscribe(self, listener, max_queue=None, shm=False, codecs=None):
+        """
+        listener (callable or str): callback function, or name of the remote
+          listener (DataFlowProxy).
+        max_queue (None or 0 <= int): only for local listeners, see DataFlowBase.subscribe()
+        shm (bool): only for remote listeners, if True, the data will be passed
+          via shared memory, when possible.
+        codecs (None or list of str): only for remote listeners. If not None,
+          the data will be sent compressed via TCP, instead of IPC, using one
+          of these codecs.
+        return (None or dict str -> str): for remote listeners, how the data
+          will be transferred. If it contains "tcp", the data is sent at the
+          given address. If it contains "shm", the data will be passed via
+          the shared memory at the given path. The listener should check it
+          can access it, and otherwise subscribe again with shm=False.
+          Otherwise, the data is sent via IPC.
+        """
+        transport = None
         with self._lock:
             count_before = self._count_listeners()
 
             # add string to listeners if listener is string
             if isinstance(listener, str):
+                self._shm_readers.pop(listener, None)
+                self._tcp_listeners.pop(listener, None)
+                transport = {}
+                if codecs is not None:
+                    transport["tcp"] = self._add_tcp_listener(listener, codecs)
+                elif shm:
+                    shm_path = self._add_shm_reader(listener)
+                    if shm_path is not None:
+                        transport["shm"] = shm_path
                 self._remote_listeners.add(listener)
             else:
                 assert callable(listener)
-                self._listeners.add(WeakMethod(listener))
+                self._add_listener(listener, max_queue)
 
             # Use '%' instead of ',' because logging may be holding on too long to the reference,
             # which we really don't want
@@ -351,29 +540,156 @@ class DataFlow(DataFlowBase):
                     if isinstance(listener, str):
                         # remove string from listeners
                         self._remote_listeners.discard(listener)
+                        self._shm_readers.pop(listener, None)
+                        self._tcp_listeners.pop(listener, None)
                     else:
-                        self._listeners.discard(WeakMethod(listener))
+                        self._remove_listener(WeakMethod(listener))
                     logging.debug("Listener %r unsubscribed, now %d subscribers on %s", listener,
                                   self._count_listeners(), self._global_name)
                     raise
 
+        return transport
+
     def unsubscribe(self, listener):
         with self._lock:
             count_before = self._count_listeners()
             if isinstance(listener, str):
                 # remove string from listeners
                 self._remote_listeners.discard(listener)
+                self._shm_readers.pop(listener, None)
+                self._tcp_listeners.pop(listener, None)
             else:
-                self._listeners.discard(WeakMethod(listener))
+                self._remove_listener(WeakMethod(listener))
 
             count_after = self._count_listeners()
             logging.debug("Listener %r unsubscribed, now %d subscribers on %s", listener, count_after, self._global_name)
             if count_before > 0 and count_after == 0:
                 self.stop_generate()
 
+    def _add_tcp_listener(self, listener, codecs):
+        """
+        Register a remote listener to receive the data via TCP.
+        Must be called with the lock taken.
+        listener (str): name of the remote listener
+        codecs (list of str): codecs supported by the listener
+        return (str): the address to connect to, to receive the data
+        raise LookupError: if none of the codecs is available
+        """
+        if not any(c in _codec.get_codecs() for c in codecs):
+            raise LookupError("None of the codecs %s is supported, available codecs: %s" %
+                              (codecs, _codec.get_codecs()))
+
+        address = self._get_tcp_publisher().address
+        self._tcp_listeners[listener] = set(codecs)
+        return address
+
+    def _get_tcp_publisher(self):
+        """
+        Must be called with the lock taken.
+        return (TcpPublisherThread): the thread sending the data via TCP, started
+          if it wasn't running yet.
+        """
+        if self._tcp_publisher is None:
+            # Don't drop any data if the dataflow should never discard
+            max_queue = 0 if self._max_discard == 0 else 2
+            self._tcp_publisher = TcpPublisherThread(self._global_name, max_queue)
+            self._tcp_publisher.start()
+        return self._tcp_publisher
+
+    def get_tcp_address(self):
+        """
+        Get the address where the data is sent via TCP. It allows the remote
+        listeners to connect before subscribing, so that no data is lost.
+        return (str): the 0MQ address to connect to
+        """
+        with self._lock:
+            return self._get_tcp_publisher().address
+
+    def get_tcp_stats(self):
+        """
+        Report the statistics of the data sent via TCP
+        return (dict str -> value): see TcpPublisherThread.get_stats(). Empty
+          if the data has never been sent via TCP.
+        """
+        if self._tcp_publisher is None:
+            return {}
+        return self._tcp_publisher.get_stats()
+
+    def _add_shm_reader(self, listener):
+        """
+        Register a remote listener to receive the data via shared memory.
+        Must be called with the lock taken.
+        listener (str): name of the remote listener
+        return (None or str): path of the shared memory, or None if not possible
+        """
+        if not _shm.is_available():
+            return None
+
+        with self._shm_lock:
+            if listener in self._shm_readers and self._shm_ring:
+                return self._shm_ring.path
+            if self._shm_ring is None:
+                # The ring will be resized as soon as the data is known
+                try:
+                    self._shm_ring = _shm.ShmRingWriter(0)
+                except OSError as ex:
+                    logging.info("Failed to create shared memory, will use 0MQ: %s", ex)
+                    return None
+
+            # Pick a reader index not in use (including by previous listeners,
+            # which might still hold some data)
+            used = set(self._shm_readers.values())
+            for i in range(_shm.MAX_READERS):
+                if i not in used and not self._shm_ring.has_pending(i):
+                    self._shm_readers[listener] = i
+                    return self._shm_ring.path
+            else:
+                logging.info("Too many shared memory readers, will use 0MQ for %s", listener)
+                return None
+
+    def _publish_shm(self, data):
+        """
+        Try to copy the data into the shared memory, for the remote listeners.
+        return (None or dict): the shared memory information to send to the
+          listeners, or None if the data should be sent via 0MQ.
+        """
+        readers = dict(self._shm_readers)  # copy to be thread-safe
+        # Only if all the IPC listeners use the shared memory, otherwise,
+        # the data has to be sent anyway.
+        if not data.size or len(readers) != len(self._remote_listeners) - len(self._tcp_listeners):
+            return None
+
+        with self._shm_lock:
+            ring = self._shm_ring
+            if ring is None:  # unregistered
+                return None
+
+            if data.nbytes > ring.slot_size:
+                # Create a new, bigger, ring. As the readers of the previous ring
+                # don't hold anything in the new one, they can all be reused.
+                logging.debug("Creating shared memory for %d bytes on %s", data.nbytes, self._global_name)
+                try:
+                    self._shm_ring = _shm.ShmRingWriter(data.nbytes)
+                except OSError as ex:
+                    logging.warning("Failed to create shared memory of %d bytes: %s", data.nbytes, ex)
+                    return None
+                ring.close()
+                ring = self._shm_ring
+
+            shm = ring.publish(data, readers.values())
+            if shm is None:
+                logging.debug("No shared memory slot available, sending via 0MQ")
+                return None
+        shm["readers"] = readers
+        return shm
+
     def notify(self, data):
-        # publish the data remotely
-        if self.pipe and len(self._remote_listeners) > 0:
+        # publish the data remotely, on other computers (asynchronously)
+        if self._tcp_listeners:
+            self._tcp_publisher.put(data, list(self._tcp_listeners.values()))
+
+        # publish the data remotely, on the same computer
+        if self.pipe and len(self._remote_listeners) > len(self._tcp_listeners):
             # TODO: is there any way to know how many recipients of the pipe?
             # If possible, we would detect it's 0, because some listener closed
             # without unsubscribing, and we would kick it out.
@@ -383,21 +699,34 @@ class DataFlow(DataFlowBase):
 
             # TODO thread-safe for self.pipe ?
             dformat = {"dtype": str(data.dtype), "shape": data.shape}
+            shm = self._publish_shm(data)
+            if shm is not None:
+                # The data is already in the shared memory, only send where to find it
+                dformat["shm"] = shm
+                buf = b""
+            elif data.flags["C_CONTIGUOUS"]:
+                buf = data
+            else:
+                # Typically, the data is transposed, flipped or cropped. If it's
+                # a view on a contiguous memory area, send that memory, along
+                # with the information to reconstruct the view.
+                strided = get_strided_buffer(data)
+                if strided is None:
+                    # Too sparse => copy (which removes the strides)
+                    logging.debug("Failed to send data with zero-copy")
+                    buf = numpy.require(data, requirements=["C_CONTIGUOUS"])
+                else:
+                    buf, dformat["offset"], dformat["strides"] = strided
+
             self.pipe.send_pyobj(dformat, zmq.SNDMORE)
             self.pipe.send_pyobj(data.metadata, zmq.SNDMORE)
             try:
-                if not data.flags["C_CONTIGUOUS"]:
-                    # if not in C order, it will be received incorrectly
-                    # TODO: if it's just rotated, send the info to reconstruct it
-                    # and avoid the memory copy
-                    raise TypeError("Need C ordered array")
-                self.pipe.send(memoryview(data), copy=False)
+                self.pipe.send(memoryview(buf), copy=False)
             except TypeError:
-                # not all buffers can be sent zero-copy (e.g., has strides)
-                # try harder by copying (which removes the strides)
+                # not all buffers can be sent zero-copy (eg, some dtypes are not
+                # supported by memoryview) => send it as bytes
                 logging.debug("Failed to send data with zero-copy")
-                data = numpy.require(data, requirements=["C_CONTIGUOUS"])
-                self.pipe.send(memoryview(data), copy=False)
+                self.pipe.send(numpy.require(buf, requirements=["C_CONTIGUOUS"]).tobytes())
 
         # publish locally
         DataFlowBase.notify(self, data)
@@ -452,20 +781,90 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
 
     # .get() is a direct remote call
 
-    # next three methods are directly from DataFlowBase
-    #.subscribe()
-    #.unsubscribe()
+    # next method is directly from DataFlowBase
     #.notify()
 
-    def _create_thread(self):
+    def subscribe(self, listener, max_queue=None):
+        DataFlowBase.subscribe(self, listener, max_queue)
+        self._update_thread_discard()
+
+    def unsubscribe(self, listener):
+        DataFlowBase.unsubscribe(self, listener)
+        self._update_thread_discard()
+
+    def get_listener_stats(self, listener):
+        stats = DataFlowBase.get_listener_stats(self, listener)
+        if stats["max_queue"] is None and self._thread:
+            # The data is discarded by the thread receiving it
+            stats["dropped"] = self._thread.dropped
+        return stats
+
+    def _notify_queues(self, data):
+        """
+        Pass the data only to the listeners which have a queue. Used for the data
+        discarded for the other listeners (according to .max_discard).
+        data (DataArray): the data to be sent to listeners
+        """
+        for l in frozenset(self._listeners):
+            queue = self._queues.get(l)
+            if queue:
+                queue.put(data)
+
+    def _update_thread_discard(self):
+        if self._thread:
+            self._thread.max_discard = self.max_discard
+            # If some listeners have a queue, they take care of discarding the
+            # data themselves, so the thread should pass all of it to them.
+            self._thread.pass_discarded = bool(self._queues)
+
+    def _create_thread(self, address=None):
         self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
         self._commands = self._ctx.socket(zmq.PAIR)
         self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
+        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard,
+                                            self._ctx, self._proxy_name, address,
+                                            discarded_notifier=self._notify_queues)
+        self._thread.pass_discarded = bool(self._queues)
         self._thread.start()
 
+    def _use_tcp(self):
+        """
+        return (bool): True if the data should be received via TCP
+        """
+        if DATAFLOW_TRANSPORT == "tcp":
+            return True
+        elif DATAFLOW_TRANSPORT == "ipc":
+            return False
+        # If the IPC socket is not accessible, the DataFlow is on another computer
+        return not os.path.exists(self._global_name)
+
     def start_generate(self):
         # start the remote subscription
+        subscribe = Pyro4.Proxy.__getattr__(self, "subscribe")
+        if self._use_tcp():
+            # Connect to the publisher before subscribing, as a 0MQ SUB socket
+            # only receives the messages sent after it has joined.
+            if not self._thread:
+                address = Pyro4.Proxy.__getattr__(self, "get_tcp_address")()
+                self._create_thread(address)
+            self._commands.send(b"SUB")
+            self._commands.recv()  # synchronise
+
+            try:
+                transport = subscribe(self._proxy_name, codecs=_codec.get_codecs())
+            except Exception as ex:
+                logging.error("Subscribing to the dataflow failed. %s", ex)
+                self._commands.send(b"UNSUB")  # asynchronous (necessary to not deadlock)
+                raise
+            if transport.get("tcp") != self._thread.address:
+                # Should never happen, as the publisher only stops with the DataFlow
+                logging.error("Dataflow sends data to %s, while connected to %s",
+                              transport.get("tcp"), self._thread.address)
+                Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
+                self._commands.send(b"UNSUB")
+                raise IOError("Dataflow %s sends data to an unexpected address" % (self._global_name,))
+            return
+
         if not self._thread:
             self._create_thread()
         self._commands.send(b"SUB")
@@ -474,7 +873,13 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         try:
             # send subscription to the actual dataflow and inform dataflow that this remote listener is interested
             # a bit tricky because the underlying method gets created on the fly
-            Pyro4.Proxy.__getattr__(self, "subscribe")(self._proxy_name)
+            transport = subscribe(self._proxy_name, shm=_shm.is_available())
+            shm_path = transport.get("shm")
+            if shm_path is not None and not os.path.exists(shm_path):
+                # The dataflow is on a computer (or container) with a different
+                # shared memory => use 0MQ to transfer the data
+                logging.info("Shared memory %s not accessible, will receive data via 0MQ", shm_path)
+                subscribe(self._proxy_name, shm=False)
         except Exception as ex:
             logging.error("Subscribing to the dataflow failed. %s", ex)
             self._commands.send(b"UNSUB")  # asynchronous (necessary to not deadlock)
@@ -509,22 +914,87 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
             pass # don't be too rough if that fails, it's not big deal anymore
 
 
+# Maximum ratio between the size of the memory area containing a non-contiguous
+# array and the size of the array, to still send it without copy.
+MAX_STRIDED_SPAN_RATIO = 2
+
+
+def get_strided_buffer(data):
+    """
+    Find the memory area containing all the elements of an array, typically to
+    send it without copying it, when it's non-contiguous.
+    data (numpy.ndarray): an array, which is a view on another array
+    return (None or tuple of (numpy.ndarray, int, tuple of int)):
+       * buffer: 1D array of bytes, containing all the elements of the array
+       * offset: position (in bytes) of the first element of the array in the buffer
+       * strides: strides of the array
+      The original array can be reconstructed with:
+        numpy.ndarray(data.shape, data.dtype, buffer, offset, strides)
+      Returns None if the array is not a view on contiguous memory, or if the
+      memory area is much bigger than the array (cf MAX_STRIDED_SPAN_RATIO).
+    """
+    if not data.size:
+        return None
+
+    # Find the range of bytes (relative to the first element) that can be accessed
+    low, high = 0, 0
+    for l, s in zip(data.shape, data.strides):
+        if s >= 0:
+            high += (l - 1) * s
+        else:
+            low += (l - 1) * s
+    span = high - low + data.itemsize
+    if span > MAX_STRIDED_SPAN_RATIO * data.nbytes:
+        return None
+
+    # Find the array owning the memory
+    root = data
+    while isinstance(root.base, numpy.ndarray):
+        root = root.base
+    if not (root.flags["C_CONTIGUOUS"] or root.flags["F_CONTIGUOUS"]):
+        return None
+
+    start = data.__array_interface__["data"][0] + low - root.__array_interface__["data"][0]
+    if start < 0 or start + span > root.nbytes:
+        return None
+
+    # 1D view of the bytes of the root array, in memory order
+    flat = root.reshape(-1, order="A").view(numpy.uint8)
+    return flat[start:start + span], -low, data.strides
+
+
 class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
+    def __init__(self, notifier, uri, max_discard, zmq_ctx, proxy_name=None, address=None,
+                 discarded_notifier=None):
         """
         notifier (callable): method to call when a new array arrives
         uri (string): unique string to identify the connection
         max_discard (int)
         zmq_ctx (0MQ context): available 0MQ context to use
+        proxy_name (None or str): name of the remote listener, as subscribed on
+          the DataFlow. Needed to receive data via shared memory.
+        address (None or str): 0MQ address to receive the data from. If None,
+          the IPC address corresponding to the uri is used.
+        discarded_notifier (None or callable): method to call with the arrays
+          discarded (according to max_discard), when .pass_discarded is True.
         """
         threading.Thread.__init__(self, name="zmq for dataflow " + uri)
         self.daemon = True
         self.uri = uri
         self.max_discard = max_discard
+        self.dropped = 0  # total number of data discarded
+        # If True, the discarded data is still passed to discarded_notifier
+        self.pass_discarded = False
         self._ctx = zmq_ctx
+        self.proxy_name = proxy_name
+        self._shm_reader = _shm.ShmRingReader()
+        self._shm_index = None  # index of this reader in the current ring
+        self._subscribed = False
+        self.address = address or "ipc://" + uri
         # don't keep strong reference to notifier so that it can be garbage
         # collected normally and it will let us know then that we can stop
         self.w_notifier = WeakMethod(notifier)
+        self.w_discarded_notifier = WeakMethod(discarded_notifier) if discarded_notifier else None
 
         # create a zmq synchronised channel to receive _commands
         self._commands = zmq_ctx.socket(zmq.PAIR)
@@ -532,19 +1002,14 @@ class SubscribeProxyThread(threading.Thread):
 
         # create a zmq subscription to receive the data
         self._data = zmq_ctx.socket(zmq.SUB)
-        # TODO find out if it does something and if it does, depend on max_discard
-        # (for now, we just set it to 0, the default, to never discard messages)
+        # Never discard messages at the 0MQ level: the messages are discarded
+        # (if needed) here, based on max_discard, or by the ListenerQueue of
+        # each listener.
         if hasattr(self._data, "rcvhwm"):  # zmq v3+
             self._data.rcvhwm = 0
         else:  # zmq v2
             self._data.hwm = 0
-        self._data.connect("ipc://" + uri)
-
-        # TODO: we need a more advance support for max_discards to be able to
-        # ensure all the data is received when the client needs it.
-        # API should be either:
-        #  *  .max_discard = XXX (= per dataflow)
-        #  * .subscribe(callback, discard=True) (per subscriber)
+        self._data.connect(self.address)
 
     def run(self):
         """
@@ -566,10 +1031,15 @@ class SubscribeProxyThread(threading.Thread):
                     message = self._commands.recv()
                     if message == b"SUB":
                         self._data.setsockopt(zmq.SUBSCRIBE, b'')
+                        self._subscribed = True
                         logging.debug("Subscribed to remote dataflow %s", self.uri)
                         self._commands.send(b"SUBD")
                     elif message == b"UNSUB":
                         self._data.setsockopt(zmq.UNSUBSCRIBE, b'')
+                        self._subscribed = False
+                        # The dataflow doesn't send us data anymore, so nothing
+                        # should stay reserved in the shared memory.
+                        self._release_shm()
                         if logging:
                             logging.debug("Unsubscribed from remote dataflow %s", self.uri)
                         # no confirmation (async)
@@ -585,19 +1055,38 @@ class SubscribeProxyThread(threading.Thread):
                     array_format = self._data.recv_pyobj()
                     array_md = self._data.recv_pyobj()
                     array_buf = self._data.recv(copy=False)
+                    shm = array_format.get("shm")
                     # logging.debug("Received new DataArray over ZMQ for %s", self.uri)
                     # more fresh data already?
-                    if (self._data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
-                        discarded < self.max_discard):
+                    discard = (self._data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
+                               discarded < self.max_discard)
+                    if discard:
                         discarded += 1
-                        # logging.debug("Discarding object received as a newer one is available")
-                        continue
-                    # TODO: only log the accumulated number every second, to avoid log flooding
-#                     if discarded:
-#                         logging.debug("Dataflow %s dropped %d arrays", self.uri, discarded)
-                    discarded = 0
+                        self.dropped += 1
+                        if not (self.pass_discarded and self.w_discarded_notifier):
+                            if shm:
+                                self._discard_shm(shm)
+                            # logging.debug("Discarding object received as a newer one is available")
+                            continue
+                    else:
+                        # TODO: only log the accumulated number every second, to avoid log flooding
+#                         if discarded:
+#                             logging.debug("Dataflow %s dropped %d arrays", self.uri, discarded)
+                        discarded = 0
+                    if shm:
+                        array = self._get_shm_array(shm, array_format)
+                        if array is None:
+                            continue
+                    elif "codec" in array_format:
+                        array = _codec.decompress(array_buf, array_format["codec"],
+                                                  array_format["dtype"], array_format["shape"])
+                    elif "strides" in array_format:
+                        # Reconstruct the same view as the original array
+                        array = numpy.ndarray(array_format["shape"], dtype=array_format["dtype"],
+                                              buffer=array_buf, offset=array_format["offset"],
+                                              strides=array_format["strides"])
                     # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
-                    if len(array_buf):
+                    elif len(array_buf):
                         array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
                     else: # frombuffer doesn't support zero length array
                         array = numpy.empty((0,), dtype=array_format["dtype"])
@@ -605,13 +1094,21 @@ class SubscribeProxyThread(threading.Thread):
                     darray = DataArray(array, metadata=array_md)
 
                     try:
-                        self.w_notifier(darray)
+                        if discard:
+                            # Only for the listeners which discard the data themselves
+                            self.w_discarded_notifier(darray)
+                        else:
+                            self.w_notifier(darray)
                     except WeakRefLostError:
                         return  # It's a sign there is nothing left to do
         except Exception:
             if logging:
                 logging.exception("Ending ZMQ thread due to exception")
         finally:
+            try:
+                self._release_shm()
+            except Exception:
+                print("Exception releasing shared memory")
             try:
                 self._commands.close()
             except Exception:
@@ -621,6 +1118,149 @@ class SubscribeProxyThread(threading.Thread):
             except Exception:
                 print("Exception closing ZMQ data connection")
 
+    def _get_shm_array(self, shm, array_format):
+        """
+        shm (dict): shared memory information
+        array_format (dict): format of the array
+        return (None or numpy.ndarray): read-only array, or None if the data
+          should be skipped
+        """
+        index = shm["readers"].get(self.proxy_name)
+        if index is None:
+            # Can happen just after subscribing again without shared memory
+            logging.debug("Skipping data in shared memory, not for us")
+            return None
+        self._shm_index = index
+        if not self._subscribed:
+            # Late data, don't hold it, as it wouldn't be released anymore
+            self._shm_reader.discard(shm, index)
+            return None
+
+        try:
+            return self._shm_reader.get_array(shm, array_format["dtype"],
+                                              array_format["shape"], index)
+        except OSError:
+            logging.exception("Failed to read data from shared memory %s", shm["path"])
+            return None
+
+    def _discard_shm(self, shm):
+        index = shm["readers"].get(self.proxy_name)
+        if index is not None:
+            self._shm_reader.discard(shm, index)
+
+    def _release_shm(self):
+        if self._shm_index is not None:
+            self._shm_reader.release_all(self._shm_index)
+
+
+class TcpPublisherThread(threading.Thread):
+    """
+    Compresses and sends the data of a DataFlow via TCP, from a separate thread,
+    so that the generator of the data is never blocked.
+    """
+
+    def __init__(self, name, max_queue):
+        """
+        name (str): name of the DataFlow, for logging
+        max_queue (0 <= int): maximum number of data waiting to be sent, the
+          oldest data being discarded first. 0 means no data is ever discarded.
+        """
+        threading.Thread.__init__(self, name="TCP publisher for dataflow " + name)
+        self.daemon = True
+        self._queue = collections.deque(maxlen=max_queue or None)
+        self._cond = threading.Condition()
+        self._must_stop = False
+
+        # Statistics
+        self._count = 0  # number of data sent
+        self._dropped = 0  # number of data discarded
+        self._raw_bytes = 0
+        self._compressed_bytes = 0
+        self._compress_time = 0  # s
+        self._last_log = time.time()
+
+        # Only used by the thread, once started
+        self._ctx = zmq.Context(1)
+        self._pipe = self._ctx.socket(zmq.PUB)
+        self._pipe.linger = 1  # don't keep messages more than 1s after close
+        port = self._pipe.bind_to_random_port("tcp://" + DATAFLOW_TCP_INTERFACE)
+        if DATAFLOW_TCP_INTERFACE == "*":
+            host = socket.getfqdn()
+        else:
+            host = DATAFLOW_TCP_INTERFACE
+        self.address = "tcp://%s:%d" % (host, port)
+        logging.debug("Dataflow %s will send data via TCP to %s", name, self.address)
+
+    def put(self, data, codecs):
+        """
+        Schedule the data to be sent
+        data (numpy.ndarray): the data
+        codecs (list of set of str): codecs supported by each listener
+        """
+        with self._cond:
+            if self._queue.maxlen and len(self._queue) == self._queue.maxlen:
+                self._dropped += 1  # The deque automatically drops the oldest one
+            self._queue.append((data, codecs))
+            self._cond.notify()
+
+    def terminate(self):
+        with self._cond:
+            self._must_stop = True
+            self._queue.clear()
+            self._cond.notify()
+
+    def get_stats(self):
+        """
+        return (dict str -> value): count (int): number of data sent, dropped (int):
+          number of data discarded, raw_bytes (int), compressed_bytes (int),
+          ratio (float): compression ratio (raw/compressed),
+          compress_time (float): total time spent compressing (s)
+        """
+        return {"count": self._count,
+                "dropped": self._dropped,
+                "raw_bytes": self._raw_bytes,
+                "compressed_bytes": self._compressed_bytes,
+                "ratio": self._raw_bytes / max(1, self._compressed_bytes),
+                "compress_time": self._compress_time,
+                }
+
+    def run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._queue and not self._must_stop:
+                        self._cond.wait()
+                    if self._must_stop:
+                        return
+                    data, codecs = self._queue.popleft()
+
+                codec = _codec.choose_codec(data.dtype, codecs)
+                tstart = time.time()
+                cdata = _codec.compress(data, codec)
+                self._compress_time += time.time() - tstart
+                self._raw_bytes += data.nbytes
+                self._compressed_bytes += len(cdata)
+                self._count += 1
+
+                dformat = {"dtype": str(data.dtype), "shape": data.shape, "codec": codec}
+                self._pipe.send_pyobj(dformat, zmq.SNDMORE)
+                self._pipe.send_pyobj(data.metadata, zmq.SNDMORE)
+                self._pipe.send(cdata, copy=False)
+                del data, cdata  # Don't hold it while waiting
+
+                # Report regularly how efficient the compression is
+                now = time.time()
+                if now > self._last_log + 10:
+                    self._last_log = now
+                    logging.debug("Sent %d arrays via TCP (%d dropped), compression ratio = %.2f, "
+                                  "in %g s", self._count, self._dropped,
+                                  self._raw_bytes / max(1, self._compressed_bytes), self._compress_time)
+        except Exception:
+            logging.exception("Ending TCP publisher thread due to exception")
+        finally:
+            self._pipe.close()
+            self._ctx.term()
+
 
 def unregister_dataflows(self):
     # Only for the "DataFlow"s, the real objects, not the proxys
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+# Shared memory ring buffer, used by the DataFlows to pass the (big) arrays to
+# the subscribers running on the same computer, without copying them through
+# the 0MQ sockets.
+#
+# The ring is a file in /dev/shm (= POSIX shared memory), containing a header
+# per slot, followed by the data of each slot:
+# * header: the sequence number of the data in the slot + one byte per reader,
+#   set to 1 by the writer when the data is published, and reset to 0 by the
+#   reader once it doesn't use the data anymore.
+# * data: the array, in C order.
+# The writer only reuses a slot once all the readers have released it. So the
+# readers can hold the array as long as they want, as a read-only view of the
+# shared memory. If no slot is free, the writer has to fallback to sending the
+# data via 0MQ.
+# As 0MQ may drop messages (on the writer or reader side), the readers cannot
+# rely only on receiving a message to release a slot. Instead, every time a
+# message is received, all the slots which are not held and contain older data
+# are released.
+
+import itertools
+import logging
+import mmap
+import numpy
+import os
+import threading
+import weakref
+
+SHM_DIR = "/dev/shm"
+MAX_READERS = 64  # maximum number of readers per ring
+RING_SLOTS = 8  # number of arrays which can be simultaneously shared
+_HEADER_DTYPE = numpy.dtype({"names": ["seq", "readers"],
+                             "formats": ["<u8", ("u1", (MAX_READERS,))],
+                             "offsets": [0, 8],
+                             "itemsize": 128})
+_ALIGNMENT = mmap.PAGESIZE
+
+_ring_counter = itertools.count()
+
+
+def is_available():
+    """
+    return (bool): True if shared memory can be used on this computer
+    """
+    return os.name != "nt" and os.path.isdir(SHM_DIR + "/.")
+
+
+def _align(size):
+    return -(-size // _ALIGNMENT) * _ALIGNMENT
+
+
+class ShmRingWriter(object):
+    """
+    Creates a shared memory ring, and writes arrays into it.
+    Not thread-safe: only one thread should call publish() at a time.
+    """
+
+    def __init__(self, slot_size):
+        """
+        slot_size (0 <= int): maximum number of bytes of an array
+        raise OSError: if the shared memory couldn't be created
+        """
+        self.slot_size = _align(slot_size)
+        self._data_offset = _align(RING_SLOTS * _HEADER_DTYPE.itemsize)
+        self.path = os.path.join(SHM_DIR, "odemis-df-%d-%d" % (os.getpid(), next(_ring_counter)))
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o660)
+        try:
+            size = self._data_offset + RING_SLOTS * self.slot_size
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        except Exception:
+            os.unlink(self.path)
+            raise
+        finally:
+            os.close(fd)
+
+        self._hdr = numpy.ndarray((RING_SLOTS,), dtype=_HEADER_DTYPE, buffer=self._mm)
+        self._seq = 0
+
+    def has_pending(self, reader):
+        """
+        reader (int): index of the reader
+        return (bool): True if the reader still holds at least one slot
+        """
+        return bool(self._hdr["readers"][:, reader].any())
+
+    def publish(self, data, readers):
+        """
+        Copy the data into a free slot, and mark it as used by the given readers.
+        data (numpy.ndarray): the array to share. It may be non-contiguous.
+        readers (list of int): index of each reader which will receive the data
+        return (None or dict): shared memory information to pass to the readers,
+          or None if no slot is available.
+        """
+        if data.nbytes > self.slot_size:
+            return None
+
+        hdr = self._hdr
+        free = numpy.flatnonzero(~hdr["readers"].any(axis=1))
+        if not free.size:
+            return None
+        # Pick the least recently used, to leave the most time to the readers
+        slot = int(free[numpy.argmin(hdr["seq"][free])])
+
+        self._seq += 1
+        # The sequence number must be updated before the reader flags, so that
+        # a reader never sees its flag set with an old sequence number.
+        hdr["seq"][slot] = self._seq
+        offset = self._data_offset + slot * self.slot_size
+        dest = numpy.ndarray(data.shape, dtype=data.dtype, buffer=self._mm, offset=offset)
+        numpy.copyto(dest, data, casting="no")
+        hdr["readers"][slot, list(readers)] = 1
+        return {"path": self.path, "slot": slot, "offset": offset, "seq": self._seq}
+
+    def close(self):
+        """
+        Remove the shared memory. The readers can still use the arrays they hold.
+        """
+        try:
+            os.unlink(self.path)
+        except OSError:
+            logging.warning("Failed to remove shared memory %s", self.path)
+        self._hdr = None
+        # The mmap will be closed once it's not used anymore
+        self._mm = None
+
+
+class ShmRingReader(object):
+    """
+    Converts the messages published via a ShmRingWriter into arrays.
+    It can be used by several threads, but only one thread should call get_array().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None  # the current ring
+        self._mm = None
+        self._hdr = None
+        self._held = set()  # (path, slot) of the arrays still in use
+
+    def _open(self, path):
+        """
+        Map the given ring, instead of the previous one
+        """
+        fd = os.open(path, os.O_RDWR)
+        try:
+            mm = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        # The previous ring stays mapped as long as arrays use it
+        self._mm = mm
+        self._hdr = numpy.ndarray((RING_SLOTS,), dtype=_HEADER_DTYPE, buffer=mm)
+        self._path = path
+
+    def get_array(self, shm, dtype, shape, reader):
+        """
+        shm (dict): shared memory information, as received in the array format
+        dtype (str): the dtype of the array
+        shape (tuple of int): the shape of the array
+        reader (int): the index of this reader in the ring
+        return (numpy.ndarray): read-only view of the array in the shared memory.
+          The slot is released as soon as the array (and all its views) are
+          not used anymore.
+        raise OSError: if the shared memory is not accessible
+        """
+        path, slot = shm["path"], shm["slot"]
+        with self._lock:
+            if path != self._path:
+                self._open(path)
+            self._release_stale(reader, shm["seq"])
+
+            hdr = self._hdr
+            array = numpy.ndarray(shape, dtype=dtype, buffer=self._mm, offset=shm["offset"])
+            array.flags.writeable = False
+            self._held.add((path, slot))
+
+        weakref.finalize(array, self._release, path, hdr, slot, reader)
+        return array
+
+    def discard(self, shm, reader):
+        """
+        Indicate that a message will not be used
+        shm (dict): shared memory information, as received in the array format
+        reader (int): the index of this reader in the ring
+        """
+        with self._lock:
+            if shm["path"] == self._path:
+                self._hdr["readers"][shm["slot"], reader] = 0
+
+    def release_all(self, reader):
+        """
+        Release all the slots which are not held. To be called when no more
+        message is expected from the writer (ie, after unsubscribing).
+        reader (int): the index of this reader in the ring
+        """
+        with self._lock:
+            if self._hdr is None:
+                return
+            for slot in range(RING_SLOTS):
+                if (self._path, slot) not in self._held:
+                    self._hdr["readers"][slot, reader] = 0
+
+    def _release_stale(self, reader, seq):
+        """
+        Release the slots with older data which have not been delivered
+        (because the message was dropped).
+        Must be called with the lock taken.
+        """
+        readers = self._hdr["readers"]
+        for slot in range(RING_SLOTS):
+            # Read the flag before the sequence number (cf ShmRingWriter.publish())
+            if (readers[slot, reader] and self._hdr["seq"][slot] < seq and
+                (self._path, slot) not in self._held):
+                readers[slot, reader] = 0
+
+    def _release(self, path, hdr, slot, reader):
+        """
+        Called when an array is not used anymore
+        """
+        with self._lock:
+            self._held.discard((path, slot))
+            hdr["readers"][slot, reader] = 0
@@ -23,12 +23,14 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 import Pyro4
 from Pyro4.core import oneway
 from collections.abc import Iterable, Set
+import collections
 import logging
 import numbers
 import numpy
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
 import threading
+import time
 import types
 import sys
 import zmq
@@ -55,6 +57,7 @@ class VigilantAttributeBase(object):
         unit (str): a SI unit in which the VA is expressed
         """
         self._listeners = set()
+        self._coalescers = {}  # WeakMethod -> Coalescer, for the listeners with a minimum period
         self._value = initval
         self.unit = unit
 
@@ -68,7 +71,7 @@ class VigilantAttributeBase(object):
                                                         val,
                                                         len(self._listeners))
 
-    def subscribe(self, listener, init=False):
+    def subscribe(self, listener, init=False, period=None):
         """
         Register a callback function to be called when the VigilantAttributeBase
         is changed
@@ -76,31 +79,146 @@ class VigilantAttributeBase(object):
         listener (function): callback function which takes as argument val the
             new value
         init (boolean): if True calls the listener directly, to initialise it
+        period (None or 0 < float): if not None, the listener is called at most
+            once per period (in s). When the value changes more often, the
+            intermediary values are dropped, but the latest value is always
+            passed (at the end of the period).
         """
         assert callable(listener)
+        if period is not None and period <= 0:
+            raise ValueError("period must be positive, but got %s" % (period,))
         if isinstance(listener, types.BuiltinMethodType):
-            self._listeners.add(listener)
+            wlistener = listener
         else:
-            self._listeners.add(WeakMethod(listener))
+            wlistener = WeakMethod(listener)
+        self._listeners.add(wlistener)
+
+        # If already subscribed, make sure the previous coalescer doesn't pass
+        # an older value later
+        coalescer = self._coalescers.pop(wlistener, None)
+        if coalescer:
+            coalescer.cancel()
+        if period is not None:
+            self._coalescers[wlistener] = Coalescer(wlistener, period,
+                                                    WeakMethod(self._remove_lost_listener))
 
         if init:
             listener(self.value)
 
     def unsubscribe(self, listener):
-        self._listeners.discard(WeakMethod(listener))
+        if isinstance(listener, types.BuiltinMethodType):
+            wlistener = listener
+        else:
+            wlistener = WeakMethod(listener)
+        self._listeners.discard(wlistener)
+        coalescer = self._coalescers.pop(wlistener, None)
+        if coalescer:
+            coalescer.cancel()
 
     def notify(self, v):
         for l in self._listeners.copy():
+            coalescer = self._coalescers.get(l)
+            if coalescer:
+                coalescer.put(v)
+                continue
             try:
                 l(v)
             except WeakRefLostError:
                 # self.unsubscribe(l)
-                logging.debug("Not notifying listener which has been dereferenced")
-                self._listeners.discard(l)
+                self._remove_lost_listener(l)
             except Exception:
                 logging.exception("Subscriber %r raised exception when "
                                   "receiving value %s", l, v)
 
+    def _remove_lost_listener(self, wlistener):
+        """
+        Forget a listener which has been garbage-collected
+        wlistener (WeakMethod): the listener, as stored in ._listeners
+        """
+        logging.debug("Not notifying listener which has been dereferenced")
+        self._listeners.discard(wlistener)
+        coalescer = self._coalescers.pop(wlistener, None)
+        if coalescer:
+            coalescer.cancel()
+
+
+class Coalescer(object):
+    """
+    Calls a listener at most once per period, with the latest value
+    """
+
+    def __init__(self, listener, period, on_lost=None):
+        """
+        listener (callable): function to call with the value as argument
+        period (0 < float): minimum time between two calls (in s)
+        on_lost (None or callable): function called with the listener as
+          argument, when the listener has been dereferenced
+        """
+        self._listener = listener
+        self.period = period
+        self._on_lost = on_lost
+        self._lock = threading.Lock()
+        self._last_call = 0  # time of the last call
+        self._timer = None  # threading.Timer waiting to pass the latest value
+        self._value = None  # latest value not passed yet (only valid if _timer is not None)
+
+    def put(self, v):
+        """
+        Pass a new value. The listener is called immediately, or at the end of
+        the period.
+        """
+        with self._lock:
+            if self._timer is not None:
+                # Already waiting => just update the value to pass
+                self._value = v
+                return
+
+            delay = self._last_call + self.period - time.time()
+            if delay > 0:
+                self._value = v
+                self._timer = threading.Timer(delay, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+            self._last_call = time.time()
+
+        self._call(v)
+
+    def cancel(self):
+        """
+        Drop the latest value, if it's not yet passed
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+                self._value = None
+
+    def _on_timer(self):
+        with self._lock:
+            if self._timer is None:  # cancelled
+                return
+            v = self._value
+            self._timer = None
+            self._value = None
+            self._last_call = time.time()
+        self._call(v)
+
+    def _call(self, v):
+        try:
+            self._listener(v)
+        except WeakRefLostError:
+            logging.debug("Not notifying listener which has been dereferenced")
+            self.cancel()
+            if self._on_lost:
+                try:
+                    self._on_lost(self._listener)
+                except WeakRefLostError:
+                    pass  # The VA is gone too
+        except Exception:
+            logging.exception("Subscriber %r raised exception when "
+                              "receiving value %s", self._listener, v)
+
 
 class VigilantAttribute(VigilantAttributeBase):
     """
@@ -272,6 +390,9 @@ class VigilantAttribute(VigilantAttributeBase):
         uri = daemon.uriFor(self)
         # uri.sockname is the file name of the pyro daemon (with full path)
         self._global_name = uri.sockname + "@" + uri.object
+        # Each message is prefixed by the topic, so that the subscribers can
+        # receive messages from multiple VAs on the same socket
+        self._topic = _get_topic(self._global_name)
         logging.debug("VA server is registered to send to " + "ipc://" + self._global_name)
         self.pipe.bind("ipc://" + self._global_name)
 
@@ -299,7 +420,7 @@ class VigilantAttribute(VigilantAttributeBase):
             pass  # we've done our best
 
     @oneway
-    def subscribe(self, listener, init=False):
+    def subscribe(self, listener, init=False, period=None):
         """
         listener (string) => uri of listener of zmq
         listener (callable) => method to call (locally)
@@ -308,7 +429,7 @@ class VigilantAttribute(VigilantAttributeBase):
         if isinstance(listener, str):
             self._remote_listeners.add(listener)
         else:
-            VigilantAttributeBase.subscribe(self, listener, init)
+            VigilantAttributeBase.subscribe(self, listener, init, period)
 
         if self.debug:
             logging.debug("Now with local subscribers %s, and remote subscribers %s",
@@ -333,6 +454,7 @@ class VigilantAttribute(VigilantAttributeBase):
 
         # publish the data remotely
         if self._remote_listeners:
+            self.pipe.send(self._topic, zmq.SNDMORE)
             self.pipe.send_pyobj(v)
 
         # publish locally
@@ -357,9 +479,8 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self.max_discard = 100
         self.readonly = False # will be updated in __setstate__
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
+        self._subscriber = None  # VASubscriber, when listening
+        self._subscription = None  # int, id of the subscription on the VASubscriber
 
     def __getattr__(self, name):
         # Behaviour of .range and .choices remote attributes:
@@ -425,23 +546,14 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._global_name = self._pyroUri.sockname + "@" + self._pyroUri.object
         self._proxy_name = "%x/%x" % (os.getpid(), id(self))
 
-        self._ctx = None
-        self._commands = None
-        self._thread = None
-
-    def _create_thread(self):
-        logging.debug("Creating thread for VA %s", self._global_name)
-        self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
-        self._commands = self._ctx.socket(zmq.PAIR)
-        self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
-        self._thread.start()
+        self._subscriber = None
+        self._subscription = None
 
-    def subscribe(self, listener, init=False):
+    def subscribe(self, listener, init=False, period=None):
         count_before = len(self._listeners)
 
         # TODO: when init=True, if already listening, reuse last received value
-        VigilantAttributeBase.subscribe(self, listener, init)
+        VigilantAttributeBase.subscribe(self, listener, init, period)
 
         if count_before == 0:
             self._start_listening()
@@ -450,10 +562,9 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         """
         start the remote subscription
         """
-        if not self._thread:
-            self._create_thread()
-        self._commands.send(b"SUB")
-        self._commands.recv() # synchronise
+        # All the VAs of the same container are received by the same thread
+        self._subscriber = VASubscriber.get_instance(self._pyroUri.sockname)
+        self._subscription = self._subscriber.subscribe(self._global_name, self.notify, self.max_discard)
 
         # send subscription to the actual VA
         # a bit tricky because the underlying method gets created on the fly
@@ -469,22 +580,20 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         stop the remote subscription
         """
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-        if self._commands:
-            self._commands.send(b"UNSUB")
+        if self._subscription is not None:
+            self._subscriber.unsubscribe(self._subscription)
+            self._subscription = None
 
     def __del__(self):
-        # end the thread (but it will stop as soon as it notices we are gone anyway)
+        # end the subscription (but it will stop as soon as it notices we are gone anyway)
         try:
-            if self._thread:
-                if self._thread.is_alive():
-                    if len(self._listeners):
-                        logging.warning("Stopping subscription while there are still subscribers "
-                                        "because VA '%s' is going out of context",
-                                        self._global_name)
-                        Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
-                    self._commands.send(b"STOP")
-                self._commands.close()
-            # self._ctx.term()
+            if self._subscription is not None:
+                if len(self._listeners):
+                    logging.warning("Stopping subscription while there are still subscribers "
+                                    "because VA '%s' is going out of context",
+                                    self._global_name)
+                    Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
+                self._subscriber.unsubscribe(self._subscription)
         except Exception:
             pass
 
@@ -494,74 +603,210 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
             pass  # don't be too rough if that fails, it's not big deal anymore
 
 
-class SubscribeProxyThread(threading.Thread):
-    def __init__(self, notifier, uri, max_discard, zmq_ctx):
+def _get_topic(global_name):
+    """
+    global_name (str): the unique name of the VA
+    return (bytes): the 0MQ topic of the messages of the VA
+    """
+    # Terminated by a null character, so that a topic is never the prefix of another one
+    return global_name.encode("utf-8") + b"\0"
+
+
+class VASubscriber(threading.Thread):
+    """
+    Receives the new values of all the (remote) VAs of a container, via a single
+    0MQ socket and thread, and passes them to the corresponding VA proxies.
+    Use get_instance() to get the instance of a given container.
+    """
+    _instances = {}  # (pid, container socket name) -> VASubscriber
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls, sockname):
+        """
+        sockname (str): the socket name of the container
+        return (VASubscriber): the (running) subscriber for the given container
+        """
+        # The pid is part of the key, because the thread doesn't survive a fork
+        key = os.getpid(), sockname
+        with cls._instances_lock:
+            subscriber = cls._instances.get(key)
+            if subscriber is None:
+                subscriber = cls(sockname)
+                subscriber.start()
+                cls._instances[key] = subscriber
+            return subscriber
+
+    def __init__(self, sockname):
         """
-        notifier (callable): method to call when a new value arrives
-        uri (string): unique string to identify the connection
-        max_discard (int)
-        zmq_ctx (0MQ context): available 0MQ context to use
+        sockname (str): the socket name of the container
         """
-        threading.Thread.__init__(self, name="zmq for VA " + uri)
+        threading.Thread.__init__(self, name="zmq for VAs of " + sockname)
         self.daemon = True
-        self.uri = uri
-        self.max_discard = max_discard
-        self._ctx = zmq_ctx
-        # don't keep strong reference to notifier so that it can be garbage
-        # collected normally and it will let us know then that we can stop
-        self.w_notifier = WeakMethod(notifier)
-
-        # create a zmq synchronised channel to receive commands
-        self._commands = zmq_ctx.socket(zmq.PAIR)
-        self._commands.connect("inproc://" + uri)
+        self._ctx = zmq.Context(1)
+        cmd_address = "inproc://VASubscriber/%x" % (id(self),)
+
+        # The commands can be sent by any thread, so it's protected by a lock.
+        # The thread never waits for the answer, to avoid deadlocks in case the
+        # thread is itself blocked by a VA listener.
+        self._cmd_lock = threading.Lock()
+        self._cmd_sender = self._ctx.socket(zmq.PAIR)
+        self._cmd_sender.sndhwm = 0  # never block
+        self._cmd_sender.bind(cmd_address)
+        self._commands = self._ctx.socket(zmq.PAIR)
+        self._commands.rcvhwm = 0
+        self._commands.connect(cmd_address)
 
         # create a zmq subscription to receive the data
-        self.data = zmq_ctx.socket(zmq.SUB)
-        self.data.connect("ipc://" + uri)
+        self.data = self._ctx.socket(zmq.SUB)
+
+        self._lock = threading.Lock()  # to protect the subscription information
+        self._subscriptions = {}  # int -> (topic, WeakMethod)
+        self._topics = {}  # topic -> set of int (subscriptions)
+        self._max_discard = {}  # topic -> int
+        self._connections = collections.Counter()  # address -> number of subscriptions (only used by the thread)
+        self._next_id = 0
+        self._pending = {}  # token -> threading.Event, for the commands waited for
+
+    def subscribe(self, global_name, notifier, max_discard):
+        """
+        Start receiving the new values of a VA
+        global_name (str): unique name of the VA
+        notifier (callable): method to call when a new value arrives. Only a
+          weak reference is kept.
+        max_discard (int): amount of updates that can be discarded in a row if
+          a new one is already available.
+        return (int): id of the subscription, to pass to unsubscribe()
+        """
+        topic = _get_topic(global_name)
+        with self._lock:
+            sid = self._next_id
+            self._next_id += 1
+            self._subscriptions[sid] = (topic, WeakMethod(notifier))
+            self._topics.setdefault(topic, set()).add(sid)
+            self._max_discard[topic] = min(max_discard, self._max_discard.get(topic, max_discard))
+        self._send_command(b"SUB", global_name, wait=True)
+        return sid
+
+    def unsubscribe(self, sid):
+        """
+        Stop receiving the new values of a VA
+        sid (int): id of the subscription, as returned by subscribe()
+        """
+        with self._lock:
+            try:
+                topic, _ = self._subscriptions.pop(sid)
+            except KeyError:
+                return  # Already removed (because the notifier was gone)
+            self._topics[topic].discard(sid)
+            if not self._topics[topic]:
+                del self._topics[topic]
+                del self._max_discard[topic]
+            global_name = topic[:-1].decode("utf-8")
+        self._send_command(b"UNSUB", global_name)
+
+    def _send_command(self, cmd, global_name, wait=False):
+        """
+        cmd (bytes): SUB or UNSUB
+        global_name (str): unique name of the VA
+        wait (bool): if True, wait (a little) for the command to be processed,
+          so that the values sent afterwards are received.
+        """
+        if threading.current_thread() is self:
+            # Typically, a VA listener which (un)subscribes
+            self._process_command(cmd, global_name)
+            return
+
+        with self._cmd_lock:
+            if wait:
+                processed = threading.Event()
+                token = b"%x" % (id(processed),)
+                self._pending[token] = processed
+            else:
+                token = b""
+            self._cmd_sender.send_multipart([cmd, global_name.encode("utf-8"), token])
+
+        # Don't wait forever, as the thread might be busy in a listener
+        if wait and not processed.wait(1):
+            logging.warning("%s of VA %s not processed after 1 s, some values might be missed",
+                            cmd.decode("ascii"), global_name)
+        self._pending.pop(token, None)
+
+    def _process_command(self, cmd, global_name):
+        address = "ipc://" + global_name
+        topic = _get_topic(global_name)
+        if cmd == b"SUB":
+            if self._connections[address] == 0:
+                self.data.connect(address)
+            self._connections[address] += 1
+            self.data.setsockopt(zmq.SUBSCRIBE, topic)
+        elif cmd == b"UNSUB":
+            self.data.setsockopt(zmq.UNSUBSCRIBE, topic)
+            self._connections[address] -= 1
+            if self._connections[address] <= 0:
+                del self._connections[address]
+                try:
+                    self.data.disconnect(address)
+                except zmq.ZMQError:
+                    pass  # The VA is already gone
+        else:
+            logging.warning("Received unknown message %s", cmd)
+
+    def _receive_all(self):
+        """
+        Read all the messages already received
+        return (list of (bytes, value)): topic and value
+        """
+        messages = []
+        while self.data.getsockopt(zmq.EVENTS) & zmq.POLLIN and len(messages) < 10000:
+            topic = self.data.recv()
+            value = self.data.recv_pyobj()
+            messages.append((topic, value))
+        return messages
 
     def run(self):
         # Process messages for commands and data
         poller = zmq.Poller()
         poller.register(self._commands, zmq.POLLIN)
         poller.register(self.data, zmq.POLLIN)
-        discarded = 0
+        discarded = collections.Counter()  # topic -> number of values discarded in a row
         while True:
             socks = dict(poller.poll())
 
             # process commands
             if socks.get(self._commands) == zmq.POLLIN:
-                message = self._commands.recv()
-                if message == b"SUB":
-                    self.data.setsockopt(zmq.SUBSCRIBE, b'')
-                    self._commands.send(b"SUBD")
-                elif message == b"UNSUB":
-                    self.data.setsockopt(zmq.UNSUBSCRIBE, b'')
-                    # no confirmation (async)
-                elif message == b"STOP":
-                    self._commands.close()
-                    self.data.close()
-                    return
+                while self._commands.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                    cmd, global_name, token = self._commands.recv_multipart()
+                    self._process_command(cmd, global_name.decode("utf-8"))
+                    processed = self._pending.get(token)
+                    if processed:
+                        processed.set()
 
             # receive data
             if socks.get(self.data) == zmq.POLLIN:
-                value = self.data.recv_pyobj()
-                # more fresh data already?
-                if (
-                        self.data.getsockopt(zmq.EVENTS) & zmq.POLLIN and
-                        discarded < self.max_discard
-                ):
-                    discarded += 1
-                    continue
-                if discarded:
-                    logging.debug("VA discarded %d values", discarded)
-                discarded = 0
-
-                try:
-                    self.w_notifier(value)
-                except WeakRefLostError:
-                    self._commands.close()
-                    self.data.close()
-                    return
+                messages = self._receive_all()
+                # Index of the last message for each VA
+                latest = {topic: i for i, (topic, _) in enumerate(messages)}
+                for i, (topic, value) in enumerate(messages):
+                    with self._lock:
+                        max_discard = self._max_discard.get(topic)
+                        if max_discard is None:  # Not subscribed anymore
+                            continue
+                        notifiers = [(sid, self._subscriptions[sid][1]) for sid in self._topics[topic]]
+
+                    # more fresh data already?
+                    if i < latest[topic] and discarded[topic] < max_discard:
+                        discarded[topic] += 1
+                        continue
+                    if discarded[topic]:
+                        logging.debug("VA discarded %d values", discarded[topic])
+                    discarded[topic] = 0
+
+                    for sid, notifier in notifiers:
+                        try:
+                            notifier(value)
+                        except WeakRefLostError:
+                            self.unsubscribe(sid)
 
 
 def unregister_vigilant_attributes(self):
@@ -24,11 +24,15 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 import logging
 
 from Pyro4.core import oneway
+import gc
+import numpy
 from odemis import model
+from odemis.model import _codec, _shm
 import pickle
 import threading
 import time
 import unittest
+import zmq
 
 
 class SimpleDataFlow(model.DataFlow):
@@ -242,6 +246,84 @@ class TestDataFlow(unittest.TestCase):
         self.assertEqual(self.left2, 0)  # it should be done before left
         self.assertEqual(self.left, 0)
 
+    def test_df_max_queue(self):
+        """
+        Check the different queue policies with a listener slower than the generator
+        """
+        self.df = SimpleDataFlow()
+        self.received_latest = []
+        self.received_all = []
+        self.df.subscribe(self.receive_slow_latest, max_queue=1)
+        self.df.subscribe(self.receive_slow_all, max_queue=0)
+        self.df.subscribe(self.receive_slow_bounded, max_queue=3)
+        self.df.subscribe(self.receive_fast)
+
+        time.sleep(2)
+        stats_latest = self.df.get_listener_stats(self.receive_slow_latest)
+        stats_all = self.df.get_listener_stats(self.receive_slow_all)
+        stats_bounded = self.df.get_listener_stats(self.receive_slow_bounded)
+        stats_fast = self.df.get_listener_stats(self.receive_fast)
+        self.df.unsubscribe(self.receive_slow_latest)
+        self.df.unsubscribe(self.receive_slow_all)
+        self.df.unsubscribe(self.receive_slow_bounded)
+        self.df.unsubscribe(self.receive_fast)
+
+        self.assertEqual(stats_latest["max_queue"], 1)
+        self.assertGreater(stats_latest["dropped"], 0)
+        self.assertLessEqual(stats_latest["queued"], 1)
+        # Always the latest data, so it must be increasing
+        nums = [d.metadata["num"] for d in self.received_latest]
+        self.assertEqual(nums, sorted(nums))
+
+        self.assertEqual(stats_bounded["max_queue"], 3)
+        self.assertGreater(stats_bounded["dropped"], 0)
+        self.assertLessEqual(stats_bounded["queued"], 3)
+
+        # Nothing dropped, the queue increases
+        self.assertEqual(stats_all["dropped"], 0)
+        self.assertGreater(stats_all["queued"], 0)
+        nums = [d.metadata["num"] for d in self.received_all]
+        self.assertEqual(nums, list(range(len(nums))))
+
+        self.assertIsNone(stats_fast["max_queue"])
+        with self.assertRaises(KeyError):
+            self.df.get_listener_stats(self.receive_fast)
+
+    def test_df_max_queue_gc(self):
+        """
+        Check a listener with a queue which is garbage-collected is unsubscribed,
+        and so the generation stops
+        """
+        self.df = SimpleDataFlow()
+
+        class Receiver(object):
+            def receive(self, dataflow, data):
+                pass
+
+        receiver = Receiver()
+        self.df.subscribe(receiver.receive, max_queue=1)
+        time.sleep(0.3)
+        del receiver
+        time.sleep(0.5)  # Wait for the next data, to detect the listener is gone
+
+        self.assertEqual(len(self.df._listeners), 0)
+        self.df._thread.join(1)
+        self.assertFalse(self.df._thread.is_alive())
+
+    def receive_slow_latest(self, dataflow, data):
+        self.received_latest.append(data)
+        time.sleep(0.35)
+
+    def receive_slow_all(self, dataflow, data):
+        self.received_all.append(data)
+        time.sleep(0.35)
+
+    def receive_slow_bounded(self, dataflow, data):
+        time.sleep(0.35)
+
+    def receive_fast(self, dataflow, data):
+        pass
+
     def receive_data(self, dataflow, data):
         """
         callback for df
@@ -263,6 +345,37 @@ class TestDataFlow(unittest.TestCase):
         if self.left2 <= 0:
             dataflow.unsubscribe(self.receive_data2)
 
+    def test_df_tcp_connect_first(self):
+        """
+        Check a remote listener connected before subscribing receives all the data via TCP
+        """
+        self.df = SimpleDataFlow()
+        self.df._global_name = "test-tcp"
+        address = self.df.get_tcp_address()
+        self.assertTrue(address.startswith("tcp://127.0.0.1:"))
+
+        ctx = zmq.Context(1)
+        sub = ctx.socket(zmq.SUB)
+        sub.connect(address)
+        sub.setsockopt(zmq.SUBSCRIBE, b'')
+        time.sleep(0.2)  # Leave time for the subscription to reach the publisher
+
+        transport = self.df.subscribe("remote", codecs=_codec.get_codecs())
+        self.assertEqual(transport["tcp"], address)
+        try:
+            self.assertTrue(sub.poll(2000), "No data received via TCP")
+            dformat = sub.recv_pyobj()
+            md = sub.recv_pyobj()
+            cdata = sub.recv()
+            self.assertEqual(md["num"], 0)  # The first data was not lost
+            data = _codec.decompress(cdata, dformat["codec"], dformat["dtype"], dformat["shape"])
+            self.assertEqual(data.shape, (2, 2))
+        finally:
+            self.df.unsubscribe("remote")
+            self.df._unregister()
+            sub.close()
+            ctx.term()
+
     def test_synchronized_df(self):
         self.dfe = SimpleDataFlow()
         self.dfs = SynchronizableDataFlow()
@@ -361,5 +474,159 @@ class TestDataFlow(unittest.TestCase):
         self.assertEqual(self.left, 10)
 
 
+class TestStridedBuffer(unittest.TestCase):
+
+    def test_views(self):
+        data = numpy.arange(200 * 100, dtype=numpy.uint16).reshape(200, 100)
+        views = (data.T,  # transposed
+                 data[::-1, ::-1],  # flipped
+                 data.T[::-1],  # rotated
+                 data[10:190, 3:97],  # cropped
+                 numpy.asfortranarray(data)[:, 1:],  # Fortran order
+                 )
+        for v in views:
+            buf, offset, strides = model.get_strided_buffer(v)
+            self.assertLessEqual(buf.nbytes, model.MAX_STRIDED_SPAN_RATIO * v.nbytes)
+            # Rebuild from a copy of the memory, as it's done after transfer
+            rebuilt = numpy.ndarray(v.shape, v.dtype, buffer=buf.tobytes(), offset=offset, strides=strides)
+            numpy.testing.assert_array_equal(rebuilt, v)
+
+        # Too sparse
+        self.assertIsNone(model.get_strided_buffer(data[::4]))
+
+    def test_transposed_speed(self):
+        """
+        Compare the throughput of transposed frames sent over 0MQ by copying
+        them, or by passing the memory + strides.
+        """
+        ctx = zmq.Context(1)
+        sender = ctx.socket(zmq.PAIR)
+        sender.bind("inproc://test_strided")
+        receiver = ctx.socket(zmq.PAIR)
+        receiver.connect("inproc://test_strided")
+
+        # Typical camera frame, rotated by the driver
+        frame = numpy.random.randint(0, 4096, (2048, 2048), dtype=numpy.uint16).T
+        n = 20
+        try:
+            tstart = time.time()
+            for i in range(n):
+                sender.send(memoryview(numpy.require(frame, requirements=["C_CONTIGUOUS"])), copy=False)
+                buf = receiver.recv(copy=False)
+                copied = numpy.frombuffer(buf, dtype=frame.dtype).reshape(frame.shape)
+            dur_copy = time.time() - tstart
+
+            tstart = time.time()
+            for i in range(n):
+                sbuf, offset, strides = model.get_strided_buffer(frame)
+                sender.send(memoryview(sbuf), copy=False)
+                buf = receiver.recv(copy=False)
+                strided = numpy.ndarray(frame.shape, frame.dtype, buffer=buf, offset=offset, strides=strides)
+            dur_strided = time.time() - tstart
+        finally:
+            sender.close()
+            receiver.close()
+            ctx.term()
+
+        numpy.testing.assert_array_equal(copied, frame)
+        numpy.testing.assert_array_equal(strided, frame)
+        print("Sending %d transposed frames took %g s with copy, %g s with strides (%g fps vs %g fps)" %
+              (n, dur_copy, dur_strided, n / dur_copy, n / dur_strided))
+        self.assertLess(dur_strided, dur_copy)
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_round_trip(self):
+        img = numpy.random.randint(1000, 1100, (256, 200), dtype=numpy.uint16)
+        arrays = (img,
+                  img.T,  # non-contiguous
+                  img.astype(numpy.float32),
+                  img.astype(numpy.uint8),
+                  numpy.zeros((0,), dtype=numpy.int32),
+                  )
+        for codec in _codec.get_codecs():
+            for a in arrays:
+                cdata = _codec.compress(a, codec)
+                out = _codec.decompress(cdata, codec, str(a.dtype), a.shape)
+                self.assertEqual(out.dtype, a.dtype)
+                numpy.testing.assert_array_equal(out, a)
+
+            # Images with little noise should compress (lz4 doesn't do entropy
+            # coding, so the noisy low bytes are hardly compressed)
+            self.assertLess(len(_codec.compress(img, codec)), img.nbytes / 1.25)
+
+    def test_choose_codec(self):
+        codecs = set(_codec.get_codecs())
+        self.assertIn("zlib", codecs)  # always available
+        self.assertIn(_codec.choose_codec(numpy.uint16, [codecs]), codecs)
+        self.assertEqual(_codec.choose_codec(numpy.float64, [codecs, {"zlib"}]), "zlib")
+        with self.assertRaises(LookupError):
+            _codec.choose_codec(numpy.uint16, [codecs, {"foo"}])
+
+
+@unittest.skipUnless(_shm.is_available(), "No shared memory available")
+class TestShmRing(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = _shm.ShmRingWriter(64 * 32 * 2)
+        self.reader = _shm.ShmRingReader()
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_publish_read(self):
+        data = numpy.arange(64 * 32, dtype=numpy.uint16).reshape(64, 32)
+        # Non-contiguous array, which should be received as C-order
+        shm = self.writer.publish(data.T, [2])
+        self.assertIsNotNone(shm)
+        array = self.reader.get_array(shm, "uint16", (32, 64), 2)
+        numpy.testing.assert_array_equal(array, data.T)
+        self.assertFalse(array.flags.writeable)
+        self.assertTrue(self.writer.has_pending(2))
+
+        # Too big => cannot be shared
+        self.assertIsNone(self.writer.publish(numpy.zeros((128, 32), dtype=numpy.uint16), [2]))
+
+        # Once the array (and its views) are gone, the slot is free
+        view = array[2:4]
+        del array
+        gc.collect()
+        self.assertTrue(self.writer.has_pending(2))
+        del view
+        gc.collect()
+        self.assertFalse(self.writer.has_pending(2))
+
+    def test_ring_full(self):
+        held = []
+        for i in range(_shm.RING_SLOTS):
+            shm = self.writer.publish(numpy.full((64,), i, dtype=numpy.uint8), [0])
+            held.append(self.reader.get_array(shm, "uint8", (64,), 0))
+        # No more slots available, until one is released
+        self.assertIsNone(self.writer.publish(numpy.zeros((64,), dtype=numpy.uint8), [0]))
+        for i, a in enumerate(held):
+            self.assertTrue((a == i).all())
+        del held[0]
+        gc.collect()
+        self.assertIsNotNone(self.writer.publish(numpy.zeros((64,), dtype=numpy.uint8), [0]))
+
+    def test_dropped_message(self):
+        # First message is never received, the slot should be released anyway
+        # as soon as the next message is received
+        self.writer.publish(numpy.zeros((64,), dtype=numpy.uint8), [1])
+        shm = self.writer.publish(numpy.ones((64,), dtype=numpy.uint8), [1])
+        array = self.reader.get_array(shm, "uint8", (64,), 1)
+        readers = self.writer._hdr["readers"][:, 1]
+        self.assertEqual(readers.sum(), 1)
+
+        # After unsubscribing, only the data still used is kept
+        self.writer.publish(numpy.zeros((64,), dtype=numpy.uint8), [1])
+        self.reader.release_all(1)
+        self.assertEqual(readers.sum(), 1)
+        del array
+        gc.collect()
+        self.assertFalse(self.writer.has_pending(1))
+
+
 if __name__ == "__main__":
     unittest.main()
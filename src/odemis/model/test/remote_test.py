@@ -614,6 +614,117 @@ class RemoteTest(unittest.TestCase):
         dfs.synchronizedOn(None)
         self.assertEqual(dfs.get_event_type(), None)
 
+    def test_dataflow_shm(self):
+        """
+        Check the data is received read-only via shared memory, and it's still
+        correct when the listener holds more arrays than the shared memory can
+        contain.
+        """
+        if not model._shm.is_available():
+            self.skipTest("No shared memory available")
+        self.comp.data.reset()
+        self.received = []
+
+        def receive_and_keep(dataflow, data):
+            self.received.append(data)
+
+        self.comp.data.subscribe(receive_and_keep)
+        time.sleep(1)
+        self.comp.data.unsubscribe(receive_and_keep)
+
+        self.assertGreater(len(self.received), model._shm.RING_SLOTS)
+        self.assertFalse(self.received[0].flags.writeable)
+        for da in self.received:
+            self.assertEqual(da.shape, (2048, 2048))
+            # The generator marks the line number count % 2048
+            count = da[0, 0]
+            self.assertTrue((da[count % 2048, 1:] == 255).all())
+        del self.received
+
+    def test_dataflow_max_queue(self):
+        """
+        Check a slow listener with a lossless queue receives all the data
+        """
+        self.comp.data.reset()
+        self.received = []
+
+        def receive_slow(dataflow, data):
+            self.received.append(int(data[0, 0]))
+            time.sleep(0.1)
+
+        self.comp.data.subscribe(receive_slow, max_queue=0)
+        time.sleep(1)
+        stats = self.comp.data.get_listener_stats(receive_slow)
+        self.comp.data.unsubscribe(receive_slow)
+
+        self.assertEqual(stats["max_queue"], 0)
+        self.assertEqual(stats["dropped"], 0)
+        self.assertGreater(stats["queued"], 0)
+        self.assertGreater(len(self.received), 1)
+        self.assertEqual(self.received, list(range(self.received[0], self.received[0] + len(self.received))))
+        del self.received
+
+    def test_dataflow_max_queue_mixed(self):
+        """
+        Check a listener with a queue doesn't change the policy of the other listeners
+        """
+        self.comp.data.reset()
+        self.received = []
+        self.received_direct = []
+
+        def receive_slow(dataflow, data):
+            self.received.append(int(data[0, 0]))
+            time.sleep(0.1)
+
+        def receive_direct_slow(dataflow, data):
+            self.received_direct.append(int(data[0, 0]))
+            time.sleep(0.1)
+
+        self.comp.data.subscribe(receive_slow, max_queue=0)
+        self.comp.data.subscribe(receive_direct_slow)
+        time.sleep(1)
+        stats = self.comp.data.get_listener_stats(receive_slow)
+        stats_direct = self.comp.data.get_listener_stats(receive_direct_slow)
+        self.comp.data.unsubscribe(receive_direct_slow)
+        self.comp.data.unsubscribe(receive_slow)
+
+        # The queued listener receives everything
+        self.assertEqual(stats["dropped"], 0)
+        self.assertEqual(self.received, list(range(self.received[0], self.received[0] + len(self.received))))
+        # The direct listener still only receives the latest data
+        self.assertGreater(stats_direct["dropped"], 0)
+        self.assertGreater(len(self.received_direct), 1)
+        self.assertNotEqual(self.received_direct,
+                            list(range(self.received_direct[0], self.received_direct[0] + len(self.received_direct))))
+        del self.received
+        del self.received_direct
+
+    def test_dataflow_tcp(self):
+        """
+        Check the data can be received via TCP, compressed
+        """
+        prev_transport = model._dataflow.DATAFLOW_TRANSPORT
+        model._dataflow.DATAFLOW_TRANSPORT = "tcp"
+        try:
+            self.count = 0
+            self.expected_shape = (2048, 2048)
+            self.data_arrays_sent = 0
+            self.comp.data.reset()
+
+            self.comp.data.subscribe(self.receive_data)
+            time.sleep(1)
+            self.comp.data.unsubscribe(self.receive_data)
+        finally:
+            model._dataflow.DATAFLOW_TRANSPORT = prev_transport
+
+        self.assertGreaterEqual(self.count, 1)
+        stats = self.comp.data.get_tcp_stats()
+        print("Sent %d arrays via TCP with compression ratio %g in %g s" %
+              (stats["count"], stats["ratio"], stats["compress_time"]))
+        self.assertGreaterEqual(stats["count"], self.count)
+        # The arrays are mostly 0's => very compressible
+        self.assertGreater(stats["ratio"], 10)
+
 #    @unittest.skip("simple")
     def test_dataflow_stridden(self):
         # test that stridden array can be passed (even if less efficient)
@@ -753,6 +864,33 @@ class RemoteTest(unittest.TestCase):
         except TypeError:
             pass # as it should be
 
+    def test_va_period(self):
+        """
+        Check the notifications are coalesced when subscribing with a period,
+        and all the VAs of a component are received by a single thread
+        """
+        prop = self.comp.prop
+        prop.value = 0
+        self.called = 0
+        self.last_value = None
+        prop.subscribe(self.receive_va_update, period=0.1)
+        nthreads = threading.active_count()
+        cont = self.comp.cont
+        cont.subscribe(self.receive_va_update)
+        # No new thread needed for the second VA
+        self.assertEqual(threading.active_count(), nthreads)
+        cont.unsubscribe(self.receive_va_update)
+
+        for i in range(1, 51):
+            prop.value = i
+            time.sleep(0.005)
+        time.sleep(0.2)  # give time to receive the last notification
+        prop.unsubscribe(self.receive_va_update)
+
+        # Every 0.1 s at most, but the last value is always received
+        self.assertLess(self.called, 10)
+        self.assertEqual(self.last_value, 50)
+
     def receive_va_update(self, value):
         logging.debug("Update va to %s", value)
         self.called += 1
@@ -62,6 +62,91 @@ class VigilantAttributeTest(unittest.TestCase):
         self.assertTrue(prop.value == 0)
         self.assertTrue(self.called == 2)
 
+    def test_notify_period(self):
+        prop = model.IntVA(0)
+        self.called = 0
+        self.last_value = None
+
+        def receive(v):
+            self.called += 1
+            self.last_value = v
+
+        prop.subscribe(receive, period=0.1)
+        prop.value = 1  # +1, immediately
+        self.assertEqual(self.called, 1)
+        for i in range(2, 51):
+            prop.value = i  # only the latest value should be passed
+            time.sleep(0.005)
+        time.sleep(0.2)
+
+        self.assertLess(self.called, 10)
+        self.assertEqual(self.last_value, 50)
+
+        # After unsubscribing, the pending value is dropped
+        prop.value = 51
+        prop.value = 52
+        prop.unsubscribe(receive)
+        called_before = self.called
+        time.sleep(0.2)
+        self.assertEqual(self.called, called_before)
+        self.assertEqual(self.last_value, 51)
+
+        with self.assertRaises(ValueError):
+            prop.subscribe(receive, period=0)
+
+    def test_notify_period_resubscribe(self):
+        """
+        Test re-subscribing a listener drops the value pending with the previous period
+        """
+        prop = model.IntVA(0)
+        self.received = []
+
+        def receive(v):
+            self.received.append(v)
+
+        prop.subscribe(receive, period=0.1)
+        prop.value = 1  # immediately
+        prop.value = 2  # pending, at the end of the period
+        prop.subscribe(receive)  # no period anymore
+        prop.value = 3  # immediately
+        time.sleep(0.2)
+        self.assertEqual(self.received, [1, 3])
+
+        # Same when changing the period
+        prop.subscribe(receive, period=0.1)
+        prop.value = 4
+        prop.value = 5
+        prop.subscribe(receive, period=0.05)
+        prop.value = 6
+        time.sleep(0.2)
+        self.assertEqual(self.received[-1], 6)
+        self.assertNotIn(5, self.received)
+        prop.unsubscribe(receive)
+
+    def test_notify_period_gc(self):
+        """
+        Test a listener with a period which is garbage-collected is forgotten
+        """
+        prop = model.IntVA(0)
+
+        class Receiver(object):
+            def receive(self, v):
+                pass
+
+        receiver = Receiver()
+        prop.subscribe(receiver.receive, period=0.1)
+        prop.value = 1
+        del receiver
+        prop.value = 2  # Within the period => passed by a timer
+        time.sleep(0.2)
+        self.assertEqual(len(prop._listeners), 0)
+        self.assertEqual(len(prop._coalescers), 0)
+
+        # The VA can still be garbage-collected
+        ref = weakref.ref(prop)
+        del prop
+        self.assertIsNone(ref())
+
     def test_del(self):
         """
         Test that the VA is properly deleted.
@@ -188,6 +188,26 @@ class BackendContainer(model.Container):
         # From now on, we'll really listen to external calls
         super(BackendContainer, self).run()
 
+    def getSnapshot(self):
+        """
+        Describe all the components alive, including the ones running in
+        sub-containers. Each container is asked only once.
+        returns (list of (Component, dict)): each component with its snapshot
+          (cf Component._getsnapshot())
+        """
+        snapshots = super(BackendContainer, self).getSnapshot()
+        for cname, container in list(self._instantiator.sub_containers.items()):
+            try:
+                snapshots.extend(container.getSnapshot())
+            except Exception:
+                logging.warning("Failed to get snapshot from container %s", cname, exc_info=True)
+
+        # Only report the components which are officially available (ex: not
+        # the Metadata Updater, or a component still being initialised)
+        mic = self._instantiator.microscope
+        names = {c.name for c in mic.alive.value} | {mic.name}
+        return [(c, s) for c, s in snapshots if s["roattributes"].get("name") in names]
+
     def _instantiate_all(self):
         """
         Thread continuously monitoring the components that need to be instantiated
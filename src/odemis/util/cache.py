@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+# Caches of (big) arrays, bounded by the memory they use
+
+import collections
+import logging
+import threading
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache which keeps the most recently used values, as long as
+    the total size of the values doesn't exceed a given number of bytes.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        max_bytes (0 <= int): maximum number of bytes used by all the values
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (value, nbytes), oldest first
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """
+        (int): number of bytes currently used by the values
+        """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Look for a value, and mark it as the most recently used.
+        key (hashable): the key of the value
+        default (object): returned if the key is not in the cache
+        return (object): the value, or the default
+        """
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, nbytes=None):
+        """
+        Add (or replace) a value, and evict the least recently used values if
+        the cache is too big.
+        key (hashable): the key of the value
+        value (object): the value to store
+        nbytes (None or 0 <= int): the memory used by the value. If None,
+          value.nbytes is used (ie, it must be a numpy array).
+        """
+        if nbytes is None:
+            nbytes = value.nbytes
+        if nbytes > self.max_bytes:
+            logging.debug("Not caching value of %d bytes, bigger than the cache", nbytes)
+            self.discard(key)
+            return
+
+        with self._lock:
+            prev = self._entries.pop(key, None)
+            if prev is not None:
+                self._nbytes -= prev[1]
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, enbytes) = self._entries.popitem(last=False)
+                self._nbytes -= enbytes
+
+    def discard(self, key):
+        """
+        Remove a value from the cache, if it's present
+        key (hashable): the key of the value
+        """
+        with self._lock:
+            prev = self._entries.pop(key, None)
+            if prev is not None:
+                self._nbytes -= prev[1]
+
+    def purge(self, predicate):
+        """
+        Remove all the values whose key matches the given condition
+        predicate (callable: key -> bool): returns True if the value must be removed
+        """
+        with self._lock:
+            for k in [k for k in self._entries if predicate(k)]:
+                _, nbytes = self._entries.pop(k)
+                self._nbytes -= nbytes
+
+    def clear(self):
+        """
+        Remove all the values
+        """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
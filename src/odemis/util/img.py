@@ -22,13 +22,16 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 # various functions to convert and modify images (as DataArray)
 
+import collections
 import logging
 import math
 import numpy
 from odemis import model
 import scipy.ndimage
+import scipy.sparse
 import cv2
 import copy
+import threading
 from odemis.model import DataArray
 from odemis.model import MD_DWELL_TIME, MD_EXP_TIME, TINT_FIT_TO_RGB, TINT_RGB_AS_IS
 from odemis.util import get_best_dtype_for_acc, transform
@@ -241,30 +244,61 @@ def compactHistogram(hist, length):
     chist = hist.reshape(-1, bin_size)
     return numpy.sum(chist, 1)
 
-# TODO: compute histogram faster. There are several ways:
-# * x=numpy.bincount(a.flat, minlength=depth) => fast (~0.03s for
-#   a 2048x2048 array) but only works on flat array with uint8 and uint16 and
-#   creates 2**16 bins if uint16 (so need to do a reshape and sum on top of it)
-# * numpy.histogram(a, bins=256, range=(0,depth)) => slow (~0.09s for a
-#   2048x2048 array) but works exactly as needed directly in every case.
-# * see weave? (~ 0.01s for 2048x2048 array of uint16) eg:
-#  timeit.timeit("counts=numpy.zeros((2**16), dtype=numpy.uint32);
-#  weave.inline( code, ['counts', 'idxa'])", "import numpy;from scipy import weave; code=r\"for (int i=0; i<Nidxa[0]; i++) { COUNTS1( IDXA1(i)>>8)++; }\"; idxa=numpy.ones((2048*2048), dtype=numpy.uint16)+15", number=100)
-# * see cython?
-# for comparison, a.min() + a.max() are 0.01s for 2048x2048 array
+def _fastHistogramSupported(data):
+    """
+    return (bool): True if the data can be passed to img_fast.histogram()
+    """
+    return (img_fast is not None and data.ndim == 2 and data.flags.c_contiguous
+            and data.dtype in img_fast.SUPPORTED_DTYPES and data.dtype.isnative)
+
+
+def minmax(data, step=1):
+    """
+    Find the minimum and maximum values of an image, in a single pass.
+    data (numpy.ndarray of numbers): greyscale image
+    step (1<=int): only look at one pixel every step along the last two dimensions
+    return (2 numbers): min and max values (of the same type as the data, for
+      integers)
+    """
+    if _fastHistogramSupported(data):
+        _, mn, mx = img_fast.histogram(data, step=step)
+        if data.dtype.kind in "biu" and mn <= mx:  # Not empty
+            # Values > 2**53 may be rounded, so look at them again
+            mn, mx = int(mn), int(mx)
+            if max(abs(mn), abs(mx)) < 2 ** 53:
+                return mn, mx
+        else:
+            return mn, mx
 
+    if step > 1:
+        data = data[..., ::step, ::step]
+    # cast to ndarray to ensure a scalar (instead of a DataArray)
+    data = data.view(numpy.ndarray)
+    if data.dtype.kind in "biu":
+        return int(data.min()), int(data.max())
+    return data.min(), data.max()
 
-def histogram(data, irange=None):
+
+def histogram(data, irange=None, length=None, step=1):
     """
     Compute the histogram of the given image.
     data (numpy.ndarray of numbers): greyscale image
     irange (None or tuple of 2 unsigned int): min/max values to be found
       in the data. None => auto (min, max will be detected from the data)
+    length (None or 0<int): maximum number of bins. If None, for integers
+      one bin per value is used (but at most 8192 bins, unless the data is 8
+      or 16 bits unsigned), and 256 bins for floats.
+      For integers, the values are grouped in bins the same way as
+      compactHistogram() does. So, to display a 256-bin histogram, it's faster to
+      directly pass length=256 than to compact the full histogram.
+    step (1<=int): only count one pixel every step along the last two
+      dimensions. It gives a good estimation of the histogram of large images,
+      much faster.
     return hist, edges:
      hist (ndarray 1D of 0<=int): number of pixels with the given value
       Note that the length of the returned histogram is not fixed. If irange
       is defined and data is integer, the length is always equal to
-      irange[1] - irange[0] + 1.
+      irange[1] - irange[0] + 1 (unless length is smaller or it's more than 8192).
      edges (tuple of numbers): lowest and highest bound of the histogram.
        edges[1] is included in the bin. If irange is defined, it's the same
        values.
@@ -275,11 +309,37 @@ def histogram(data, irange=None):
             irange = (idt.min, idt.max)
             if data.itemsize > 2:
                 # range is too big to be used as is => look really at the data
-                irange = (int(data.view(numpy.ndarray).min()),
-                          int(data.view(numpy.ndarray).max()))
+                irange = minmax(data, step)
+        else:
+            irange = minmax(data, step)
+
+    # The optimised version computes everything in a single (parallel) pass
+    if _fastHistogramSupported(data):
+        if data.dtype.kind in "biu":
+            width = int(irange[1]) - int(irange[0]) + 1
+            if length is None:
+                if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2:
+                    flength = width  # Same as numpy.bincount()
+                else:
+                    flength = min(8192, width)
+                if width % flength:
+                    flength = None  # Bins of non-integer size => use numpy
+            else:
+                # Same bins as compactHistogram(): the last one may be partial,
+                # but there are no bins past irange[1]
+                binw = -(-width // length)  # ceil
+                flength = -(-width // binw)
+        elif irange[0] < irange[1]:  # float (and not NaN)
+            flength = 256 if length is None else length
         else:
-            # cast to ndarray to ensure a scalar (instead of a DataArray)
-            irange = (data.view(numpy.ndarray).min(), data.view(numpy.ndarray).max())
+            flength = None
+
+        if flength:
+            hist, _, _ = img_fast.histogram(data, irange, flength, step)
+            return hist, tuple(irange)
+
+    if step > 1:
+        data = data[..., ::step, ::step]
 
     # short-cuts (for the most usual types)
     if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2 and len(data) > 0:
@@ -287,21 +347,24 @@ def histogram(data, irange=None):
         # and second halves of the histogram.
         # TODO: for 32 or 64 bits with full range, convert to a view looking
         # only at the 2 high bytes.
-        length = irange[1] - irange[0] + 1
-        hist = numpy.bincount(data.flat, minlength=length)
+        length_full = irange[1] - irange[0] + 1
+        hist = numpy.bincount(data.flat, minlength=length_full)
         edges = (0, hist.size - 1)
         if edges[1] > irange[1]:
             logging.warning("Unexpected value %d outside of range %s", edges[1], irange)
     else:
         if data.dtype.kind in "biu":
-            length = min(8192, irange[1] - irange[0] + 1)
+            length_full = min(8192, irange[1] - irange[0] + 1)
         else:
             # For floats, it will automatically find the minimum and maximum
-            length = 256
-        hist, all_edges = numpy.histogram(data, bins=length, range=irange)
+            length_full = 256
+        hist, all_edges = numpy.histogram(data, bins=length_full, range=irange)
         edges = (max(irange[0], all_edges[0]),
                  min(irange[1], all_edges[-1]))
 
+    if length is not None and hist.size > length:
+        hist = compactHistogram(hist, length)
+
     return hist, edges
 
 
@@ -387,73 +450,39 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         if irange[0] == irange[1]:
             logging.info("Requested RGB conversion with null-range %s", irange)
 
-    # Determine if it is necessary to deal with the color map
-    # Otherwise, continue with the old method
-
-    if isinstance(tint, colors.Colormap):
-        # Normalize the data to the interval [0, 1.0]
-        # TODO: Add logarithmic normalization with LogNorm
-        # norm = colors.LogNorm(vmin=data.min(), vmax=data.max())
-        norm = colors.Normalize(vmin=irange[0], vmax=irange[1], clip=True)
-        rgb = tint(norm(data))  # returns an rgba array
-        rgb = rgb[:, :, :3]  # discard alpha channel
-        out = numpy.empty(rgb.shape, dtype=numpy.uint8)
-        numpy.multiply(rgb, 255, casting='unsafe', out=out)
-        return out
-
-    if data.dtype == numpy.uint8 and irange[0] == 0 and irange[1] == 255:
-        # short-cut when data is already the same type
-        # logging.debug("Applying direct range mapping to RGB")
-        drescaled = data
-        # TODO: also write short-cut for 16 bits by reading only the high byte?
-    else:
-        # If data might go outside of the range, clip first
-        if data.dtype.kind in "iu":
-            # no need to clip if irange is the whole possible range
+    if data.dtype.kind in "iu":
+        # Ensure B&W if there is only one value allowed
+        if irange[0] >= irange[1]:
             idt = numpy.iinfo(data.dtype)
-            # Ensure B&W if there is only one value allowed
-            if irange[0] >= irange[1]:
-                if irange[0] > idt.min:
-                    irange = (irange[0] - 1, irange[0])
-                else:
-                    irange = (irange[0], irange[0] + 1)
-
-            if img_fast:
-                try:
-                    # only (currently) supports uint16
-                    return img_fast.DataArray2RGB(data, irange, tint)
-                except ValueError as exp:
-                    logging.info("Fast conversion cannot run: %s", exp)
-                except Exception:
-                    logging.exception("Failed to use the fast conversion")
-
-            if irange[0] > idt.min or irange[1] < idt.max:
-                data = data.clip(*irange)
-        else: # floats et al. => always clip
-            # Ensure B&W if there is just one value allowed
-            if irange[0] >= irange[1]:
-                irange = (irange[0] - 1e-9, irange[0])
-            data = data.clip(*irange)
+            if irange[0] > idt.min:
+                irange = (irange[0] - 1, irange[0])
+            else:
+                irange = (irange[0], irange[0] + 1)
+    elif irange[0] >= irange[1]:  # floats et al.
+        # Ensure B&W if there is just one value allowed
+        irange = (irange[0] - 1e-9, irange[0])
 
-        # use .tolist() to force conversion to "safe" Python type, which avoid overflows
-        range_width = irange[1].tolist() - irange[0].tolist()
-        if data.dtype.kind == "i":
-            # Signed ints are "special" because we cannot use the same type to store the values shifted to 0.
-            dtype_uint = numpy.min_scalar_type(max(255, range_width))
-            dshift = numpy.subtract(data, irange[0], dtype=dtype_uint, casting="unsafe")
-        else:
-            dshift = data - irange[0]
+    # A colormap is converted to a look-up table (LUT) of 256 RGB colours
+    if isinstance(tint, colors.Colormap):
+        tint = getColormapLUT(tint)
 
-        if dshift.dtype == numpy.uint8:
-            drescaled = dshift  # re-use memory for the result
-        else:
-            # TODO: could directly use one channel of the 'rgb' variable?
-            drescaled = numpy.empty(data.shape, dtype=numpy.uint8)
-        # Ideally, it would be 255 / (irange[1] - irange[0]) + 0.5, but to avoid
-        # the addition, we can just use 255.99, and with the rounding down, it's
-        # very similar.
-        b = 255.99 / range_width
-        numpy.multiply(dshift, b, out=drescaled, casting="unsafe")
+    if img_fast:
+        try:
+            # Clip, scale and tint in a single pass (for all int and float types)
+            return img_fast.DataArray2RGB(data, irange, tint)
+        except ValueError as exp:
+            logging.info("Fast conversion cannot run: %s", exp)
+        except Exception:
+            logging.exception("Failed to use the fast conversion")
+
+    if isinstance(tint, numpy.ndarray):  # colormap
+        if data.dtype in (numpy.uint8, numpy.uint16):
+            # The LUT covers directly every possible value => a single gather
+            lut = getColormapLUT(tint, irange, data.dtype)
+            return numpy.take(lut, data, axis=0)
+        return numpy.take(tint, _rescaleToUint8(data, irange), axis=0)
+
+    drescaled = _rescaleToUint8(data, irange)
 
     # Now duplicate it 3 times to make it RGB (as a simple approximation of
     # greyscale)
@@ -487,6 +516,104 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
     return rgb
 
 
+def _rescaleToUint8(data, irange):
+    """
+    Clip and scale the data to 0->255
+    data (numpy.ndarray): the data, of any int or float type
+    irange (tuple of 2 values): min/max intensities mapped to 0/255. min must be < max.
+    return (numpy.ndarray of uint8): the scaled data, of the same shape
+    """
+    if data.dtype == numpy.uint8 and irange[0] == 0 and irange[1] == 255:
+        # short-cut when data is already the same type
+        # logging.debug("Applying direct range mapping to RGB")
+        return data
+        # TODO: also write short-cut for 16 bits by reading only the high byte?
+
+    # If data might go outside of the range, clip first
+    if data.dtype.kind in "iu":
+        # no need to clip if irange is the whole possible range
+        idt = numpy.iinfo(data.dtype)
+        if irange[0] > idt.min or irange[1] < idt.max:
+            data = data.clip(*irange)
+    else: # floats et al. => always clip
+        data = data.clip(*irange)
+
+    # use .tolist() to force conversion to "safe" Python type, which avoid overflows
+    range_width = irange[1].tolist() - irange[0].tolist()
+    if data.dtype.kind == "i":
+        # Signed ints are "special" because we cannot use the same type to store the values shifted to 0.
+        dtype_uint = numpy.min_scalar_type(max(255, range_width))
+        dshift = numpy.subtract(data, irange[0], dtype=dtype_uint, casting="unsafe")
+    else:
+        dshift = data - irange[0]
+
+    if dshift.dtype == numpy.uint8:
+        drescaled = dshift  # re-use memory for the result
+    else:
+        drescaled = numpy.empty(data.shape, dtype=numpy.uint8)
+    # Ideally, it would be 255 / (irange[1] - irange[0]) + 0.5, but to avoid
+    # the addition, we can just use 255.99, and with the rounding down, it's
+    # very similar.
+    b = 255.99 / range_width
+    numpy.multiply(dshift, b, out=drescaled, casting="unsafe")
+    return drescaled
+
+
+# Cache of the LUTs of the colormaps: (id of colormap or LUT, irange, dtype) -> (colormap or LUT, LUT)
+# The colormap is kept, to be sure its id is not reused.
+_colormap_luts = collections.OrderedDict()
+_colormap_luts_lock = threading.Lock()
+MAX_COLORMAP_LUTS = 32  # maximum number of LUTs cached
+
+
+def getColormapLUT(color_map, irange=None, dtype=None):
+    """
+    Compute the look-up table (LUT) of a colormap. The LUTs are cached, so
+    calling it repeatedly with the same arguments is cheap.
+    color_map (matplotlib.colors.Colormap or numpy.ndarray): the colormap, or
+      its LUT of 256 colours (as returned when irange is None).
+    irange (None or tuple of 2 values): min/max intensities mapped to the first/last
+      colour of the colormap. If None, the LUT has 256 colours.
+    dtype (None or numpy.dtype): uint8 or uint16, the type of the data, needed
+      if irange is not None.
+    return (numpy.ndarray of shape (N, 3) of uint8): the RGB colour of each value,
+      with N = 256 if irange is None, or else the number of possible values of dtype.
+      It must not be modified.
+    """
+    if irange is not None:
+        irange = tuple(numpy.asarray(irange).tolist())
+        dtype = numpy.dtype(dtype)
+    key = (id(color_map), irange, dtype)
+    with _colormap_luts_lock:
+        try:
+            cm_cached, lut = _colormap_luts[key]
+            if cm_cached is color_map:
+                _colormap_luts.move_to_end(key)
+                return lut
+        except KeyError:
+            pass
+
+    if irange is None:
+        # Use the colormap on 256 values
+        lut = color_map(numpy.linspace(0.0, 1.0, 256))[:, :3]  # discard alpha channel
+        lut = numpy.multiply(lut, 255).astype(numpy.uint8)
+    else:
+        if isinstance(color_map, numpy.ndarray):
+            lut256 = color_map
+        else:
+            lut256 = getColormapLUT(color_map)
+        values = numpy.arange(numpy.iinfo(dtype).min, numpy.iinfo(dtype).max + 1, dtype=dtype)
+        irange = numpy.array(irange, dtype=dtype)
+        lut = numpy.take(lut256, _rescaleToUint8(values, irange), axis=0)
+    lut.flags.writeable = False
+
+    with _colormap_luts_lock:
+        _colormap_luts[key] = (color_map, lut)
+        while len(_colormap_luts) > MAX_COLORMAP_LUTS:
+            _colormap_luts.popitem(last=False)
+    return lut
+
+
 def getColorbar(color_map, width, height, alpha=False):
     """
     Returns an RGB gradient rectangle or colorbar (as numpy array with 2 dim of RGB tuples)
@@ -717,7 +844,9 @@ def Subtract(a, b):
     # TODO: see if it is more useful to upgrade the type to a bigger if overflow
     if a.dtype.kind in "bu":
         # avoid underflow so that 1 - 2 = 0 (and not 65536)
-        return numpy.maximum(a, b) - b
+        r = numpy.maximum(a, b)
+        r -= b  # in-place, to avoid another copy of the (big) data
+        return r
     else:
         # TODO handle under/over-flows with integer types (127 - (-1) => -128)
         return a - b
@@ -839,6 +968,71 @@ def mean_within_circle(data: model.DataArray, center: Tuple[float, float], radiu
     return mean
 
 
+def getLineProfileWeights(shape, start, end, n, width=1):
+    """
+    Compute the weights to apply to each pixel of an image to get the profile
+    along a line, of a given width. Each point of the profile is the mean of
+    the points across the line, bilinearly interpolated. The points which fall
+    outside of the image are not taken into account in the mean (instead of
+    counting as 0). A point is considered inside the image if it's within the
+    area of a pixel, so a line on the border of the image is still fully used.
+    The weights only depend on the geometry, so they can be reused for all the
+    images of the same shape, typically the ones at every wavelength.
+
+    shape (int, int): shape of the image (Y, X)
+    start (float, float): position of the beginning of the line, in px (X, Y)
+    end (float, float): position of the end of the line, in px (X, Y)
+    n (1 <= int): number of points of the profile, evenly spread from start to end
+    width (1 <= int): number of points across the line (spaced by 1 px), which
+      are averaged.
+    return:
+      pixels (ndarray of int of shape K): index of the pixels used, in the
+        flattened image (ie, y * X + x)
+      weights (scipy.sparse.csr_matrix of shape (n, K)): the weight of each
+        of these pixels, for each point of the profile. If all the points across
+        the line are outside of the image, the weights of the profile point are
+        all 0.
+      To get the profile of images A of shape (..., Y, X), as an array of shape
+      (n, ...), compute: weights @ A.reshape(-1, Y * X)[:, pixels].T
+    """
+    sy, sx = shape
+    v = (end[0] - start[0], end[1] - start[1])
+    l = math.hypot(*v)
+    # perpendicular unit vector
+    pv = (-v[1] / l, v[0] / l) if l > 0 else (0, 0)
+    spread = (width - 1) / 2
+    wpos = numpy.linspace(-spread, spread, width)
+
+    # Coordinates of all the points, as (n, width)
+    px = numpy.linspace(start[0], end[0], n)[:, None] + pv[0] * wpos
+    py = numpy.linspace(start[1], end[1], n)[:, None] + pv[1] * wpos
+    valid = (px >= -0.5) & (px < sx - 0.5) & (py >= -0.5) & (py < sy - 0.5)
+    # Each point has the same weight, among the points inside the image
+    nvalid = valid.sum(axis=1, keepdims=True)
+    pw = valid / numpy.maximum(nvalid, 1)
+
+    # Bilinear interpolation: the weight of each of the 4 pixels around
+    px = numpy.clip(px, 0, sx - 1)
+    py = numpy.clip(py, 0, sy - 1)
+    x0 = numpy.minimum(px.astype(numpy.intp), max(sx - 2, 0))
+    y0 = numpy.minimum(py.astype(numpy.intp), max(sy - 2, 0))
+    fx = px - x0
+    fy = py - y0
+    x1 = numpy.minimum(x0 + 1, sx - 1)
+    y1 = numpy.minimum(y0 + 1, sy - 1)
+
+    cols = numpy.stack([y0 * sx + x0, y0 * sx + x1, y1 * sx + x0, y1 * sx + x1])
+    vals = numpy.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx]) * pw
+    rows = numpy.broadcast_to(numpy.arange(n)[:, None], cols.shape)
+    # Only keep the pixels used, to avoid going through the whole image
+    pixels, cols = numpy.unique(cols, return_inverse=True)
+    # The duplicate entries (ie, when x0 == x1) are summed
+    weights = scipy.sparse.csr_matrix((vals.ravel(), (rows.ravel(), cols.ravel())),
+                                      shape=(n, len(pixels)))
+    weights.eliminate_zeros()
+    return pixels, weights
+
+
 def mergeMetadata(current, correction=None):
     """
     Applies the correction metadata to the current metadata.
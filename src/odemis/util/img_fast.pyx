@@ -17,98 +17,294 @@ You should have received a copy of the GNU General Public License along with Ode
 # Optimised versions of the functions of odemis.util.img
 
 import cython
+from cython.parallel import prange, threadid
+import os
 
 # import both numpy and the Cython declarations for numpy
 import numpy
 cimport numpy
 
-# TODO: use fused types to support multiple types (but needs Cython >= 0.20)
-ctypedef numpy.uint16_t uint16_t
+# All the types of data which can be converted
+ctypedef fused image_t:
+    numpy.uint8_t
+    numpy.uint16_t
+    numpy.uint32_t
+    numpy.uint64_t
+    numpy.int8_t
+    numpy.int16_t
+    numpy.int32_t
+    numpy.int64_t
+    numpy.float32_t
+    numpy.float64_t
 
-# nogil allows multi-threading but prevents use of any Python objects or call
+SUPPORTED_DTYPES = frozenset(numpy.dtype(t) for t in (
+    numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64,
+    numpy.int8, numpy.int16, numpy.int32, numpy.int64,
+    numpy.float32, numpy.float64))
+
+# Below this number of pixels, it's not worthy to start threads
+MIN_PARALLEL_SIZE = 256 * 256
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
-cdef void cDataArray2RGB(uint16_t* data, int datalen, uint16_t irange0, uint16_t irange1,
-                         int* tint, numpy.uint8_t* ret) nogil:
-    cdef double b = 255. / <double>(irange1 - irange0)
-    cdef double br = (b * <double>tint[0]) / 255.
-    cdef double bg = (b * <double>tint[1]) / 255.
-    cdef double bb = (b * <double>tint[2]) / 255.
-
-    cdef numpy.uint8_t di
-    cdef double df
-    cdef int retpos = 0
-
-    if tint[0] == tint[1] == tint[2] == 255:
-        # optimised version, without tinting (about 2x faster)
-        for i in range(datalen):
-            # clip
-            if data[i] <= irange0:
+cdef void cDataArray2RGB(const image_t* data, Py_ssize_t h, Py_ssize_t w,
+                         double irange0, double irange1,
+                         const numpy.uint8_t[:, ::1] lut, numpy.uint8_t[:, :, ::1] ret,
+                         int nthreads) nogil:
+    """
+    Convert the data to RGB in one pass: each pixel is clipped, scaled to 0->255,
+    and converted to RGB via the look-up table.
+    nthreads (int): number of threads to use
+    """
+    cdef Py_ssize_t y, x
+    cdef double b = 255. / (irange1 - irange0)
+    cdef double v
+    cdef int di
+
+    # nogil allows multi-threading but prevents use of any Python objects or call
+    for y in prange(h, schedule="static", num_threads=nthreads):
+        for x in range(w):
+            v = <double> data[y * w + x]
+            # clip (NaN is considered as the minimum)
+            if not v > irange0:
                 di = 0
-            elif data[i] >= irange1:
+            elif v >= irange1:
                 di = 255
             else:
-                di = <numpy.uint8_t> ((data[i] - irange0) * b + 0.5)
-            ret[retpos] = di
-            retpos += 1
-            ret[retpos] = di
-            retpos += 1
-            ret[retpos] = di
-            retpos += 1
-    else:
-        for i in range(datalen):
-            # clip
-            if data[i] <= irange0:
-                ret[retpos] = 0
-                retpos += 1
-                ret[retpos] = 0
-                retpos += 1
-                ret[retpos] = 0
-                retpos += 1
-            elif data[i] >= irange1:
-                ret[retpos] = tint[0]
-                retpos += 1
-                ret[retpos] = tint[1]
-                retpos += 1
-                ret[retpos] = tint[2]
-                retpos += 1
-            else:
-                df = (data[i] - irange0)
-                ret[retpos] = <numpy.uint8_t> (df * br + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bg + 0.5)
-                retpos += 1
-                ret[retpos] = <numpy.uint8_t> (df * bb + 0.5)
-                retpos += 1
-
-# This function is probably not needed, but I have no idea how to instantiate
-# a numpy array which can be passed as a pointer
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def wrapDataArray2RGB(numpy.ndarray[uint16_t, ndim=2] data not None,
-                  irange,
-                  tint,
-                  numpy.ndarray[numpy.uint8_t, ndim=3] ret not None):
-    cdef int ctint[3]
-    ctint[0] = tint[0]
-    ctint[1] = tint[1]
-    ctint[2] = tint[2]
-    cDataArray2RGB(&data[0,0], data.size, irange[0], irange[1], ctint, &ret[0,0,0])
+                di = <int> ((v - irange0) * b + 0.5)
+            ret[y, x, 0] = lut[di, 0]
+            ret[y, x, 1] = lut[di, 1]
+            ret[y, x, 2] = lut[di, 2]
+
+
+# A pointer is passed (instead of a memoryview), as Cython < 3 doesn't support
+# const fused memoryviews, and the data might be read-only.
+def _DataArray2RGB(numpy.ndarray data, double irange0, double irange1,
+                   const numpy.uint8_t[:, ::1] lut, numpy.uint8_t[:, :, ::1] ret,
+                   int nthreads):
+    cdef void* p = numpy.PyArray_DATA(data)
+    cdef Py_ssize_t h = data.shape[0]
+    cdef Py_ssize_t w = data.shape[1]
+    # Dispatch on the kind and size, as the same type might have several numbers
+    cdef char kind = ord(data.dtype.kind)
+    cdef int itemsize = data.dtype.itemsize
+    with nogil:
+        if kind == b'u':
+            if itemsize == 1:
+                cDataArray2RGB(<numpy.uint8_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+            elif itemsize == 2:
+                cDataArray2RGB(<numpy.uint16_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+            elif itemsize == 4:
+                cDataArray2RGB(<numpy.uint32_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+            elif itemsize == 8:
+                cDataArray2RGB(<numpy.uint64_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+        elif kind == b'i':
+            if itemsize == 1:
+                cDataArray2RGB(<numpy.int8_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+            elif itemsize == 2:
+                cDataArray2RGB(<numpy.int16_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+            elif itemsize == 4:
+                cDataArray2RGB(<numpy.int32_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+            elif itemsize == 8:
+                cDataArray2RGB(<numpy.int64_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+        elif kind == b'f':
+            if itemsize == 4:
+                cDataArray2RGB(<numpy.float32_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+            elif itemsize == 8:
+                cDataArray2RGB(<numpy.float64_t*> p, h, w, irange0, irange1, lut, ret, nthreads)
+
+
+_tint_luts = {}  # tint (3-tuple) -> LUT
+
+
+def tint_to_lut(tint):
+    """
+    Compute the look-up table to convert a greyscale value to a tinted RGB value
+    tint (3-tuple of 0<=int<=255): the RGB colour of the maximum value
+    return (numpy.ndarray of shape (256, 3) of uint8): the RGB value for each
+      greyscale value. It should not be modified.
+    """
+    tint = tuple(int(t) for t in tint)
+    try:
+        return _tint_luts[tint]
+    except KeyError:
+        pass
+
+    lut = numpy.empty((256, 3), dtype=numpy.uint8)
+    lut[:] = numpy.arange(256)[:, numpy.newaxis] * (numpy.array(tint) / 255) + 0.5
+    lut.flags.writeable = False
+    if len(_tint_luts) > 256:  # Don't let it grow forever
+        _tint_luts.clear()
+    _tint_luts[tint] = lut
+    return lut
 
 
 def DataArray2RGB(data, irange, tint=(255, 255, 255)):
+    """
+    Optimised version of img.DataArray2RGB()
+    data (numpy.ndarray): 2D image, C-contiguous, of any int or float type
+    irange (tuple of 2 numbers): min/max intensities mapped to black/white.
+      min must be < max.
+    tint (3-tuple of 0<=int<=255, or numpy.ndarray of shape (256, 3) of uint8):
+      either the RGB colour of the final image, or a look-up table giving the
+      RGB colour of each of the 256 levels (eg, a colormap).
+    return (numpy.ndarray of shape (Y, X, 3) of uint8): the RGB image
+    raise ValueError: if the data is not supported by the optimised version
+    """
+    if data.ndim != 2:
+        raise ValueError("Optimised version only works on 2D arrays (got %d dims)" % (data.ndim,))
     if not data.flags.c_contiguous:
         raise ValueError("Optimised version only works with C-contiguous arrays")
-    if data.dtype != numpy.uint16:
-        # Note: cython automatically detects such errors, but it seems that with
-        # ctyhon 0.23, it can leak memory.
-        raise ValueError("Optimised version only works on uint16 (got %s)" % (data.dtype,))
+    # Note: cython automatically detects such errors, but it seems that with
+    # ctyhon 0.23, it can leak memory.
+    if data.dtype not in SUPPORTED_DTYPES or not data.dtype.isnative:
+        raise ValueError("Optimised version doesn't support %s" % (data.dtype,))
     # Note: we could also make an optimised version for F-contiguous arrays,
-    # but it's not clear when it'd be useful. For more complex arrays, it's also
-    # probably possible to generate a faster version than numpy, but I don't
-    # know how.
-    if irange[0] >= irange[1]:
+    # but it's not clear when it'd be useful.
+    if not irange[0] < irange[1]:
         raise ValueError("irange needs to be a tuple of low/high values")
+
+    if isinstance(tint, numpy.ndarray):
+        lut = tint
+        if lut.shape != (256, 3) or lut.dtype != numpy.uint8:
+            raise ValueError("LUT should be of shape 256 x 3 of uint8 (got %s of %s)" %
+                             (lut.shape, lut.dtype))
+        lut = numpy.ascontiguousarray(lut)
+    else:
+        lut = tint_to_lut(tint)
+
+    if data.size >= MIN_PARALLEL_SIZE:
+        nthreads = os.cpu_count() or 1
+    else:
+        nthreads = 1
     ret = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
-    wrapDataArray2RGB(data, irange, tint, ret)
+    _DataArray2RGB(data, float(irange[0]), float(irange[1]), lut, ret, nthreads)
     return ret
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void cHistogram(const image_t* data, Py_ssize_t h, Py_ssize_t w, Py_ssize_t step,
+                     double irange0, double irange1, double binw,
+                     numpy.int64_t[:, ::1] hists, double[:, ::1] minmax,
+                     int nthreads) nogil:
+    """
+    Compute the histogram and the min/max of the data in one pass. Each thread
+    accumulates in its own histogram (and min/max), which have to be summed
+    afterwards.
+    step (1<=int): only one pixel every step is counted, on each dimension
+    binw (0<float): width of a bin. If hists has 0 bins, only min/max is computed.
+    hists (int64 array of shape nthreads x bins): must be initialised to 0.
+    minmax (float array of shape nthreads x 2): must be initialised to +inf/-inf.
+    """
+    cdef Py_ssize_t y, x, b
+    cdef int t
+    cdef Py_ssize_t length = hists.shape[1]
+    cdef Py_ssize_t nx = (w + step - 1) // step
+    cdef double v
+
+    for y in prange(0, h, step, schedule="static", num_threads=nthreads):
+        t = threadid()
+        for x in range(nx):
+            v = <double> data[y * w + x * step]
+            # NaN is never counted
+            if v < minmax[t, 0]:
+                minmax[t, 0] = v
+            if v > minmax[t, 1]:
+                minmax[t, 1] = v
+            if length == 0 or not (irange0 <= v <= irange1):
+                continue
+            b = <Py_ssize_t> ((v - irange0) / binw)
+            if b >= length:  # v == irange1, for floats
+                b = length - 1
+            hists[t, b] += 1
+
+
+def _histogram(numpy.ndarray data, Py_ssize_t step, double irange0, double irange1,
+               double binw, numpy.int64_t[:, ::1] hists, double[:, ::1] minmax,
+               int nthreads):
+    cdef void* p = numpy.PyArray_DATA(data)
+    cdef Py_ssize_t h = data.shape[0]
+    cdef Py_ssize_t w = data.shape[1]
+    cdef char kind = ord(data.dtype.kind)
+    cdef int itemsize = data.dtype.itemsize
+    with nogil:
+        if kind == b'u':
+            if itemsize == 1:
+                cHistogram(<numpy.uint8_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+            elif itemsize == 2:
+                cHistogram(<numpy.uint16_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+            elif itemsize == 4:
+                cHistogram(<numpy.uint32_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+            elif itemsize == 8:
+                cHistogram(<numpy.uint64_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+        elif kind == b'i':
+            if itemsize == 1:
+                cHistogram(<numpy.int8_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+            elif itemsize == 2:
+                cHistogram(<numpy.int16_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+            elif itemsize == 4:
+                cHistogram(<numpy.int32_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+            elif itemsize == 8:
+                cHistogram(<numpy.int64_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+        elif kind == b'f':
+            if itemsize == 4:
+                cHistogram(<numpy.float32_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+            elif itemsize == 8:
+                cHistogram(<numpy.float64_t*> p, h, w, step, irange0, irange1, binw, hists, minmax, nthreads)
+
+
+def histogram(data, irange=None, length=0, step=1):
+    """
+    Optimised computation of the histogram and min/max of an image, in a single
+    (parallel) pass.
+    data (numpy.ndarray): 2D image, C-contiguous, of any int or float type
+    irange (None or tuple of 2 numbers): lowest and highest values of the
+      histogram (both included). Values outside of this range are not counted
+      in the histogram (but still in the min/max).
+    length (0<=int): number of bins. If 0, only the min/max is computed.
+      For integers, the range width (irange[1] - irange[0] + 1) must be a
+      multiple of the bin width, except for the last bin, which may be partial.
+    step (1<=int): only one pixel every step is looked at, along each dimension.
+    return hist, min, max:
+      hist (ndarray 1D of int64): number of pixels in each bin
+      min, max (float): the smallest and largest values (seen). If there is no
+        (non-NaN) value, min is +inf, and max is -inf.
+    raise ValueError: if the data is not supported by the optimised version
+    """
+    if data.ndim != 2:
+        raise ValueError("Optimised version only works on 2D arrays (got %d dims)" % (data.ndim,))
+    if not data.flags.c_contiguous:
+        raise ValueError("Optimised version only works with C-contiguous arrays")
+    if data.dtype not in SUPPORTED_DTYPES or not data.dtype.isnative:
+        raise ValueError("Optimised version doesn't support %s" % (data.dtype,))
+    if step < 1:
+        raise ValueError("step must be a positive int (got %s)" % (step,))
+
+    if length:
+        if not irange[0] <= irange[1]:
+            raise ValueError("irange needs to be a tuple of low/high values")
+        if data.dtype.kind in "biu":
+            # Each bin contains the same number of integer values
+            binw = -(-(int(irange[1]) - int(irange[0]) + 1) // length)
+        else:
+            binw = (irange[1] - irange[0]) / length
+            if binw == 0:  # Only one value => all in the first bin
+                binw = 1
+        irange0, irange1 = float(irange[0]), float(irange[1])
+    else:
+        irange0, irange1, binw = 0., 0., 1.
+
+    if data.size // (step * step) >= MIN_PARALLEL_SIZE:
+        nthreads = os.cpu_count() or 1
+    else:
+        nthreads = 1
+    hists = numpy.zeros((nthreads, length), dtype=numpy.int64)
+    minmax = numpy.empty((nthreads, 2), dtype=numpy.float64)
+    minmax[:, 0] = numpy.inf
+    minmax[:, 1] = -numpy.inf
+    _histogram(data, step, irange0, irange1, binw, hists, minmax, nthreads)
+    return hists.sum(axis=0), minmax[:, 0].min(), minmax[:, 1].max()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 17 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+import numpy
+from odemis.util.cache import LRUCache
+import unittest
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(1000)
+        a = numpy.zeros(400, dtype=numpy.uint8)
+        b = numpy.zeros(400, dtype=numpy.uint8)
+        c = numpy.zeros(400, dtype=numpy.uint8)
+
+        cache.put("a", a)
+        cache.put("b", b)
+        self.assertEqual(cache.nbytes, 800)
+        self.assertIs(cache.get("a"), a)  # => a is now the most recently used
+
+        cache.put("c", c)  # => b is evicted
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 800)
+        self.assertIsNone(cache.get("b"))
+        self.assertIs(cache.get("a"), a)
+        self.assertIs(cache.get("c"), c)
+        self.assertEqual(cache.get("b", "nope"), "nope")
+
+        # Replacing a value updates the size
+        cache.put("c", "small", nbytes=10)
+        self.assertEqual(cache.nbytes, 410)
+        self.assertEqual(cache.get("c"), "small")
+
+        # Too big to be cached
+        cache.put("d", numpy.zeros(2000, dtype=numpy.uint8))
+        self.assertNotIn("d", cache)
+        self.assertEqual(cache.nbytes, 410)
+
+        cache.discard("a")
+        cache.discard("a")  # No error if not present
+        self.assertEqual(cache.nbytes, 10)
+
+        cache.put(("x", 1), "foo", nbytes=10)
+        cache.put(("x", 2), "bar", nbytes=10)
+        cache.put(("y", 1), "foo", nbytes=10)
+        cache.purge(lambda k: k[0] == "x")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 20)
+        self.assertIn(("y", 1), cache)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -297,6 +297,74 @@ class TestHistogram(unittest.TestCase):
         hist_forced, edges = img.histogram(grey_img, edges)
         numpy.testing.assert_array_equal(hist, hist_forced)
 
+    def test_length_step(self):
+        """
+        test histogram() with a given length, and subsampling
+        """
+        size = (2048, 2048)
+        for dtype, irange in (("uint16", (0, 4095)), ("uint32", (-256, 4095 + 256)),
+                              ("int16", (-4096, 4095)), ("float32", (-10., 4500.))):
+            grey_img = numpy.random.randint(0, 4096, size).astype(dtype)
+            grey_img[0, 0] = 0
+            grey_img[0, 1] = 4095
+
+            tstart = time.time()
+            hist, edges = img.histogram(grey_img, irange)
+            chist_full = img.compactHistogram(hist, 256)
+            full_dur = time.time() - tstart
+            tstart = time.time()
+            chist, cedges = img.histogram(grey_img, irange, length=256)
+            compact_dur = time.time() - tstart
+            tstart = time.time()
+            shist, sedges = img.histogram(grey_img, irange, length=256, step=4)
+            sub_dur = time.time() - tstart
+            print("Time %s histogram full = %g s, compact = %g s, subsampled = %g s" %
+                  (dtype, full_dur, compact_dur, sub_dur))
+
+            self.assertEqual(cedges, edges)
+            self.assertEqual(sedges, edges)
+            self.assertEqual(len(chist), 256)
+            if grey_img.dtype.kind != "f":  # float bins are not exactly aligned
+                numpy.testing.assert_array_equal(chist, chist_full)
+            self.assertEqual(chist.sum(), grey_img.size)
+            self.assertEqual(shist.sum(), grey_img[::4, ::4].size)
+            # Same distribution (roughly)
+            numpy.testing.assert_allclose(shist * 16, chist, rtol=0.1, atol=200)
+
+            # Non-contiguous gives the same result
+            nchist, _ = img.histogram(grey_img.T.copy().T, irange, length=256)
+            numpy.testing.assert_array_equal(nchist, chist)
+
+    def test_length_not_multiple(self):
+        """
+        test histogram() with a length, for a range which is not a multiple of the bin width
+        """
+        irange = (100, 4095)  # 3996 values => 250 bins of 16 values, the last one partial
+        grey_img = numpy.random.randint(irange[0], irange[1] + 1, (512, 512)).astype(numpy.uint16)
+        grey_img[0, 0] = irange[1]
+
+        hist, edges = img.histogram(grey_img, irange)
+        chist_full = img.compactHistogram(hist, 256)
+        chist, cedges = img.histogram(grey_img, irange, length=256)
+        self.assertEqual(cedges, irange)
+        self.assertEqual(len(chist), 250)
+        numpy.testing.assert_array_equal(chist, chist_full)
+        self.assertGreater(chist[-1], 0)  # No empty bins past the range
+
+    def test_minmax(self):
+        for dtype in ("uint8", "uint16", "int32", "uint64", "float32", "float64"):
+            data = numpy.zeros((512, 300), dtype=dtype) + 3
+            data[10, 61] = 1
+            data[100, 101] = 120
+            self.assertEqual(img.minmax(data), (1, 120))
+            self.assertEqual(img.minmax(data[:, 50:]), (1, 120))
+            # subsampled -> only see the 3's
+            self.assertEqual(img.minmax(data, step=4), (3, 3))
+
+        data = numpy.zeros((10, 10), dtype=numpy.uint64) + (2 ** 64 - 1)
+        data[2, 2] = 2 ** 64 - 2
+        self.assertEqual(img.minmax(data), (2 ** 64 - 2, 2 ** 64 - 1))
+
     def test_compact(self):
         """
         test the compactHistogram()
@@ -510,6 +578,37 @@ class TestDataArray2RGB(unittest.TestCase):
         # ±1, to handle the value shifts by the standard converter to handle floats
         numpy.testing.assert_almost_equal(rgb, rgb_nc_back, decimal=0)
 
+    def test_fast_dtypes(self):
+        """Benchmark the fast conversion on 4k x 4k images of every type"""
+        try:
+            import odemis.util.img_fast
+        except ImportError as ex:
+            self.skipTest(f"img_fast not available ({ex}), cannot test it")
+
+        size = (4096, 4096)
+        tint = (0, 73, 255)
+        for dtype in ("uint8", "uint16", "uint32", "int16", "int32", "float32", "float64"):
+            if numpy.dtype(dtype).kind == "f":
+                data = numpy.random.random(size).astype(dtype) * 1000 - 200
+            else:
+                data = numpy.random.randint(0, 200, size).astype(dtype)
+            irange = numpy.array((10, 180), dtype=dtype)
+            data_nc = data.T.copy().T  # non-contiguous cannot be treated by fast conversion
+
+            for t in ((255, 255, 255), tint):
+                tstart = time.time()
+                rgb = img.DataArray2RGB(data, irange, t)
+                fast_dur = time.time() - tstart
+
+                tstart = time.time()
+                rgb_nc = img.DataArray2RGB(data_nc, irange, t)
+                std_dur = time.time() - tstart
+
+                print("Time %s (tint %s) fast conversion = %g s, standard = %g s" %
+                      (dtype, t, fast_dur, std_dur))
+                # ±1, to handle the value shifts by the standard converter to handle floats
+                numpy.testing.assert_allclose(rgb, rgb_nc, atol=1)
+
     def test_tint(self):
         """test with tint (on the fast path)"""
         size = (1024, 1024)
@@ -558,6 +657,47 @@ class TestDataArray2RGB(unittest.TestCase):
         self.assertTrue(numpy.all(pixel0 <= pixelg))
         self.assertTrue(numpy.all(pixelg <= pixel1))
 
+    def test_colormap(self):
+        """test with a colormap, on the fast path and on the LUT path"""
+        size = (1024, 1024)
+        cmap = cm.get_cmap("viridis")
+        for dtype in ("uint8", "uint16", "int16", "float32"):
+            data = numpy.zeros(size, dtype=dtype)
+            data[:] = numpy.arange(size[1]) // 8
+            irange = numpy.array((10, 100), dtype=dtype)
+            data_nc = data.T.copy().T  # non-contiguous => cannot use the fast conversion
+
+            tstart = time.time()
+            out = img.DataArray2RGB(data, irange, cmap)
+            fast_dur = time.time() - tstart
+            tstart = time.time()
+            out_nc = img.DataArray2RGB(data_nc, irange, cmap)
+            lut_dur = time.time() - tstart
+            # Reference: per pixel matplotlib computation
+            tstart = time.time()
+            norm = colors.Normalize(vmin=irange[0], vmax=irange[1], clip=True)
+            out_ref = (cmap(norm(data))[:, :, :3] * 255).astype(numpy.uint8)
+            ref_dur = time.time() - tstart
+            print("Time %s colormap fast conversion = %g s, LUT = %g s, matplotlib = %g s" %
+                  (dtype, fast_dur, lut_dur, ref_dur))
+
+            self.assertEqual(out.shape, size + (3,))
+            self.assertEqual(out.dtype, numpy.uint8)
+            numpy.testing.assert_array_equal(out[0, 0], out_ref[0, 0])  # min
+            numpy.testing.assert_array_equal(out[0, -1], out_ref[0, -1])  # max
+            # Due to different rounding, it might be the neighbour colour in the colormap
+            numpy.testing.assert_allclose(out, out_ref, atol=4)
+            numpy.testing.assert_allclose(out_nc, out_ref, atol=4)
+
+        # The LUTs are cached
+        lut = img.getColormapLUT(cmap)
+        self.assertIs(img.getColormapLUT(cmap), lut)
+        self.assertEqual(lut.shape, (256, 3))
+        lut16 = img.getColormapLUT(cmap, (10, 100), numpy.uint16)
+        self.assertEqual(lut16.shape, (2 ** 16, 3))
+        self.assertIs(img.getColormapLUT(cmap, (10, 100), numpy.uint16), lut16)
+        numpy.testing.assert_array_equal(lut16[100:], lut[-1:].repeat(2 ** 16 - 100, axis=0))
+
     def test_uint8(self):
         # uint8 is special because it's so close from the output that bytescale
         # normally does nothing
@@ -969,6 +1109,56 @@ class TestMeanWithinCircle(unittest.TestCase):
         numpy.testing.assert_almost_equal(m, data[:, :, 15, 10])  # Y, X are in reverse order
 
 
+class TestGetLineProfileWeights(unittest.TestCase):
+
+    def _profile(self, data, start, end, n, width):
+        pixels, weights = img.getLineProfileWeights(data.shape[-2:], start, end, n, width)
+        return numpy.asarray(weights @ data.reshape(-1, data.shape[-2] * data.shape[-1])[:, pixels].T)
+
+    def test_inside(self):
+        """
+        Check that a line inside the image is the same as a bilinear interpolation
+        """
+        data = numpy.random.random((50, 30, 40))
+        # Horizontal line => just the pixels
+        prof = self._profile(data, (3, 7), (33, 7), 31, 1)
+        numpy.testing.assert_almost_equal(prof, data[:, 7, 3:34].T)
+
+        # Diagonal line, with width
+        start, end, n, width = (30, 25), (3, 2), 36, 3
+        prof = self._profile(data, start, end, n, width)
+        v = (end[0] - start[0], end[1] - start[1])
+        l = math.hypot(*v)
+        pv = (-v[1] / l, v[0] / l)
+        for i, (x, y) in enumerate(zip(numpy.linspace(start[0], end[0], n),
+                                       numpy.linspace(start[1], end[1], n))):
+            exp = 0
+            for w in (-1, 0, 1):
+                px, py = x + w * pv[0], y + w * pv[1]
+                x0, y0 = int(px), int(py)
+                fx, fy = px - x0, py - y0
+                exp += (data[:, y0, x0] * (1 - fx) * (1 - fy) + data[:, y0, x0 + 1] * fx * (1 - fy) +
+                        data[:, y0 + 1, x0] * (1 - fx) * fy + data[:, y0 + 1, x0 + 1] * fx * fy)
+            numpy.testing.assert_almost_equal(prof[i], exp / 3)
+
+    def test_outside(self):
+        """
+        Check that the points outside of the image are not counted in the mean
+        """
+        data = numpy.full((5, 30, 40), 7, dtype=numpy.uint16)
+        # On the border, half of the width is outside
+        prof = self._profile(data, (0, 0), (39, 0), 40, 10)
+        numpy.testing.assert_almost_equal(prof, 7)
+
+        # Image of just one line, with an even width
+        prof = self._profile(data[:, :1, :], (2, 0), (30, 0), 29, 4)
+        numpy.testing.assert_almost_equal(prof, 7)
+
+        # Completely outside => 0
+        pixels, weights = img.getLineProfileWeights((30, 40), (50, 50), (60, 50), 11, 2)
+        self.assertEqual(weights.nnz, 0)
+
+
 class TestImageIntegrator(unittest.TestCase):
 
     def setUp(self):
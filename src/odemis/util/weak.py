@@ -73,6 +73,9 @@ class WeakMethodFree(object):
     #    return not self == other
 
 def WeakMethod(f):
+    if isinstance(f, (WeakMethodBound, WeakMethodFree)):
+        # Already weak (eg, a listener passed back to unsubscribe())
+        return f
     try:
         # Check if the parameter has a function object, which is the case
         # if it's a bound function (ie.e a method)